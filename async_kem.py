@@ -0,0 +1,258 @@
+# asyncio front-end for the KEM.
+#
+# A KEM operation takes milliseconds of CPU time, so calling it inline
+# blocks the event loop. AsyncKyber runs the operations of one mode in an
+# executor (threads by default, or any concurrent.futures executor such
+# as a ProcessPoolExecutor) and awaits the result:
+#
+#   - at most max_concurrency jobs are in the executor at a time; further
+#     requests wait on a semaphore
+#   - at most max_pending requests are accepted (waiting or running);
+#     beyond that a request fails immediately with Overloaded, so a
+#     server can shed load instead of queueing without bound
+#   - with batch_window set, requests of the same kind that arrive within
+#     batch_window seconds of each other are grouped, up to max_batch of
+#     them, into one call of the batched KEM of batch.py (requires numpy)
+#   - the latency of every request, from the call to the result, is
+#     recorded; latency_percentiles reports percentiles over the last
+#     history requests
+#
+# async_keypair, async_encaps and async_decaps use a default AsyncKyber
+# per mode unless one is passed in.
+
+from batch import *
+import asyncio
+from collections import deque
+from concurrent.futures import Executor, ThreadPoolExecutor
+from math import ceil
+from os import cpu_count
+from threading import Lock
+from time import perf_counter
+
+
+class Overloaded(RuntimeError):
+    pass
+
+
+# Executor tasks; module level so a process executor can pickle them
+def kem_task(op:str, mode:int, args:tuple):
+    return getattr(Kyber(mode), op)(*args)
+
+BATCH_FUNCTIONS = {"keypair": crypto_kem_keypair_batch, "encaps": crypto_kem_enc_batch,
+                   "decaps": crypto_kem_dec_batch}
+
+def batch_task(op:str, mode:int, args:tuple):
+    return BATCH_FUNCTIONS[op](*args, get_params(mode))
+
+
+#################################################
+# Name:        AsyncKyber
+#
+# Description: Awaitable KEM operations of one mode, see above
+#
+# Arguments:   - int mode: 2, 3 or 4
+#              - Executor executor: executor to run operations in; by
+#                default a ThreadPoolExecutor owned by this object
+#              - int max_concurrency: jobs in the executor at a time,
+#                defaults to os.cpu_count()
+#              - int max_pending: accepted requests at a time, None for
+#                no limit
+#              - float batch_window: seconds to collect a micro-batch,
+#                None to run every request on its own
+#              - int max_batch: maximum size of a micro-batch
+#              - int history: number of latencies kept per operation
+##################################################
+class AsyncKyber:
+    def __init__(self, mode:int, executor:Executor=None, max_concurrency:int=None, max_pending:int=None,
+                 batch_window:float=None, max_batch:int=64, history:int=10000):
+        if batch_window is not None and np is None:
+            raise ImportError("Micro-batching requires numpy to be installed")
+        if max_batch < 1:
+            raise ValueError("max_batch must be at least 1")
+        self.params = get_params(mode)
+        self.owns_executor = executor is None
+        self.max_concurrency = max_concurrency or cpu_count() or 1
+        self.executor = executor or ThreadPoolExecutor(self.max_concurrency)
+        self.threads = isinstance(self.executor, ThreadPoolExecutor)
+        self.semaphore, self.loop = None, None
+        self.max_pending = max_pending
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.pending = 0
+        self.rejected = 0
+        self.batches = 0
+        self.queues = {op: [] for op in BATCH_FUNCTIONS}
+        self.timers = {}
+        self.tasks = set()
+        self.latencies = {op: deque(maxlen=history) for op in BATCH_FUNCTIONS}
+
+    def close(self):
+        if self.owns_executor:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    async def keypair(self, key_seed:bytes=None, z:bytes=None) -> Tuple[bytes, bytes]:
+        for x in (key_seed, z):
+            if x is not None and len(x) != self.params.KYBER_SYMBYTES:
+                raise ValueError("Seeds must be KYBER_SYMBYTES long")
+        return await self.submit("keypair", (key_seed, z))
+
+    async def encaps(self, pk:bytes, seed:bytes=None) -> Tuple[bytes, bytes]:
+        if isinstance(pk, PreparedPublicKey):
+            pk.check(self.params)
+            # Only threads share the prepared key; the batched KEM and
+            # other executors get the packed key, which is cheaper to
+            # pickle than the prepared one
+            if self.batch_window is not None or not self.threads:
+                pk = pk.pk
+        elif len(pk) != self.params.KYBER_PUBLICKEYBYTES:
+            raise ValueError("Public key must be KYBER_PUBLICKEYBYTES long")
+        if seed is not None and len(seed) != self.params.KYBER_SYMBYTES:
+            raise ValueError("Seeds must be KYBER_SYMBYTES long")
+        return await self.submit("encaps", (pk, seed))
+
+    async def decaps(self, ct:bytes, sk:bytes) -> bytes:
+        if len(ct) != self.params.KYBER_CIPHERTEXTBYTES:
+            raise ValueError("Ciphertext must be KYBER_CIPHERTEXTBYTES long")
+        if isinstance(sk, PreparedSecretKey):
+            sk.check(self.params)
+            if self.batch_window is not None:
+                raise ValueError("Micro-batching needs packed secret keys")
+        elif len(sk) != self.params.KYBER_SECRETKEYBYTES:
+            raise ValueError("Secret key must be KYBER_SECRETKEYBYTES long")
+        return await self.submit("decaps", (ct, sk))
+
+    # The semaphore of the running event loop; a new loop gets a new one
+    def limit(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            self.semaphore, self.loop = asyncio.Semaphore(self.max_concurrency), loop
+        return self.semaphore
+
+    async def submit(self, op:str, args:tuple):
+        if self.max_pending is not None and self.pending >= self.max_pending:
+            self.rejected += 1
+            raise Overloaded(f"{self.pending} requests are already pending")
+        self.pending += 1
+        start = perf_counter()
+        try:
+            if self.batch_window is None:
+                async with self.limit():
+                    loop = asyncio.get_running_loop()
+                    result = await loop.run_in_executor(self.executor, kem_task, op, self.params.KYBER_K, args)
+            else:
+                result = await self.enqueue(op, args)
+        finally:
+            self.pending -= 1
+        self.latencies[op].append(perf_counter() - start)
+        return result
+
+    # Micro-batching: the first request of a batch starts the timer, the
+    # batch is sent when the timer fires or the batch is full
+    async def enqueue(self, op:str, args:tuple):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self.queues[op]
+        queue.append((args, future))
+        if len(queue) >= self.max_batch:
+            self.flush(op)
+        elif len(queue) == 1:
+            self.timers[op] = loop.call_later(self.batch_window, self.flush, op)
+        return await future
+
+    def flush(self, op:str):
+        timer = self.timers.pop(op, None)
+        if timer is not None:
+            timer.cancel()
+        items, self.queues[op] = self.queues[op], []
+        if items:
+            # keep a reference so the task is not garbage collected
+            task = asyncio.get_running_loop().create_task(self.run_batch(op, items))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, op:str, items:list):
+        p = self.params
+        n = len(items)
+
+        def fill(x:bytes) -> bytes:
+            return urandom(p.KYBER_SYMBYTES) if x is None else bytes(x)
+
+        if op == "keypair":
+            args = (n, b"".join(fill(seed) for (seed, z), f in items), b"".join(fill(z) for (seed, z), f in items))
+        elif op == "encaps":
+            args = (b"".join(bytes(pk) for (pk, seed), f in items), b"".join(fill(seed) for (pk, seed), f in items))
+        else:
+            args = (b"".join(bytes(ct) for (ct, sk), f in items), b"".join(bytes(sk) for (ct, sk), f in items))
+        try:
+            async with self.limit():
+                self.batches += 1
+                loop = asyncio.get_running_loop()
+                results = await loop.run_in_executor(self.executor, batch_task, op, p.KYBER_K, args)
+        except Exception as e:
+            for args, future in items:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        if op == "keypair":
+            pks, sks = results
+            results = [(pks[i*p.KYBER_PUBLICKEYBYTES:(i+1)*p.KYBER_PUBLICKEYBYTES],
+                        sks[i*p.KYBER_SECRETKEYBYTES:(i+1)*p.KYBER_SECRETKEYBYTES]) for i in range(n)]
+        elif op == "encaps":
+            cts, sss = results
+            results = [(cts[i*p.KYBER_CIPHERTEXTBYTES:(i+1)*p.KYBER_CIPHERTEXTBYTES],
+                        sss[i*p.KYBER_SSBYTES:(i+1)*p.KYBER_SSBYTES]) for i in range(n)]
+        else:
+            results = [results[i*p.KYBER_SSBYTES:(i+1)*p.KYBER_SSBYTES] for i in range(n)]
+        for (args, future), result in zip(items, results):
+            if not future.done():
+                future.set_result(result)
+
+    # Latency percentiles in seconds over the recorded requests of op,
+    # or of all operations if op is None (nearest-rank method)
+    def latency_percentiles(self, op:str=None, percentiles:Tuple[float, ...]=(50, 90, 99)) -> dict:
+        ops = [op] if op is not None else list(self.latencies)
+        samples = sorted(x for op in ops for x in self.latencies[op])
+        if not samples:
+            return {}
+        return {q: samples[max(ceil(q/100*len(samples)), 1) - 1] for q in percentiles}
+
+    def stats(self) -> dict:
+        return {"pending": self.pending, "rejected": self.rejected, "batches": self.batches,
+                "completed": {op: len(x) for op, x in self.latencies.items()},
+                "latency": {op: self.latency_percentiles(op) for op in self.latencies}}
+
+
+frontends = {}
+frontends_lock = Lock()
+
+#################################################
+# Name:        default_frontend
+#
+# Description: The AsyncKyber used by async_keypair, async_encaps and
+#              async_decaps for the mode of p, created on first use
+#
+# Arguments:   - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def default_frontend(p:Parameters=g) -> AsyncKyber:
+    with frontends_lock:
+        frontend = frontends.get(p.KYBER_K)
+        if frontend is None:
+            frontend = frontends[p.KYBER_K] = AsyncKyber(p.KYBER_K)
+        return frontend
+
+
+async def async_keypair(key_seed:bytes=None, z:bytes=None, frontend:AsyncKyber=None, p:Parameters=g) -> Tuple[bytes, bytes]:
+    return await (frontend or default_frontend(p)).keypair(key_seed, z)
+
+async def async_encaps(pk:bytes, seed:bytes=None, frontend:AsyncKyber=None, p:Parameters=g) -> Tuple[bytes, bytes]:
+    return await (frontend or default_frontend(p)).encaps(pk, seed)
+
+async def async_decaps(ct:bytes, sk:bytes, frontend:AsyncKyber=None, p:Parameters=g) -> bytes:
+    return await (frontend or default_frontend(p)).decaps(ct, sk)
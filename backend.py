@@ -0,0 +1,558 @@
+# Arithmetic backends.
+#
+# A backend is one implementation of everything indcpa.py does to
+# polynomials: NTT, inverse NTT, basemul, reduction, (de)serialization,
+# compression, CBD sampling and matrix expansion. All backends produce
+# identical keys, ciphertexts and shared secrets:
+#
+#   - "reference": the functions of poly.py and polyvec.py as they are
+#   - "fast":      pure Python, the radix-4 NTT (with twiddle lookup tables
+#                  when enabled, see ntt.py), the mode-specialized
+#                  kernels of kernels.py and the table-driven CBD samplers
+#   - "kronecker": "fast" with products needed in normal domain computed
+#                  by big-integer multiplication (Kronecker substitution)
+#   - "numpy":     "fast" with the NTT, basemul, CBD sampling and matrix
+#                  expansion done as whole-array numpy operations
+#
+# The backend is selected with set_backend or the KYBER_BACKEND environment
+# variable; without either the fastest available backend is used.
+# active_backend returns the name of the selected one.
+
+from kernels import *
+from os import environ
+from threading import Lock
+from functools import lru_cache
+
+
+# Matrix expansion. gen_matrix in indcpa.py caches the result and calls
+# the gen_matrix of the selected backend, which is one of the functions
+# below.
+
+# Only depends on KYBER_N and KYBER_Q, so it is the same for every mode
+GEN_MATRIX_NBLOCKS = ((12*g.KYBER_N//8*(1 << 12)//g.KYBER_Q + XOF_BLOCKBYTES)//XOF_BLOCKBYTES)
+
+
+#################################################
+# Name:        rej_uniform
+#
+# Description: Run rejection sampling on uniform random bytes to generate
+#              uniform random integers mod q
+#
+# Arguments:   - List[int] r: output buffer
+#              - int l: requested number of 16-bit integers (uniform mod q)
+#              - List[int] buf: input buffer (assumed to be uniformly random bytes)
+#              - buflen: length of input buffer in bytes
+#
+# Returns number of sampled 16-bit integers (at most l)
+##################################################
+def rej_uniform(r:List[int], l:int, buf:List[int], buflen:int) -> int:
+    ctr, pos = 0, 0
+    while ctr<l and pos+3<=buflen:
+        val0 = ((buf[pos+0] >> 0) | (buf[pos+1] << 8)) & 0xFFF
+        val1 = ((buf[pos+1] >> 4) | (buf[pos+2] << 4)) & 0xFFF
+        pos += 3
+
+        if val0 < g.KYBER_Q:
+            r[ctr] = val0
+            ctr += 1
+        if ctr<l and val1<g.KYBER_Q:
+            r[ctr] = val1
+            ctr += 1
+    return ctr
+
+
+#################################################
+# Name:        expand_matrix
+#
+# Description: Deterministically generate matrix A (or the transpose of A)
+#              from a seed. Entries of the matrix are polynomials that look
+#              uniformly random. Performs rejection sampling on output of
+#              a XOF
+#
+# Arguments:   - List[polyvec] a: output matrix A
+#              - List[int] seed: input seed
+#              - int transposed: boolean deciding whether A or A^T is generated
+#              - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def expand_matrix(a:List[polyvec], seed:List[int], transposed:int, p:Parameters=g):
+    for i in range(p.KYBER_K):
+        for j in range(p.KYBER_K):
+            state = xof_state()
+            if transposed:
+                xof_absorb(state, seed, i, j)
+            else:
+                xof_absorb(state, seed, j, i)
+
+            buf = xof_squeezeblocks(GEN_MATRIX_NBLOCKS, state)
+            buflen = GEN_MATRIX_NBLOCKS*XOF_BLOCKBYTES
+            ctr = rej_uniform(a[i].vec[j].coeffs, p.KYBER_N, buf, buflen)
+
+            while (ctr < p.KYBER_N):
+                off = buflen % 3
+                for k in range(off):
+                    buf[k] = buf[buflen - off + k]
+                buf = buf[:off] + xof_squeezeblocks(1, state)
+                buflen = off + XOF_BLOCKBYTES
+                # Sample straight into the remaining coefficients
+                ctr += rej_uniform(memoryview(a[i].vec[j].coeffs)[ctr:], p.KYBER_N - ctr, buf, buflen)
+
+
+#################################################
+# Name:        rej_uniform_np
+#
+# Description: Vectorized rej_uniform. Decodes all 12-bit candidates of
+#              each buffer at once, drops the ones >= q and keeps the
+#              first l in order, matching rej_uniform.
+#
+# Arguments:   - ndarray buf: uint8 array of shape (M, buflen) with
+#                             buflen a multiple of 3
+#              - int l: requested number of integers per row
+#
+# Returns an (M, l) array of sampled integers and an (M,) array holding
+# how many candidates of each row were accepted (rows with fewer than l
+# have to be refilled by the caller).
+##################################################
+def rej_uniform_np(buf, l:int):
+    b = buf.reshape(buf.shape[0], -1, 3).astype(np.int64)
+    val = np.empty(b.shape[:2] + (2,), dtype=np.int64)
+    val[..., 0] = ((b[..., 0] >> 0) | (b[..., 1] << 8)) & 0xFFF
+    val[..., 1] = ((b[..., 1] >> 4) | (b[..., 2] << 4)) & 0xFFF
+    val = val.reshape(buf.shape[0], -1)
+
+    accept = val < g.KYBER_Q
+    # Stable sort moves accepted candidates to the front, keeping their order
+    order = np.argsort(~accept, axis=1, kind="stable")[:, :l]
+    return np.take_along_axis(val, order, axis=1), accept.sum(axis=1)
+
+
+#################################################
+# Name:        gen_matrix_array
+#
+# Description: expand_matrix using rej_uniform_np for the matrices of
+#              several seeds. The XOF output of all K*K entries of all
+#              matrices is sampled in one call; an entry is only
+#              refilled when it genuinely has fewer than n candidates.
+#              Since XOF_BLOCKBYTES is a multiple of 3 no bytes are carried
+#              over between blocks, so appending whole blocks gives the
+#              same integers as the reference refill loop.
+#
+# Arguments:   - List[List[int]] seeds: input seeds
+#              - int transposed: boolean deciding whether A or A^T is generated
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns int64 array of shape (len(seeds), K, K, N)
+##################################################
+def gen_matrix_array(seeds:List[List[int]], transposed:int, p:Parameters=g):
+    buflen = GEN_MATRIX_NBLOCKS*XOF_BLOCKBYTES
+    states = []
+    for seed in seeds:
+        for i in range(p.KYBER_K):
+            for j in range(p.KYBER_K):
+                state = xof_state()
+                if transposed:
+                    xof_absorb(state, seed, i, j)
+                else:
+                    xof_absorb(state, seed, j, i)
+                states.append(state)
+
+    buf = np.frombuffer(b"".join(state.read(buflen) for state in states), dtype=np.uint8)
+    vals, ctr = rej_uniform_np(buf.reshape(len(states), buflen), p.KYBER_N)
+
+    for k in np.flatnonzero(ctr < p.KYBER_N):
+        extra = buf[k*buflen:(k+1)*buflen].tobytes()
+        while True:
+            extra += states[k].read(XOF_BLOCKBYTES)
+            row, n = rej_uniform_np(np.frombuffer(extra, dtype=np.uint8).reshape(1, -1), p.KYBER_N)
+            if n[0] >= p.KYBER_N:
+                vals[k] = row[0]
+                break
+
+    return vals.reshape(len(seeds), p.KYBER_K, p.KYBER_K, p.KYBER_N)
+
+
+#################################################
+# Name:        gen_matrix_np
+#
+# Description: expand_matrix using gen_matrix_array
+#
+# Arguments:   - List[polyvec] a: output matrix A
+#              - List[int] seed: input seed
+#              - int transposed: boolean deciding whether A or A^T is generated
+#              - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def gen_matrix_np(a:List[polyvec], seed:List[int], transposed:int, p:Parameters=g):
+    vals = gen_matrix_array([seed], transposed, p)[0]
+    for i in range(p.KYBER_K):
+        np.frombuffer(a[i].coeffs, dtype=np.int32)[:] = vals[i].reshape(-1)
+
+
+#################################################
+# Name:        Backend
+#
+# Description: The operations of one backend for one mode. Batched
+#              operations take a list of polys, serialization and
+#              compression take an offset into the byte array. ntt and
+#              matrix_mul skip the reduction after the NTT if reduce is
+#              False (see LazyReduction in indcpa.py).
+#
+# Arguments:   - str name: name of the backend
+#              - Parameters p: parameters of the mode
+##################################################
+class Backend:
+    def __init__(self, name:str, p:Parameters):
+        self.name = name
+        self.mode = p.KYBER_K
+
+    def __repr__(self) -> str:
+        return f"Backend({self.name!r}, mode={self.mode})"
+
+    # r = A*b for A in NTT domain and b, r in normal domain; b is
+    # transformed in place, and only reduced after the NTT if reduce is set
+    def matrix_mul(self, r:List[poly], a:List[polyvec], b:polyvec, reduce:bool=True):
+        self.ntt(b.vec, reduce)
+        self.matrix_basemul(r, a, b)
+        self.invntt(r)
+
+    # The operand of matrix_mul for a matrix a in the form the backend
+    # multiplies with, converted without any shared cache so that it is
+    # safe for secret key material such as the s of indcpa_dec. The
+    # result is passed to matrix_mul in place of a and may be kept by the
+    # owner of the key (see PreparedPublicKey and PreparedSecretKey)
+    def matrix_operand(self, a:List[polyvec]):
+        return a
+
+    # Bound on the coefficients of r = matrix_mul(r, a, b, False) with K
+    # columns, for coefficients of a at most A and of b at most B
+    def matrix_mul_bound(self, A:int, B:int, K:int) -> int:
+        return invntt_bound(barrett_bound(K*basemul_bound(A, ntt_bound(B))))
+
+
+#################################################
+# Name:        reference_backend
+#
+# Description: Builds the reference backend for a mode
+#
+# Arguments:   - Parameters p: parameters of the mode
+##################################################
+def reference_backend(p:Parameters) -> Backend:
+    be = Backend("reference", p)
+
+    def ref_ntt(r:List[poly], reduce:bool=True):
+        for a in r:
+            ntt(a.coeffs)
+            if reduce:
+                poly_reduce(a)
+
+    def ref_invntt(r:List[poly]):
+        for a in r:
+            invntt(a.coeffs)
+
+    def ref_matrix_basemul(r:List[poly], a:List[polyvec], b:polyvec):
+        for i in range(len(a)):
+            polyvec_basemul_acc_montgomery(r[i], a[i], b, p)
+
+    def ref_polyvec_reduce(r:polyvec):
+        polyvec_reduce(r, p)
+
+    def ref_gen_matrix(a:List[polyvec], seed:List[int], transposed:int):
+        expand_matrix(a, seed, transposed, p)
+
+    def ref_getnoise(r:List[poly], seed:List[int], nonce:int, eta:int):
+        cbd = cbd2 if eta == 2 else cbd3
+        for i in range(len(r)):
+            buf = [0]*(eta*p.KYBER_N//4)
+            prf(buf, len(buf), seed, nonce+i)
+            cbd(r[i], buf)
+
+    def ref_polyvec_tobytes(r:List[int], a:polyvec, off:int=0):
+        temp = [0]*p.KYBER_POLYVECBYTES
+        polyvec_tobytes(temp, a, p)
+        r[off:off+p.KYBER_POLYVECBYTES] = temp
+
+    def ref_polyvec_frombytes(r:polyvec, a:List[int], off:int=0):
+        polyvec_frombytes(r, a[off:off+p.KYBER_POLYVECBYTES], p)
+
+    def ref_polyvec_compress(r:List[int], a:polyvec, off:int=0):
+        temp = [0]*p.KYBER_POLYVECCOMPRESSEDBYTES
+        polyvec_compress(temp, a, p)
+        r[off:off+p.KYBER_POLYVECCOMPRESSEDBYTES] = temp
+
+    def ref_polyvec_decompress(r:polyvec, a:List[int], off:int=0):
+        polyvec_decompress(r, a[off:off+p.KYBER_POLYVECCOMPRESSEDBYTES], p)
+
+    def ref_poly_compress(r:List[int], a:poly, off:int=0):
+        temp = [0]*p.KYBER_POLYCOMPRESSEDBYTES
+        poly_compress(temp, a, p)
+        r[off:off+p.KYBER_POLYCOMPRESSEDBYTES] = temp
+
+    def ref_poly_decompress(r:poly, a:List[int], off:int=0):
+        poly_decompress(r, a[off:off+p.KYBER_POLYCOMPRESSEDBYTES], p)
+
+    be.ntt, be.invntt = ref_ntt, ref_invntt
+    be.matrix_basemul = ref_matrix_basemul
+    be.poly_reduce, be.polyvec_reduce, be.poly_tomont = poly_reduce, ref_polyvec_reduce, poly_tomont
+    be.getnoise = ref_getnoise
+    be.gen_matrix = ref_gen_matrix
+    be.polyvec_tobytes, be.polyvec_frombytes = ref_polyvec_tobytes, ref_polyvec_frombytes
+    be.polyvec_compress, be.polyvec_decompress = ref_polyvec_compress, ref_polyvec_decompress
+    be.poly_compress, be.poly_decompress = ref_poly_compress, ref_poly_decompress
+    be.poly_frommsg, be.poly_tomsg = poly_frommsg, poly_tomsg
+    return be
+
+
+#################################################
+# Name:        fast_backend
+#
+# Description: Builds the pure Python backend for a mode
+#
+# Arguments:   - Parameters p: parameters of the mode
+##################################################
+def fast_backend(p:Parameters) -> Backend:
+    be = reference_backend(p)
+    be.name = "fast"
+    kernels = get_kernels(p)
+
+    def fast_getnoise(r:List[poly], seed:List[int], nonce:int, eta:int):
+        buflen = eta*p.KYBER_N//4
+        buf = prf_batch(buflen, seed, range(nonce, nonce+len(r)))
+        cbd = cbd2_table if eta == 2 else cbd3_table
+        for i in range(len(r)):
+            cbd(r[i], buf[i*buflen:(i+1)*buflen])
+
+    def fast_ntt(r:List[poly], reduce:bool=True):
+        for a in r:
+            c = a.coeffs.tolist()
+            ntt_lut(c)
+            a.coeffs[:] = array("i", c)
+            if reduce:
+                kernels.poly_reduce(a)
+
+    def fast_invntt(r:List[poly]):
+        for a in r:
+            c = a.coeffs.tolist()
+            invntt_lut(c)
+            a.coeffs[:] = array("i", c)
+
+    be.ntt, be.invntt = fast_ntt, fast_invntt
+    be.poly_reduce, be.polyvec_reduce, be.poly_tomont = kernels.poly_reduce, kernels.polyvec_reduce, kernels.poly_tomont
+    be.getnoise = fast_getnoise
+    be.polyvec_tobytes, be.polyvec_frombytes = kernels.polyvec_tobytes, kernels.polyvec_frombytes
+    be.polyvec_compress, be.polyvec_decompress = kernels.polyvec_compress, kernels.polyvec_decompress
+    be.poly_compress, be.poly_decompress = kernels.poly_compress, kernels.poly_decompress
+    be.poly_frommsg, be.poly_tomsg = kernels.poly_frommsg, kernels.poly_tomsg
+    return be
+
+
+#################################################
+# Name:        kronecker_operand
+#
+# Description: Transform a polynomial from NTT domain to normal domain and
+#              pack it for polyvec_matrix_mul_kronecker
+#
+# Arguments:   - array coeffs: coefficients in NTT domain
+#
+# Returns the packed int
+##################################################
+def kronecker_operand(coeffs:array) -> int:
+    a = coeffs.tolist()
+    # invntt multiplies by 2^16, montgomery_reduce divides it out again
+    invntt_lut(a)
+    return poly_to_kronecker(poly([montgomery_reduce(x) for x in a]))
+
+
+# Matrix and public-key polynomials recur across calls (the matrix cache,
+# a server's static keys), so their normal domain packed form is cached
+# by coefficient bytes. Secret key polynomials never go through this
+# cache, see Backend.matrix_operand.
+KRONECKER_CACHE_SIZE = 64
+
+@lru_cache(maxsize=KRONECKER_CACHE_SIZE)
+def public_kronecker_operand(coeffs:bytes) -> int:
+    a = array("i")
+    a.frombytes(coeffs)
+    return kronecker_operand(a)
+
+
+#################################################
+# Name:        kronecker_backend
+#
+# Description: Builds the pure Python backend for a mode that multiplies
+#              by Kronecker substitution instead of NTT and basemul
+#              wherever the product is needed in normal domain
+#
+# Arguments:   - Parameters p: parameters of the mode
+##################################################
+def kronecker_backend(p:Parameters) -> Backend:
+    be = fast_backend(p)
+    be.name = "kronecker"
+
+    # a is a matrix of public polynomials or the result of matrix_operand
+    def kronecker_matrix_mul(r:List[poly], a:List[polyvec], b:polyvec, reduce:bool=True):
+        if isinstance(a[0], polyvec):
+            a = [[public_kronecker_operand(bytes(x.coeffs)) for x in row.vec] for row in a]
+        polyvec_matrix_mul_kronecker(r, a, b, p)
+
+    def kronecker_matrix_operand(a:List[polyvec]) -> List[List[int]]:
+        return [[kronecker_operand(x.coeffs) for x in row.vec] for row in a]
+
+    # The products come out as centered representatives
+    def kronecker_matrix_mul_bound(A:int, B:int, K:int) -> int:
+        return p.KYBER_Q//2
+
+    be.matrix_mul, be.matrix_mul_bound = kronecker_matrix_mul, kronecker_matrix_mul_bound
+    be.matrix_operand = kronecker_matrix_operand
+    return be
+
+
+#################################################
+# Name:        numpy_backend
+#
+# Description: Builds the numpy backend for a mode
+#
+# Arguments:   - Parameters p: parameters of the mode
+##################################################
+def numpy_backend(p:Parameters) -> Backend:
+    if np is None:
+        raise ImportError("The numpy backend requires numpy to be installed")
+    be = fast_backend(p)
+    be.name = "numpy"
+
+    def np_ntt(r:List[poly], reduce:bool=True):
+        a = poly_to_array(r)
+        ntt_array(a)
+        poly_from_array(r, barrett_reduce_np(a) if reduce else a)
+
+    def np_invntt(r:List[poly]):
+        a = poly_to_array(r)
+        invntt_array(a)
+        poly_from_array(r, a)
+
+    def np_matrix_basemul(r:List[poly], a:List[polyvec], b:polyvec):
+        polyvec_matrix_basemul_acc_np(r, a, b, p)
+
+    def np_matrix_operand(a:List[polyvec]):
+        return polyvec_matrix_to_array(a, p)
+
+    def np_gen_matrix(a:List[polyvec], seed:List[int], transposed:int):
+        gen_matrix_np(a, seed, transposed, p)
+
+    def np_getnoise(r:List[poly], seed:List[int], nonce:int, eta:int):
+        poly_from_array(r, poly_getnoise_array(seed, nonce, len(r), eta))
+
+    def np_polyvec_tobytes(r:List[int], a:polyvec, off:int=0):
+        polyvec_tobytes_np(r, a, off, p)
+
+    def np_polyvec_frombytes(r:polyvec, a:List[int], off:int=0):
+        polyvec_frombytes_np(r, a, off, p)
+
+    be.ntt, be.invntt = np_ntt, np_invntt
+    be.matrix_basemul, be.matrix_operand = np_matrix_basemul, np_matrix_operand
+    be.getnoise = np_getnoise
+    be.gen_matrix = np_gen_matrix
+    be.polyvec_tobytes, be.polyvec_frombytes = np_polyvec_tobytes, np_polyvec_frombytes
+    N = p.KYBER_K*p.KYBER_N
+    be.polyvec_compress, be.polyvec_decompress = make_codec_np(p, 8*p.KYBER_POLYVECCOMPRESSEDBYTES//N, N)
+    be.poly_compress, be.poly_decompress = make_codec_np(p, 8*p.KYBER_POLYCOMPRESSEDBYTES//p.KYBER_N, p.KYBER_N)
+    msg_compress, msg_decompress = make_codec_np(p, 1, p.KYBER_N)
+
+    def np_poly_frommsg(r:poly, msg:List[int]):
+        msg_decompress(r, msg)
+
+    def np_poly_tomsg(msg:List[int], a:poly):
+        msg_compress(msg, a)
+
+    be.poly_frommsg, be.poly_tomsg = np_poly_frommsg, np_poly_tomsg
+    return be
+
+
+#################################################
+# Name:        BackendRegistry
+#
+# Description: Maps backend names to factories and holds the selected
+#              backend. Backends are built per mode on first use.
+#
+# Arguments:   - str name: initially selected backend; None selects the
+#                          fastest available one
+##################################################
+class BackendRegistry:
+    def __init__(self, name:str=None):
+        self.lock = Lock()
+        self.factories = {}
+        self.backends = {}
+        self.name = None
+        self.register("reference", reference_backend)
+        self.register("fast", fast_backend)
+        self.register("kronecker", kronecker_backend)
+        self.register("numpy", numpy_backend, np is not None)
+        self.set_backend(name)
+
+    def register(self, name:str, factory, available:bool=True):
+        with self.lock:
+            self.factories[name] = (factory, available)
+            self.backends = {key: be for key, be in self.backends.items() if key[0] != name}
+
+    def available(self) -> List[str]:
+        return [name for name, (factory, available) in self.factories.items() if available]
+
+    def set_backend(self, name:str=None):
+        if name is None:
+            name = "numpy" if "numpy" in self.available() else "kronecker"
+        if name not in self.factories:
+            raise ValueError(f"Unknown backend {name!r}, must be one of {sorted(self.factories)}")
+        if name not in self.available():
+            raise ImportError(f"Backend {name!r} is not available on this host")
+        self.name = name
+
+    def get(self, p:Parameters=g) -> Backend:
+        key = (self.name, p.KYBER_K)
+        be = self.backends.get(key)
+        if be is None:
+            with self.lock:
+                be = self.backends.get(key)
+                if be is None:
+                    # Build from the frozen parameters, g may change mode later
+                    be = self.backends[key] = self.factories[self.name][0](get_params(p.KYBER_K))
+        return be
+
+backends = BackendRegistry(environ.get("KYBER_BACKEND") or None)
+
+
+#################################################
+# Name:        set_backend
+#
+# Description: Selects the backend used by indcpa.py
+#
+# Arguments:   - str name: "reference", "fast", "numpy" or a registered
+#                          name; None selects the fastest available one
+##################################################
+def set_backend(name:str=None):
+    backends.set_backend(name)
+
+
+#################################################
+# Name:        get_backend
+#
+# Description: Returns the selected backend for the mode of p
+#
+# Arguments:   - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def get_backend(p:Parameters=g) -> Backend:
+    return backends.get(p)
+
+
+#################################################
+# Name:        available_backends
+#
+# Description: Returns the names of the backends usable on this host
+##################################################
+def available_backends() -> List[str]:
+    return backends.available()
+
+
+#################################################
+# Name:        active_backend
+#
+# Description: Returns the name of the selected backend
+##################################################
+def active_backend() -> str:
+    return backends.name
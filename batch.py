@@ -0,0 +1,319 @@
+# Batched KEM.
+#
+# crypto_kem_keypair_batch, crypto_kem_enc_batch and crypto_kem_dec_batch
+# run N operations of one mode in a single call. Apart from the hashing,
+# which is done per item, every step works on arrays of shape (N, K, 256):
+# the matrix expansion, CBD sampling, NTTs, basemuls, (de)serialization
+# and compression of all N items are each one numpy operation. Inputs
+# and outputs are contiguous buffers of N fixed-size records, e.g. the
+# ciphertext of item i is cts[i*KYBER_CIPHERTEXTBYTES:(i+1)*KYBER_CIPHERTEXTBYTES].
+# The results are the same as N calls of crypto_kem_keypair,
+# crypto_kem_enc and crypto_kem_dec with the same randomness. An empty
+# batch gives empty outputs.
+#
+# The batched KEM requires numpy.
+
+from kem import *
+
+
+#################################################
+# Name:        records
+#
+# Description: View of n records of size bytes as a uint8 array of
+#              shape (n, size); raises ValueError on a length mismatch
+#
+# Arguments:   - bytes a: contiguous records, or a list of records
+#              - int size: size of a record
+#              - str name: name of the records for the error message
+#              - int n: number of records, derived from a if None
+##################################################
+def records(a:bytes, size:int, name:str, n:int=None):
+    if isinstance(a, (list, tuple)):
+        a = b"".join(bytes(x) for x in a)
+    if n is None:
+        n = len(a)//size
+    if len(a) != n*size:
+        raise ValueError(f"{name} must be {n} records of {size} bytes")
+    return np.frombuffer(a, dtype=np.uint8).reshape(n, size)
+
+
+#################################################
+# Name:        getnoise_batch
+#
+# Description: Sample count polynomials with consecutive nonces starting
+#              at nonce from each of the seeds, as poly_getnoise_eta1/eta2
+#
+# Arguments:   - List[bytes] seeds: input seeds
+#              - int nonce: first one-byte nonce
+#              - int count: number of polynomials per seed
+#              - int eta: parameter of the binomial distribution (2 or 3)
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns int64 array of shape (len(seeds), count, N)
+##################################################
+def getnoise_batch(seeds:List[bytes], nonce:int, count:int, eta:int, p:Parameters=g):
+    buflen = eta*p.KYBER_N//4
+    buf = b"".join([prf_batch(buflen, seed, range(nonce, nonce+count)) for seed in seeds])
+    buf = np.frombuffer(buf, dtype=np.uint8).reshape(len(seeds)*count, buflen)
+    return cbd_np(buf, eta).reshape(len(seeds), count, p.KYBER_N)
+
+
+#################################################
+# Name:        matrix_basemul_batch
+#
+# Description: Row-wise basemul of matrices with vectors in NTT domain,
+#              as polyvec_matrix_basemul_acc_np for each item
+#
+# Arguments:   - ndarray a: matrices of shape (N, R, K, 256) (N may be 1)
+#              - ndarray b: vectors of shape (N, K, 256)
+#
+# Returns int64 array of shape (N, R, 256)
+##################################################
+def matrix_basemul_batch(a, b):
+    return barrett_reduce_np(basemul_array(a, b[:, None]).sum(axis=2))
+
+
+#################################################
+# Name:        ntt_batch
+#
+# Description: ntt_array with reduction on polynomials
+#
+# Arguments:   - ndarray a: polynomials of shape (..., 256)
+#
+# Returns int64 array of the shape of a
+##################################################
+def ntt_batch(a):
+    shape = a.shape
+    a = np.ascontiguousarray(a, dtype=np.int64).reshape(-1, 256)
+    ntt_array(a)
+    return barrett_reduce_np(a).reshape(shape)
+
+
+#################################################
+# Name:        invntt_batch
+#
+# Description: invntt_array on polynomials
+#
+# Arguments:   - ndarray a: polynomials of shape (..., 256)
+#
+# Returns int64 array of the shape of a
+##################################################
+def invntt_batch(a):
+    shape = a.shape
+    a = np.ascontiguousarray(a, dtype=np.int64).reshape(-1, 256)
+    invntt_array(a)
+    return a.reshape(shape)
+
+
+#################################################
+# Name:        indcpa_keypair_batch
+#
+# Description: indcpa_keypair for each of the seeds
+#
+# Arguments:   - List[bytes] seeds: input randomness, KYBER_SYMBYTES each
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns (pk, sk) uint8 arrays of shape (N, KYBER_INDCPA_PUBLICKEYBYTES)
+# and (N, KYBER_INDCPA_SECRETKEYBYTES)
+##################################################
+def indcpa_keypair_batch(seeds:List[bytes], p:Parameters=g):
+    K = p.KYBER_K
+    bufs = [hash_g(bytes(seed)) for seed in seeds]
+    publicseeds = [buf[:p.KYBER_SYMBYTES] for buf in bufs]
+
+    a = gen_matrix_array(publicseeds, 0, p)
+    noise = ntt_batch(getnoise_batch([buf[p.KYBER_SYMBYTES:] for buf in bufs], 0, 2*K, p.KYBER_ETA1, p))
+    skpv, e = noise[:, :K], noise[:, K:]
+
+    # tomont, add e and reduce
+    pkpv = montgomery_reduce_np(matrix_basemul_batch(a, skpv)*((1 << 32) % p.KYBER_Q))
+    pkpv = barrett_reduce_np(pkpv + e)
+
+    sk = polyvec_tobytes_array(skpv.reshape(len(seeds), -1), p)
+    pk = np.empty((len(seeds), p.KYBER_INDCPA_PUBLICKEYBYTES), dtype=np.uint8)
+    pk[:, :p.KYBER_POLYVECBYTES] = polyvec_tobytes_array(pkpv.reshape(len(seeds), -1), p)
+    pk[:, p.KYBER_POLYVECBYTES:] = np.frombuffer(b"".join(publicseeds), dtype=np.uint8).reshape(len(seeds), -1)
+    return pk, sk
+
+
+#################################################
+# Name:        indcpa_enc_batch
+#
+# Description: indcpa_enc for each message, public key and coins. The
+#              matrix of a public key that occurs several times in pks
+#              is only expanded once.
+#
+# Arguments:   - ndarray m: uint8 array of shape (N, KYBER_INDCPA_MSGBYTES)
+#              - ndarray pks: uint8 array of shape (N, KYBER_INDCPA_PUBLICKEYBYTES)
+#              - List[bytes] coins: KYBER_SYMBYTES of randomness per item
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns uint8 array of shape (N, KYBER_INDCPA_BYTES)
+##################################################
+def indcpa_enc_batch(m, pks, coins:List[bytes], p:Parameters=g):
+    K, n = p.KYBER_K, len(m)
+    pkpv = polyvec_frombytes_array(pks[:, :p.KYBER_POLYVECBYTES]).reshape(n, 1, K, p.KYBER_N)
+    seeds, index = np.unique(pks[:, p.KYBER_POLYVECBYTES:], axis=0, return_inverse=True)
+    at = gen_matrix_array([seed.tobytes() for seed in seeds], 1, p)[index.reshape(-1)]
+    k = decompress_array(m, 1, p)
+
+    sp = ntt_batch(getnoise_batch(coins, 0, K, p.KYBER_ETA1, p))
+    noise = getnoise_batch(coins, K, K+1, p.KYBER_ETA2, p)
+
+    # b = A^T*sp and v = pk*sp in one matrix-vector product
+    rows = invntt_batch(matrix_basemul_batch(np.concatenate((at, pkpv), axis=1), sp))
+    rows = rows + noise
+    rows[:, K] += k
+    rows = barrett_reduce_np(rows)
+
+    c = np.empty((n, p.KYBER_INDCPA_BYTES), dtype=np.uint8)
+    du = 8*p.KYBER_POLYVECCOMPRESSEDBYTES//(K*p.KYBER_N)
+    dv = 8*p.KYBER_POLYCOMPRESSEDBYTES//p.KYBER_N
+    c[:, :p.KYBER_POLYVECCOMPRESSEDBYTES] = compress_array(rows[:, :K].reshape(n, -1), du, p)
+    c[:, p.KYBER_POLYVECCOMPRESSEDBYTES:] = compress_array(rows[:, K], dv, p)
+    return c
+
+
+#################################################
+# Name:        indcpa_dec_batch
+#
+# Description: indcpa_dec for each ciphertext
+#
+# Arguments:   - ndarray c: uint8 array of shape (N, KYBER_INDCPA_BYTES)
+#              - ndarray sks: uint8 array of shape (N, KYBER_INDCPA_SECRETKEYBYTES),
+#                or (1, KYBER_INDCPA_SECRETKEYBYTES) to use one key for all
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns uint8 array of shape (N, KYBER_INDCPA_MSGBYTES)
+##################################################
+def indcpa_dec_batch(c, sks, p:Parameters=g):
+    K, n = p.KYBER_K, len(c)
+    du = 8*p.KYBER_POLYVECCOMPRESSEDBYTES//(K*p.KYBER_N)
+    dv = 8*p.KYBER_POLYCOMPRESSEDBYTES//p.KYBER_N
+    b = decompress_array(c[:, :p.KYBER_POLYVECCOMPRESSEDBYTES], du, p).reshape(n, K, p.KYBER_N)
+    v = decompress_array(c[:, p.KYBER_POLYVECCOMPRESSEDBYTES:], dv, p)
+    skpv = polyvec_frombytes_array(sks[:, :p.KYBER_POLYVECBYTES]).reshape(len(sks), 1, K, p.KYBER_N)
+
+    mp = invntt_batch(matrix_basemul_batch(skpv, ntt_batch(b)))[:, 0]
+    return compress_array(barrett_reduce_np(v - mp), 1, p)
+
+
+#################################################
+# Name:        crypto_kem_keypair_batch
+#
+# Description: Generates n key pairs, as crypto_kem_keypair
+#
+# Arguments:   - int n: number of key pairs
+#              - bytes key_seeds: optional n seeds for indcpa_keypair
+#                (n records of KYBER_SYMBYTES)
+#              - bytes zs: optional n values for pseudo-random output on
+#                reject (n records of KYBER_SYMBYTES)
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns (pks, sks): n public keys of KYBER_PUBLICKEYBYTES and n secret
+# keys of KYBER_SECRETKEYBYTES, each as one contiguous bytes object
+##################################################
+def crypto_kem_keypair_batch(n:int, key_seeds:bytes=None, zs:bytes=None, p:Parameters=g) -> Tuple[bytes, bytes]:
+    if np is None:
+        raise ImportError("The batched KEM requires numpy to be installed")
+    if n < 0:
+        raise ValueError("n must not be negative")
+    if key_seeds is None:
+        key_seeds = urandom(n*p.KYBER_SYMBYTES)
+    if zs is None:
+        zs = urandom(n*p.KYBER_SYMBYTES)
+    key_seeds = records(key_seeds, p.KYBER_SYMBYTES, "key_seeds", n)
+    zs = records(zs, p.KYBER_SYMBYTES, "zs", n)
+    if n == 0:
+        return b"", b""
+
+    pk, indcpa_sk = indcpa_keypair_batch([seed.tobytes() for seed in key_seeds], p)
+    sk = np.empty((n, p.KYBER_SECRETKEYBYTES), dtype=np.uint8)
+    sk[:, :p.KYBER_INDCPA_SECRETKEYBYTES] = indcpa_sk
+    sk[:, p.KYBER_INDCPA_SECRETKEYBYTES:-2*p.KYBER_SYMBYTES] = pk
+    sk[:, -2*p.KYBER_SYMBYTES:-p.KYBER_SYMBYTES] = np.frombuffer(
+        b"".join([hash_h(x.tobytes()) for x in pk]), dtype=np.uint8).reshape(n, -1)
+    sk[:, -p.KYBER_SYMBYTES:] = zs
+    return pk.tobytes(), sk.tobytes()
+
+
+#################################################
+# Name:        crypto_kem_enc_batch
+#
+# Description: Generates a cipher text and shared secret for each public
+#              key, as crypto_kem_enc
+#
+# Arguments:   - bytes pks: n public keys (n records of KYBER_PUBLICKEYBYTES)
+#              - bytes seeds: optional randomness
+#                (n records of KYBER_SYMBYTES)
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns (cts, sss): n cipher texts of KYBER_CIPHERTEXTBYTES and n shared
+# secrets of KYBER_SSBYTES, each as one contiguous bytes object
+##################################################
+def crypto_kem_enc_batch(pks:bytes, seeds:bytes=None, p:Parameters=g) -> Tuple[bytes, bytes]:
+    if np is None:
+        raise ImportError("The batched KEM requires numpy to be installed")
+    pks = records(pks, p.KYBER_PUBLICKEYBYTES, "pks")
+    n = len(pks)
+    if seeds is None:
+        seeds = urandom(n*p.KYBER_SYMBYTES)
+    seeds = records(seeds, p.KYBER_SYMBYTES, "seeds", n)
+    if n == 0:
+        return b"", b""
+
+    # Don't release system RNG output
+    # Multitarget countermeasure for coins + contributory KEM
+    bufs = [hash_h(seed.tobytes()) + hash_h(pk.tobytes()) for seed, pk in zip(seeds, pks)]
+    krs = [hash_g(buf) for buf in bufs]
+
+    m = np.frombuffer(b"".join([buf[:p.KYBER_SYMBYTES] for buf in bufs]), dtype=np.uint8).reshape(n, -1)
+    ct = indcpa_enc_batch(m, pks, [kr[p.KYBER_SYMBYTES:] for kr in krs], p)
+
+    # hash concatenation of pre-k and H(c) to k
+    ss = b"".join([kdf(kr[:p.KYBER_SYMBYTES] + hash_h(c.tobytes()), p.KYBER_SSBYTES) for kr, c in zip(krs, ct)])
+    return ct.tobytes(), ss
+
+
+#################################################
+# Name:        crypto_kem_dec_batch
+#
+# Description: Generates the shared secret for each cipher text, as
+#              crypto_kem_dec
+#
+# Arguments:   - bytes cts: n cipher texts (n records of KYBER_CIPHERTEXTBYTES)
+#              - bytes sks: n secret keys (n records of KYBER_SECRETKEYBYTES),
+#                or one secret key used for all cipher texts
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns the n shared secrets of KYBER_SSBYTES as one contiguous bytes
+# object. The shared secret of a rejected cipher text is pseudo-random.
+##################################################
+def crypto_kem_dec_batch(cts:bytes, sks:bytes, p:Parameters=g) -> bytes:
+    if np is None:
+        raise ImportError("The batched KEM requires numpy to be installed")
+    cts = records(cts, p.KYBER_CIPHERTEXTBYTES, "cts")
+    n = len(cts)
+    sks = records(sks, p.KYBER_SECRETKEYBYTES, "sks", 1 if len(sks) == p.KYBER_SECRETKEYBYTES else n)
+    if n == 0:
+        return b""
+    pks = sks[:, p.KYBER_INDCPA_SECRETKEYBYTES:-2*p.KYBER_SYMBYTES]
+    hpks = [x.tobytes() for x in sks[:, -2*p.KYBER_SYMBYTES:-p.KYBER_SYMBYTES]]
+    zs = [x.tobytes() for x in sks[:, -p.KYBER_SYMBYTES:]]
+    if len(sks) == 1:
+        pks = np.broadcast_to(pks, (n, pks.shape[1]))
+        hpks, zs = hpks*n, zs*n
+
+    m = indcpa_dec_batch(cts, sks, p)
+
+    # Multitarget countermeasure for coins + contributory KEM
+    krs = [hash_g(x.tobytes() + hpk) for x, hpk in zip(m, hpks)]
+
+    # coins are in kr[KYBER_SYMBYTES:]
+    cmp = indcpa_enc_batch(m, pks, [kr[p.KYBER_SYMBYTES:] for kr in krs], p)
+    fail = (cmp != cts).any(axis=1)
+
+    # Overwrite pre-k with z on re-encryption failure and
+    # hash concatenation of pre-k and H(c) to k
+    return b"".join([kdf((z if f else kr[:p.KYBER_SYMBYTES]) + hash_h(c.tobytes()), p.KYBER_SSBYTES)
+                     for kr, z, f, c in zip(krs, zs, fail, cts)])
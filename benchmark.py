@@ -1,21 +1,69 @@
-from kem import *
+from batch import *
 from timeit import timeit
-from time import sleep
+from time import sleep, perf_counter
+from os import cpu_count
+from pool import *
 
-for mode in [2, 3, 4]:
-    g.set_mode(mode)
-    print(f"Kyber {mode}")
+def benchmark_single():
+    for mode in [2, 3, 4]:
+        g.set_mode(mode)
+        print(f"Kyber {mode}")
 
-    t = timeit("sleep(0.01)", globals=globals(), number = 1000)
-    print(f"Test: {round(t, 3)}s")
+        t = timeit("sleep(0.01)", globals=globals(), number = 1000)
+        print(f"Test: {round(t, 3)}s")
 
-    t = timeit("crypto_kem_keypair(pk, sk)", setup="pk, sk= [0]*g.KYBER_PUBLICKEYBYTES, [0]*g.KYBER_SECRETKEYBYTES", globals=globals(), number=1000)
-    print(f"key generation: {round(t, 3)}s")
+        t = timeit("crypto_kem_keypair(pk, sk)", setup="pk, sk= [0]*g.KYBER_PUBLICKEYBYTES, [0]*g.KYBER_SECRETKEYBYTES", globals=globals(), number=1000)
+        print(f"key generation: {round(t, 3)}s")
 
-    stp = """pk, sk= [0]*g.KYBER_PUBLICKEYBYTES, [0]*g.KYBER_SECRETKEYBYTES;crypto_kem_keypair(pk, sk);ss = [0]*g.KYBER_SSBYTES;ct = [0]*g.KYBER_CIPHERTEXTBYTES"""
-    t = timeit("crypto_kem_enc(ct, ss, pk)", setup = stp, globals=globals(), number=1000)
-    print(f"Encapsulation: {round(t, 3)}s")
+        stp = """pk, sk= [0]*g.KYBER_PUBLICKEYBYTES, [0]*g.KYBER_SECRETKEYBYTES;crypto_kem_keypair(pk, sk);ss = [0]*g.KYBER_SSBYTES;ct = [0]*g.KYBER_CIPHERTEXTBYTES"""
+        t = timeit("crypto_kem_enc(ct, ss, pk)", setup = stp, globals=globals(), number=1000)
+        print(f"Encapsulation: {round(t, 3)}s")
 
-    stp  = """pk, sk= [0]*g.KYBER_PUBLICKEYBYTES, [0]*g.KYBER_SECRETKEYBYTES;crypto_kem_keypair(pk, sk);ss = [0]*g.KYBER_SSBYTES;ct = [0]*g.KYBER_CIPHERTEXTBYTES;crypto_kem_enc(ct, ss, pk); ssp=[0]*g.KYBER_SSBYTES"""
-    t = timeit("crypto_kem_dec(ssp, ct, sk)", setup=stp, globals=globals(), number=1000)
-    print(f"Decapsulation: {round(t, 3)}s\n")
+        stp  = """pk, sk= [0]*g.KYBER_PUBLICKEYBYTES, [0]*g.KYBER_SECRETKEYBYTES;crypto_kem_keypair(pk, sk);ss = [0]*g.KYBER_SSBYTES;ct = [0]*g.KYBER_CIPHERTEXTBYTES;crypto_kem_enc(ct, ss, pk); ssp=[0]*g.KYBER_SSBYTES"""
+        t = timeit("crypto_kem_dec(ssp, ct, sk)", setup=stp, globals=globals(), number=1000)
+        print(f"Decapsulation: {round(t, 3)}s\n")
+
+
+# Throughput of the batched KEM (requires numpy)
+def benchmark_batch():
+    for mode in [2, 3, 4]:
+        p = get_params(mode)
+        print(f"Kyber {mode} batched (operations per second)")
+        for n in [1, 8, 64, 256]:
+            pks, sks = crypto_kem_keypair_batch(n, p=p)
+            cts, sss = crypto_kem_enc_batch(pks, p=p)
+            reps = max(1, 256//n)
+            t = timeit(lambda: crypto_kem_keypair_batch(n, p=p), number=reps)
+            te = timeit(lambda: crypto_kem_enc_batch(pks, p=p), number=reps)
+            td = timeit(lambda: crypto_kem_dec_batch(cts, sks, p), number=reps)
+            print(f"batch {n:>3}: key generation {round(n*reps/t)}, encapsulation {round(n*reps/te)}, decapsulation {round(n*reps/td)}")
+        print()
+
+
+# Throughput of KyberPool with 1 to cpu_count() worker processes
+def benchmark_pool(n:int=1000):
+    for mode in [2, 3, 4]:
+        kyber = Kyber(mode)
+        pk, sk = kyber.keypair()
+        ct, ss = kyber.encaps(pk)
+        print(f"Kyber {mode} process pool (operations per second)")
+        for workers in range(1, cpu_count() + 1):
+            with KyberPool(mode, workers, public_keys=[pk], secret_keys=[sk]) as pool:
+                # start the workers before timing
+                pool.keypair(workers)
+                t = perf_counter()
+                pool.keypair(n)
+                tk = perf_counter()
+                pool.encaps(pk, n=n)
+                te = perf_counter()
+                pool.decaps([ct]*n, sk)
+                td = perf_counter()
+            print(f"{workers:>2} workers: key generation {round(n/(tk-t))}, encapsulation {round(n/(te-tk))}, decapsulation {round(n/(td-te))}")
+        print()
+
+
+if __name__ == "__main__":
+    benchmark_single()
+    if np is not None:
+        benchmark_batch()
+    benchmark_pool()
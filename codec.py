@@ -0,0 +1,153 @@
+# Table-driven compression codec for any bit width d.
+#
+# Compress_d(x) = round(2^d/q * x) mod 2^d and its inverse are the only
+# places outside the NTT where the reference divides by q. Since the
+# input of Compress_d is a coefficient in (-q, q), compression is a lookup
+# in a table of q entries: indexing with a negative coefficient wraps
+# around to x + q, which is exactly the normalization the reference does
+# with (x >> 15) & q. Decompression is a lookup in a table of 2^d entries.
+#
+# The d-bit values are packed little-endian, 8 values to d bytes, for
+# every d; this is the byte layout all the hand-written branches of
+# poly.py and polyvec.py implement (d = 1 is poly_tomsg/poly_frommsg,
+# d = 4, 5 is poly_compress, d = 10, 11 is polyvec_compress). One codec
+# covers a whole polyvec, since its coefficients share one buffer.
+#
+# Coefficients outside (-q, q) are not valid input, but the codec falls
+# back to the reference arithmetic for them so the output still matches.
+
+from polyvec import *
+from functools import lru_cache
+
+
+#################################################
+# Name:        compress_table
+#
+# Description: Table of Compress_d(x) for x in {0,...,q-1}
+#
+# Arguments:   - int q: modulus
+#              - int d: bit width
+##################################################
+@lru_cache(maxsize=None)
+def compress_table(q:int, d:int) -> List[int]:
+    return [(((x << d) + q//2)//q) & ((1 << d) - 1) for x in range(q)]
+
+
+#################################################
+# Name:        decompress_table
+#
+# Description: Table of Decompress_d(x) for x in {0,...,2^d-1}
+#
+# Arguments:   - int q: modulus
+#              - int d: bit width
+##################################################
+@lru_cache(maxsize=None)
+def decompress_table(q:int, d:int) -> List[int]:
+    return [(x*q + (1 << (d-1))) >> d for x in range(1 << d)]
+
+
+#################################################
+# Name:        make_codec
+#
+# Description: Compression and decompression of n coefficients to
+#              n*d/8 bytes. compress(r, a, off) writes the coefficients
+#              of the poly or polyvec a to r at offset off,
+#              decompress(r, a, off) reads them back from a.
+#
+# Arguments:   - Parameters p: parameters of the mode
+#              - int d: bit width, 1 <= d <= 11
+#              - int n: number of coefficients, a multiple of 8
+##################################################
+def make_codec(p:Parameters, d:int, n:int):
+    Q, HALF, MASK, NBYTES = p.KYBER_Q, p.KYBER_Q//2, (1 << d) - 1, n*d//8
+    T, D = compress_table(Q, d), decompress_table(Q, d)
+    lookup = T.__getitem__
+    SHIFTS = [d*j for j in range(8)]
+    D1, D2, D4 = d, 2*d, 4*d
+
+    def codec_compress(r:List[int], a:poly, off:int=0):
+        try:
+            t = list(map(lookup, a.coeffs))
+        except IndexError:
+            t = [((((u + ((u >> 15) & Q)) << d) + HALF)//Q) & MASK for u in a.coeffs]
+        # merge neighbours until every value holds 8 coefficients, d bytes
+        t = [t0 | (t1 << D1) for t0, t1 in zip(t[0::2], t[1::2])]
+        t = [t0 | (t1 << D2) for t0, t1 in zip(t[0::2], t[1::2])]
+        t = [t0 | (t1 << D4) for t0, t1 in zip(t[0::2], t[1::2])]
+        r[off:off+NBYTES] = b"".join([x.to_bytes(d, "little") for x in t])
+
+    def codec_decompress(r:poly, a:List[int], off:int=0):
+        a = bytes(byte_view(a, off, NBYTES))
+        r.coeffs[:] = array("i", [D[(x >> s) & MASK]
+                                  for x in [int.from_bytes(a[i:i+d], "little") for i in range(0, NBYTES, d)]
+                                  for s in SHIFTS])
+    return codec_compress, codec_decompress
+
+
+#################################################
+# Name:        compress_array
+#
+# Description: numpy version of the codec on arrays: compresses the
+#              coefficients in the last axis of c to d bits each
+#
+# Arguments:   - ndarray c: integer array of shape (..., n), n a multiple of 8
+#              - int d: bit width, 1 <= d <= 11
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns uint8 array of shape (..., n*d/8)
+##################################################
+def compress_array(c, d:int, p:Parameters=g):
+    Q = p.KYBER_Q
+    try:
+        t = compress_table_np(Q, d)[c]
+    except IndexError:
+        c = c.astype(np.int64)
+        t = ((((c + ((c >> 15) & Q)) << d) + Q//2)//Q) & ((1 << d) - 1)
+    bits = ((t[..., None] >> np.arange(d, dtype=np.uint16)) & 1).astype(np.uint8)
+    return np.packbits(bits.reshape(c.shape[:-1] + (-1,)), axis=-1, bitorder="little")
+
+
+#################################################
+# Name:        decompress_array
+#
+# Description: Inverse of compress_array up to the rounding error
+#
+# Arguments:   - ndarray a: uint8 array of shape (..., m)
+#              - int d: bit width, 1 <= d <= 11
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns int32 array of shape (..., 8*m/d)
+##################################################
+def decompress_array(a, d:int, p:Parameters=g):
+    bits = np.unpackbits(a, axis=-1, bitorder="little")
+    bits = bits.reshape(a.shape[:-1] + (-1, d))
+    return decompress_table_np(p.KYBER_Q, d)[bits @ (1 << np.arange(d, dtype=np.uint16))]
+
+
+@lru_cache(maxsize=None)
+def compress_table_np(q:int, d:int):
+    return np.array(compress_table(q, d), dtype=np.uint16)
+
+@lru_cache(maxsize=None)
+def decompress_table_np(q:int, d:int):
+    return np.array(decompress_table(q, d), dtype=np.int32)
+
+
+#################################################
+# Name:        make_codec_np
+#
+# Description: numpy version of make_codec
+#
+# Arguments:   - Parameters p: parameters of the mode
+#              - int d: bit width, 1 <= d <= 11
+#              - int n: number of coefficients, a multiple of 8
+##################################################
+def make_codec_np(p:Parameters, d:int, n:int):
+    NBYTES = n*d//8
+
+    def codec_compress_np(r:List[int], a:poly, off:int=0):
+        store_bytes(r, off, compress_array(np.frombuffer(a.coeffs, dtype=np.int32), d, p))
+
+    def codec_decompress_np(r:poly, a:List[int], off:int=0):
+        np.frombuffer(r.coeffs, dtype=np.int32)[:] = decompress_array(bytes_to_array(a, off, NBYTES), d, p)
+    return codec_compress_np, codec_decompress_np
@@ -1,7 +1,9 @@
 # Contains elements from indcpa.h and indcpa.c
 
-from polyvec import *
+from backend import *
 from os import urandom
+from collections import OrderedDict
+from threading import Lock, local
 
 
 #################################################
@@ -14,11 +16,12 @@ from os import urandom
 # Arguments:   - List[int] r:    the output serialized public key
 #              - polyvec pk:     the input public-key polyvec
 #              - List[int] seed: the input public seed
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def pack_pk(r:List[int], pk:polyvec, seed:List[int]):
-    polyvec_tobytes(r, pk)
-    for i in range(g.KYBER_SYMBYTES):
-        r[i+g.KYBER_POLYVECBYTES] = seed[i]
+def pack_pk(r:List[int], pk:polyvec, seed:List[int], p:Parameters=g):
+    get_backend(p).polyvec_tobytes(r, pk)
+    for i in range(p.KYBER_SYMBYTES):
+        r[i+p.KYBER_POLYVECBYTES] = seed[i]
 
 
 #################################################
@@ -30,11 +33,12 @@ def pack_pk(r:List[int], pk:polyvec, seed:List[int]):
 # Arguments:   - polyvec pk: output public-key polynomial vector
 #              - List[int] seed: output seed to generate matrix A
 #              - List[int] packedpk: input serialized public key
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def unpack_pk(pk:polyvec, seed:List[int], packedpk:List[int]):
-    polyvec_frombytes(pk, packedpk)
-    for i in range(g.KYBER_SYMBYTES):
-        seed[i] = packedpk[i+g.KYBER_POLYVECBYTES]
+def unpack_pk(pk:polyvec, seed:List[int], packedpk:List[int], p:Parameters=g):
+    get_backend(p).polyvec_frombytes(pk, packedpk)
+    for i in range(p.KYBER_SYMBYTES):
+        seed[i] = packedpk[i+p.KYBER_POLYVECBYTES]
 
 
 #################################################
@@ -44,9 +48,10 @@ def unpack_pk(pk:polyvec, seed:List[int], packedpk:List[int]):
 #
 # Arguments:   - List[int] r: output serialized secret key
 #              - polyvec sk: input vector of polynomials (secret key)
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def pack_sk(r:List[int], sk:polyvec):
-    polyvec_tobytes(r, sk)
+def pack_sk(r:List[int], sk:polyvec, p:Parameters=g):
+    get_backend(p).polyvec_tobytes(r, sk)
 
 
 #################################################
@@ -56,9 +61,10 @@ def pack_sk(r:List[int], sk:polyvec):
 #
 # Arguments:   - polyvec sk: output vector of polynomials (secret key)
 #              - List[int] packedsk: input serialized secret key
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def unpack_sk(sk:polyvec, packedsk:List[int]):
-    polyvec_frombytes(sk, packedsk)
+def unpack_sk(sk:polyvec, packedsk:List[int], p:Parameters=g):
+    get_backend(p).polyvec_frombytes(sk, packedsk)
 
 
 #################################################
@@ -71,13 +77,12 @@ def unpack_sk(sk:polyvec, packedsk:List[int]):
 # Arguments:   - List[int] r: the output serialized ciphertext
 #              - poly pk: the input vector of polynomials b
 #              - poly v: the input polynomial v
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def pack_ciphertext(r:List[int], b:polyvec, v:poly):
-    polyvec_compress(r, b)
-    temp = [0]*g.KYBER_POLYCOMPRESSEDBYTES
-    poly_compress(temp, v)
-    for i in range(g.KYBER_POLYCOMPRESSEDBYTES):
-        r[g.KYBER_POLYVECCOMPRESSEDBYTES+i] = temp[i]
+def pack_ciphertext(r:List[int], b:polyvec, v:poly, p:Parameters=g):
+    backend = get_backend(p)
+    backend.polyvec_compress(r, b)
+    backend.poly_compress(r, v, p.KYBER_POLYVECCOMPRESSEDBYTES)
 
 
 #################################################
@@ -89,39 +94,80 @@ def pack_ciphertext(r:List[int], b:polyvec, v:poly):
 # Arguments:   - polyvec b: the output vector of polynomials b
 #              - poly v: the output polynomial v
 #              - List[int] c: the input serialized ciphertext
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def unpack_ciphertext(b:polyvec, v:poly, c:List[int]):
-    polyvec_decompress(b, c)
-    poly_decompress(v, c[g.KYBER_POLYVECCOMPRESSEDBYTES:])
+def unpack_ciphertext(b:polyvec, v:poly, c:List[int], p:Parameters=g):
+    backend = get_backend(p)
+    backend.polyvec_decompress(b, c)
+    backend.poly_decompress(v, c, p.KYBER_POLYVECCOMPRESSEDBYTES)
 
 
 #################################################
-# Name:        rej_uniform
+# Name:        MatrixCache
 #
-# Description: Run rejection sampling on uniform random bytes to generate
-#              uniform random integers mod q
+# Description: Bounded LRU cache of expanded matrices, keyed by
+#              (mode, seed, transposed). Encapsulating repeatedly to the
+#              same public key then expands A^T only once.
+#              A capacity of 0 disables the cache.
 #
-# Arguments:   - List[int] r: output buffer
-#              - int l: requested number of 16-bit integers (uniform mod q)
-#              - List[int] buf: input buffer (assumed to be uniformly random bytes)
-#              - buflen: length of input buffer in bytes
-#
-# Returns number of sampled 16-bit integers (at most l)
+# Arguments:   - int capacity: maximum number of matrices kept
 ##################################################
-def rej_uniform(r:List[int], l:int, buf:List[int], buflen:int) -> int:
-    ctr, pos = 0, 0
-    while ctr<l and pos+3<=buflen:
-        val0 = ((buf[pos+0] >> 0) | (buf[pos+1] << 8)) & 0xFFF
-        val1 = ((buf[pos+1] >> 4) | (buf[pos+2] << 4)) & 0xFFF
-        pos += 3
-
-        if val0 < g.KYBER_Q:
-            r[ctr] = val0
-            ctr += 1
-        if ctr<l and val1<g.KYBER_Q:
-            r[ctr] = val1
-            ctr += 1
-    return ctr
+class MatrixCache:
+    def __init__(self, capacity:int=8):
+        self.lock = Lock()
+        self.entries = OrderedDict()
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key:tuple):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+            else:
+                self.entries.move_to_end(key)
+                self.hits += 1
+            return entry
+
+    def put(self, key:tuple, entry):
+        with self.lock:
+            if self.capacity <= 0:
+                return
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self._evict()
+
+    def set_capacity(self, capacity:int):
+        with self.lock:
+            self.capacity = capacity
+            self._evict()
+
+    def _evict(self):
+        while len(self.entries) > max(self.capacity, 0):
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    # Drop all matrices generated from seed, or everything if seed is None
+    def invalidate(self, seed:List[int]=None):
+        with self.lock:
+            if seed is None:
+                self.entries.clear()
+                return
+            seed = bytes(seed)
+            for key in [key for key in self.entries if key[1] == seed]:
+                del self.entries[key]
+
+    def stats(self) -> dict:
+        with self.lock:
+            return {"size": len(self.entries), "capacity": self.capacity,
+                    "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+matrix_cache = MatrixCache()
 
 
 #################################################
@@ -135,42 +181,276 @@ def rej_uniform(r:List[int], l:int, buf:List[int], buflen:int) -> int:
 # Arguments:   - polyvec *a: pointer to ouptput matrix A
 #              - const uint8_t *seed: pointer to input seed
 #              - int transposed: boolean deciding whether A or A^T is generated
+#              - bool use_cache: look up and store the matrix in matrix_cache
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-GEN_MATRIX_NBLOCKS = ((12*g.KYBER_N//8*(1 << 12)//g.KYBER_Q + XOF_BLOCKBYTES)//XOF_BLOCKBYTES)
-def gen_matrix(a:List[polyvec], seed:List[int], transposed:int):
-    buf = [0]*(GEN_MATRIX_NBLOCKS*XOF_BLOCKBYTES+2)
-    state = xof_state()
-
-    for i in range(g.KYBER_K):
-        for j in range(g.KYBER_K):
-            state = xof_state()
-            if transposed:
-                xof_absorb(state, seed, i, j)
-            else:
-                xof_absorb(state, seed, j, i)
+def gen_matrix(a:List[polyvec], seed:List[int], transposed:int, use_cache:bool=True, p:Parameters=g):
+    key = (p.KYBER_K, bytes(seed[:p.KYBER_SYMBYTES]), bool(transposed))
+    cached = matrix_cache.get(key) if use_cache else None
+    if cached is not None:
+        for i in range(p.KYBER_K):
+            a[i].coeffs[:] = cached[i]
+        return
+
+    get_backend(p).gen_matrix(a, seed, transposed)
+
+    if use_cache:
+        matrix_cache.put(key, tuple(array("i", a[i].coeffs) for i in range(p.KYBER_K)))
+
+
+# Key generation seeds are fresh every time, so A is not cached
+def gen_a(A, B, p:Parameters=g):
+    gen_matrix(A, B, 0, False, p)
 
-            buf = xof_squeezeblocks(GEN_MATRIX_NBLOCKS, state)
-            buflen = GEN_MATRIX_NBLOCKS*XOF_BLOCKBYTES
-            ctr = rej_uniform(a[i].vec[j].coeffs, g.KYBER_N, buf, buflen)
+def gen_at(A, B, p:Parameters=g):
+    gen_matrix(A, B, 1, True, p)
 
-            while (ctr < g.KYBER_N):
-                off = buflen % 3
-                for k in range(off):
-                    buf[k] = buf[buflen - off + k]
-                buf = buf[:off] + xof_squeezeblocks(1, state)
-                buflen = off + XOF_BLOCKBYTES
-                temp = [0]*(g.KYBER_N - ctr)
-                ctr1 = rej_uniform(temp, g.KYBER_N - ctr, buf, buflen)
-                for index in range(g.KYBER_N-ctr):
-                    a[i].vec[j].coeffs[ctr+index] = temp[index]
-                ctr += ctr1
 
+#################################################
+# Name:        Workspace
+#
+# Description: Preallocated intermediates of indcpa_keypair, indcpa_enc
+#              and indcpa_dec for the mode that was active when it was
+#              created. Passing the same workspace to every call removes
+#              the per-call allocation of polynomials and buffers.
+#              A workspace must not be shared between threads;
+#              get_workspace returns one per thread and mode.
+##################################################
+class Workspace:
+    def __init__(self, p:Parameters=g):
+        self.mode = p.KYBER_K
+        # a holds A for keypair and A^T for enc
+        self.a = [polyvec(None, p) for _ in range(p.KYBER_K)]
+        # sp doubles as skpv and ep as e
+        self.sp, self.pkpv, self.ep, self.b = [polyvec(None, p) for _ in range(4)]
+        self.v, self.k, self.epp = [poly() for _ in range(3)]
+        self.seed = bytearray(p.KYBER_SYMBYTES)
+        self.cmp = bytearray(p.KYBER_CIPHERTEXTBYTES)
+
+        # Argument lists for the batched calls in indcpa_keypair/indcpa_enc
+        self.keypair_noise = self.sp.vec + self.ep.vec
+        self.enc_noise = self.ep.vec + [self.epp]
+        self.enc_rows = self.b.vec + [self.v]
+        self.enc_matrix = self.a + [self.pkpv]
+
+    def check(self, p:Parameters=g):
+        if self.mode != p.KYBER_K:
+            raise ValueError("Workspace was created for a different mode")
+
+workspaces = local()
+
+def get_workspace(p:Parameters=g) -> Workspace:
+    if not hasattr(workspaces, "by_mode"):
+        workspaces.by_mode = {}
+    ws = workspaces.by_mode.get(p.KYBER_K)
+    if ws is None:
+        ws = workspaces.by_mode[p.KYBER_K] = Workspace(p)
+    return ws
 
-def gen_a(A, B):
-    gen_matrix(A, B, 0)
 
-def gen_at(A, B):
-    gen_matrix(A, B, 1)
+#################################################
+# Name:        PreparedPublicKey
+#
+# Description: A public key parsed once for repeated encryption: the
+#              unpacked polyvec, the seed, the expanded matrix A^T and
+#              H(pk). indcpa_enc and the KEM encapsulation accept it in
+#              place of the packed public key and then skip unpack_pk,
+#              gen_at and hashing pk; the ciphertexts are unchanged.
+#              The buffers take footprint(p) bytes, see nbytes.
+#
+# Arguments:   - List[int] pk: input public key
+#                (of length KYBER_PUBLICKEYBYTES bytes)
+#              - Parameters p: parameters of the mode (defaults to g)
+##################################################
+class PreparedPublicKey:
+    def __init__(self, pk:List[int], p:Parameters=g):
+        if len(pk) != p.KYBER_PUBLICKEYBYTES:
+            raise ValueError("Public key must be KYBER_PUBLICKEYBYTES long")
+        self.mode = p.KYBER_K
+        self.pk = bytes(pk)
+        self.hpk = hash_h(self.pk)
+        self.seed = bytearray(p.KYBER_SYMBYTES)
+        self.pkpv = polyvec(None, p)
+        unpack_pk(self.pkpv, self.seed, self.pk, p)
+        self.seed = bytes(self.seed)
+        # The matrix belongs to this key, so it bypasses matrix_cache
+        self.at = [polyvec(None, p) for _ in range(p.KYBER_K)]
+        gen_matrix(self.at, self.seed, 1, False, p)
+        # Matrix operand of the product in indcpa_enc, and its form per
+        # backend, see operand
+        self.matrix = self.at + [self.pkpv]
+        self.operands = {}
+
+    def check(self, p:Parameters=g):
+        if self.mode != p.KYBER_K:
+            raise ValueError("Public key was prepared for a different mode")
+
+    # operands is a cache, rebuilt on first use after unpickling
+    def __getstate__(self):
+        return dict(self.__dict__, operands={})
+
+    # The matrix_operand of matrix for backend, kept on the key from its
+    # first use
+    def operand(self, backend:Backend):
+        operand = self.operands.get(backend.name)
+        if operand is None:
+            operand = self.operands[backend.name] = backend.matrix_operand(self.matrix)
+        return operand
+
+    # Bytes held by the key material of a prepared key of the mode of p:
+    # K^2 + K polynomials of N 32-bit coefficients, pk, seed and H(pk).
+    # The kronecker and numpy backends add their form of the matrix to
+    # operands on first use.
+    @staticmethod
+    def footprint(p:Parameters=g) -> int:
+        return ((p.KYBER_K + 1)*p.KYBER_K*p.KYBER_N*4 + p.KYBER_PUBLICKEYBYTES
+                + 2*p.KYBER_SYMBYTES)
+
+    @property
+    def nbytes(self) -> int:
+        return (sum(memoryview(a.coeffs).nbytes for a in self.matrix) + len(self.pk)
+                + len(self.seed) + len(self.hpk))
+
+
+#################################################
+# Name:        PreparedSecretKey
+#
+# Description: A KEM secret key parsed once for repeated decryption: the
+#              unpacked NTT-domain polyvec s, the embedded public key as
+#              a PreparedPublicKey for the re-encryption, H(pk) and z.
+#              indcpa_dec and the KEM decapsulation accept it in place of
+#              the packed secret key and then only do the per-ciphertext
+#              work; the shared secrets are unchanged.
+#              The buffers take footprint(p) bytes, see nbytes.
+#
+# Arguments:   - List[int] sk: input secret key
+#                (of length KYBER_SECRETKEYBYTES bytes)
+#              - Parameters p: parameters of the mode (defaults to g)
+##################################################
+class PreparedSecretKey:
+    def __init__(self, sk:List[int], p:Parameters=g):
+        if len(sk) != p.KYBER_SECRETKEYBYTES:
+            raise ValueError("Secret key must be KYBER_SECRETKEYBYTES long")
+        self.mode = p.KYBER_K
+        sk = bytes(sk)
+        self.skpv = polyvec(None, p)
+        unpack_sk(self.skpv, sk, p)
+        # Matrix operand of the product in indcpa_dec per backend, see
+        # operand
+        self.operands = {}
+        self.public_key = PreparedPublicKey(sk[p.KYBER_INDCPA_SECRETKEYBYTES:
+                                               p.KYBER_INDCPA_SECRETKEYBYTES+p.KYBER_INDCPA_PUBLICKEYBYTES], p)
+        # H(pk) and z as stored in sk, which is what crypto_kem_dec uses
+        self.hpk = sk[-2*p.KYBER_SYMBYTES:-p.KYBER_SYMBYTES]
+        self.z = sk[-p.KYBER_SYMBYTES:]
+
+    def check(self, p:Parameters=g):
+        if self.mode != p.KYBER_K:
+            raise ValueError("Secret key was prepared for a different mode")
+
+    # operands is a cache, rebuilt on first use after unpickling
+    def __getstate__(self):
+        return dict(self.__dict__, operands={})
+
+    # The matrix_operand of s for backend, kept on the key (and nowhere
+    # else) from its first use
+    def operand(self, backend:Backend):
+        operand = self.operands.get(backend.name)
+        if operand is None:
+            operand = self.operands[backend.name] = backend.matrix_operand([self.skpv])
+        return operand
+
+    # Bytes held by the key material of a prepared key of the mode of p:
+    # K polynomials of N 32-bit coefficients, the prepared public key,
+    # H(pk) and z. The kronecker and numpy backends add their form of s
+    # to operands on first use.
+    @staticmethod
+    def footprint(p:Parameters=g) -> int:
+        return p.KYBER_K*p.KYBER_N*4 + PreparedPublicKey.footprint(p) + 2*p.KYBER_SYMBYTES
+
+    @property
+    def nbytes(self) -> int:
+        return (memoryview(self.skpv.coeffs).nbytes + self.public_key.nbytes
+                + len(self.hpk) + len(self.z))
+
+
+#################################################
+# Name:        LazyReduction
+#
+# Description: Selects where indcpa_keypair, indcpa_enc and indcpa_dec
+#              reduce coefficients. "eager" reduces wherever the reference
+#              implementation does. "lazy" tracks bounds on the
+#              coefficients through each operation, skips the reduction
+#              after the forward NTT and only reduces before an encoding
+#              if the bound does not already keep every coefficient in
+#              (-q, q). The encodings only depend on the coefficients mod q
+#              in that range, so they are the same as with "eager".
+#              "validate" runs both and raises RuntimeError if they differ.
+#
+# Arguments:   - str mode: "eager", "lazy" or "validate"
+##################################################
+class LazyReduction:
+    def __init__(self, mode:str="eager"):
+        self.set_mode(mode)
+
+    def set_mode(self, mode:str):
+        if mode not in ("eager", "lazy", "validate"):
+            raise ValueError("Reduction mode must be 'eager', 'lazy' or 'validate'")
+        self.mode = mode
+
+    def check(self, lazy:List[int], eager:List[int]):
+        if list(lazy) != list(eager):
+            raise RuntimeError("Lazy reduction changed the encoding")
+
+lazy_reduction = LazyReduction()
+
+
+LAZY_BOUNDS = {}
+
+#################################################
+# Name:        get_lazy_bounds
+#
+# Description: Bounds on the coefficients that lazy reduction checks
+#              before each encoding, computed on first use per backend
+#              and mode: "skpv" and "pkpv" in indcpa_keypair, "b" and
+#              "v" in indcpa_enc, "mp" in indcpa_dec. Raises ValueError
+#              if a skipped reduction would make barrett_reduce inexact.
+#
+# Arguments:   - Backend backend: the backend doing the arithmetic
+#              - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def get_lazy_bounds(backend:Backend, p:Parameters=g) -> dict:
+    key = (backend.name, p.KYBER_K)
+    bounds = LAZY_BOUNDS.get(key)
+    if bounds is None:
+        s = ntt_bound(p.KYBER_ETA1)
+        barrett_bound(p.KYBER_K*basemul_bound(p.KYBER_Q-1, s))
+        # Unpacked public key coefficients have 12 bits
+        b = backend.matrix_mul_bound(4095, p.KYBER_ETA1, p.KYBER_K) + p.KYBER_ETA2
+        bounds = LAZY_BOUNDS[key] = {
+            "skpv": s,
+            "pkpv": montgomery_bound((p.KYBER_Q//2)*((1<<32) % p.KYBER_Q)) + s,
+            "b": b,
+            "v": b + (p.KYBER_Q+1)//2,
+            "mp": backend.matrix_mul_bound(4095, p.KYBER_Q, p.KYBER_K) + p.KYBER_Q}
+    return bounds
+
+
+#################################################
+# Name:        settle
+#
+# Description: Reduce the polynomials r unless the bound already keeps
+#              all their coefficients in (-q, q), as the encodings require
+#
+# Arguments:   - reduce: backend.poly_reduce or backend.polyvec_reduce
+#              - r: poly or polyvec to reduce
+#              - int bound: bound on the coefficients of r
+#              - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def settle(reduce, r, bound:int, p:Parameters=g):
+    if bound >= p.KYBER_Q:
+        barrett_bound(bound)
+        reduce(r)
 
 
 #################################################
@@ -183,40 +463,56 @@ def gen_at(A, B):
 #                             (of length KYBER_INDCPA_PUBLICKEYBYTES bytes)
 #              - List[int] sk: output private key
 #                             (of length KYBER_INDCPA_SECRETKEYBYTES bytes)
+#              - List[int] seed: optional input randomness
+#              - Workspace ws: optional workspace, defaults to get_workspace()
+#              - Parameters p: parameters of the mode (defaults to g)
+#              - bool lazy: reduce lazily; defaults to lazy_reduction.mode
 ##################################################
-def indcpa_keypair(pk:List[int], sk:List[int], seed:List[int]=None):
-    buf = [0]*2*g.KYBER_SYMBYTES
+def indcpa_keypair(pk:List[int], sk:List[int], seed:List[int]=None, ws:Workspace=None, p:Parameters=g, lazy:bool=None):
+    if seed is None:
+        seed = urandom(p.KYBER_SYMBYTES)
+    if lazy is None:
+        if lazy_reduction.mode == "validate":
+            epk, esk = [0]*p.KYBER_INDCPA_PUBLICKEYBYTES, [0]*p.KYBER_INDCPA_SECRETKEYBYTES
+            indcpa_keypair(epk, esk, seed, ws, p, False)
+            indcpa_keypair(pk, sk, seed, ws, p, True)
+            lazy_reduction.check(pk[:len(epk)], epk)
+            lazy_reduction.check(sk[:len(esk)], esk)
+            return
+        lazy = lazy_reduction.mode == "lazy"
+
+    if ws is None:
+        ws = get_workspace(p)
+    ws.check(p)
     nonce = 0
-    a = [polyvec() for _ in range(g.KYBER_K)]
-    e, pkpv, skpv = [polyvec() for _ in range(3)]
+    backend = get_backend(p)
+    a, e, pkpv, skpv = ws.a, ws.ep, ws.pkpv, ws.sp
 
-    if seed is None:
-        seed = list(urandom(g.KYBER_SYMBYTES))
-    assert len(seed) == g.KYBER_SYMBYTES
+    assert len(seed) == p.KYBER_SYMBYTES
     # buf = bytes(range(KYBER_SYMBYTES))
-    buf = list(hash_g(bytes(seed)))
+    buf = hash_g(bytes(seed))
 
-    gen_a(a, buf[:g.KYBER_SYMBYTES])
+    gen_a(a, buf[:p.KYBER_SYMBYTES], p)
 
-    for i in range(g.KYBER_K):
-        poly_getnoise_eta1(skpv.vec[i], buf[g.KYBER_SYMBYTES:], nonce)
-        nonce += 1
-    for i in range(g.KYBER_K):
-        poly_getnoise_eta1(e.vec[i], buf[g.KYBER_SYMBYTES:], nonce)
-        nonce += 1
+    backend.getnoise(ws.keypair_noise, buf[p.KYBER_SYMBYTES:], nonce, p.KYBER_ETA1)
+    nonce += 2*p.KYBER_K
 
-    polyvec_ntt(skpv)
-    polyvec_ntt(e)
+    backend.ntt(ws.keypair_noise, not lazy)
 
-    for i in range(g.KYBER_K):
-        polyvec_basemul_acc_montgomery(pkpv.vec[i], a[i], skpv)
-        poly_tomont(pkpv.vec[i])
+    backend.matrix_basemul(pkpv.vec, a, skpv)
+    for i in range(p.KYBER_K):
+        backend.poly_tomont(pkpv.vec[i])
 
-    polyvec_add(pkpv, pkpv, e)
-    polyvec_reduce(pkpv)
+    polyvec_add(pkpv, pkpv, e, p)
+    if lazy:
+        bounds = get_lazy_bounds(backend, p)
+        settle(backend.polyvec_reduce, pkpv, bounds["pkpv"], p)
+        settle(backend.polyvec_reduce, skpv, bounds["skpv"], p)
+    else:
+        backend.polyvec_reduce(pkpv)
 
-    pack_sk(sk, skpv)
-    pack_pk(pk, pkpv, buf[:g.KYBER_SYMBYTES])
+    pack_sk(sk, skpv, p)
+    pack_pk(pk, pkpv, buf[:p.KYBER_SYMBYTES], p)
 
 
 #################################################
@@ -231,47 +527,63 @@ def indcpa_keypair(pk:List[int], sk:List[int], seed:List[int]=None):
 #                             (of length KYBER_INDCPA_MSGBYTES bytes)
 #              - List[int] pk: input public key
 #                              (of length KYBER_INDCPA_PUBLICKEYBYTES)
+#                              or a PreparedPublicKey
 #              - List[int] coins: input random coins used as seed
 #                                 (of length KYBER_SYMBYTES) to deterministically
 #                                 generate all randomness
+#              - Workspace ws: optional workspace, defaults to get_workspace()
+#              - Parameters p: parameters of the mode (defaults to g)
+#              - bool lazy: reduce lazily; defaults to lazy_reduction.mode
 ##################################################
-def indcpa_enc(c:List[int], m:List[int], pk:List[int], coins:List[int]):
-    seed = [0]*g.KYBER_SYMBYTES
+def indcpa_enc(c:List[int], m:List[int], pk:List[int], coins:List[int], ws:Workspace=None, p:Parameters=g, lazy:bool=None):
+    if lazy is None:
+        if lazy_reduction.mode == "validate":
+            expected = [0]*p.KYBER_INDCPA_BYTES
+            indcpa_enc(expected, m, pk, coins, ws, p, False)
+            indcpa_enc(c, m, pk, coins, ws, p, True)
+            lazy_reduction.check(c[:len(expected)], expected)
+            return
+        lazy = lazy_reduction.mode == "lazy"
+
+    if ws is None:
+        ws = get_workspace(p)
+    ws.check(p)
+    seed = ws.seed
     nonce = 0
-    at = [polyvec() for _ in range(g.KYBER_K)]
-    sp, pkpv, ep, b = [polyvec() for _ in range(4)]
-    v, k, epp = [poly() for _ in range(3)]
-
-    unpack_pk(pkpv, seed, pk)
-    poly_frommsg(k, m)
-    gen_at(at, seed)
-
-    for i in range(g.KYBER_K):
-        poly_getnoise_eta1(sp.vec[i], coins, nonce)
-        nonce += 1
-    for i in range(g.KYBER_K):
-        poly_getnoise_eta2(ep.vec[i], coins, nonce)
-        nonce += 1
-    poly_getnoise_eta2(epp, coins, nonce)
-    nonce += 1
-
-    polyvec_ntt(sp)
-
-    for i in range(g.KYBER_K):
-        polyvec_basemul_acc_montgomery(b.vec[i], at[i], sp)
-
-    polyvec_basemul_acc_montgomery(v, pkpv, sp)
-
-    polyvec_invntt_tomont(b)
-    poly_invntt_tomont(v)
-
-    polyvec_add(b, b, ep)
+    backend = get_backend(p)
+    at = ws.a
+    sp, pkpv, ep, b = ws.sp, ws.pkpv, ws.ep, ws.b
+    v, k, epp = ws.v, ws.k, ws.epp
+
+    if isinstance(pk, PreparedPublicKey):
+        pk.check(p)
+        matrix = pk.operand(backend)
+    else:
+        unpack_pk(pkpv, seed, pk, p)
+        gen_at(at, seed, p)
+        matrix = ws.enc_matrix
+    backend.poly_frommsg(k, m)
+
+    backend.getnoise(sp.vec, coins, nonce, p.KYBER_ETA1)
+    nonce += p.KYBER_K
+    backend.getnoise(ws.enc_noise, coins, nonce, p.KYBER_ETA2)
+    nonce += p.KYBER_K+1
+
+    # b = A^T*sp and v = pk*sp in one matrix-vector product
+    backend.matrix_mul(ws.enc_rows, matrix, sp, not lazy)
+
+    polyvec_add(b, b, ep, p)
     poly_add(v, v, epp)
     poly_add(v, v, k)
-    polyvec_reduce(b)
-    poly_reduce(v)
+    if lazy:
+        bounds = get_lazy_bounds(backend, p)
+        settle(backend.polyvec_reduce, b, bounds["b"], p)
+        settle(backend.poly_reduce, v, bounds["v"], p)
+    else:
+        backend.polyvec_reduce(b)
+        backend.poly_reduce(v)
 
-    pack_ciphertext(c, b, v)
+    pack_ciphertext(c, b, v, p)
 
 
 #################################################
@@ -286,19 +598,42 @@ def indcpa_enc(c:List[int], m:List[int], pk:List[int], coins:List[int]):
 #                             (of length KYBER_INDCPA_BYTES)
 #              - List[int] sk: input secret key
 #                              (of length KYBER_INDCPA_SECRETKEYBYTES)
+#                              or a PreparedSecretKey
+#              - Workspace ws: optional workspace, defaults to get_workspace()
+#              - Parameters p: parameters of the mode (defaults to g)
+#              - bool lazy: reduce lazily; defaults to lazy_reduction.mode
 ##################################################
-def indcpa_dec(m:List[int], c:List[int], sk:List[int]):
-    b, skpv = polyvec(), polyvec()
-    v, mp = poly(), poly()
-
-    unpack_ciphertext(b, v, c)
-    unpack_sk(skpv, sk)
-
-    polyvec_ntt(b)
-    polyvec_basemul_acc_montgomery(mp, skpv, b)
-    poly_invntt_tomont(mp)
+def indcpa_dec(m:List[int], c:List[int], sk:List[int], ws:Workspace=None, p:Parameters=g, lazy:bool=None):
+    if lazy is None:
+        if lazy_reduction.mode == "validate":
+            expected = [0]*p.KYBER_INDCPA_MSGBYTES
+            indcpa_dec(expected, c, sk, ws, p, False)
+            indcpa_dec(m, c, sk, ws, p, True)
+            lazy_reduction.check(m[:len(expected)], expected)
+            return
+        lazy = lazy_reduction.mode == "lazy"
+
+    if ws is None:
+        ws = get_workspace(p)
+    ws.check(p)
+    backend = get_backend(p)
+    b, skpv = ws.b, ws.sp
+    v, mp = ws.v, ws.k
+
+    unpack_ciphertext(b, v, c, p)
+    if isinstance(sk, PreparedSecretKey):
+        sk.check(p)
+        matrix = sk.operand(backend)
+    else:
+        unpack_sk(skpv, sk, p)
+        matrix = backend.matrix_operand([skpv])
+
+    backend.matrix_mul([mp], matrix, b, not lazy)
 
     poly_sub(mp, v, mp)
-    poly_reduce(mp)
+    if lazy:
+        settle(backend.poly_reduce, mp, get_lazy_bounds(backend, p)["mp"], p)
+    else:
+        backend.poly_reduce(mp)
     
-    poly_tomsg(m, mp)
+    backend.poly_tomsg(m, mp)
@@ -1,6 +1,7 @@
 # Contains elements from kem.h and kem.c
 from verify import *
 from indcpa import *
+from typing import Tuple
 
 
 #################################################
@@ -13,22 +14,23 @@ from indcpa import *
 #                (an already allocated array of KYBER_PUBLICKEYBYTES bytes)
 #              - List[int] sk: output private key
 #                (an already allocated array of KYBER_SECRETKEYBYTES bytes)
+#              - Parameters p: parameters of the mode (defaults to g)
 #
 # Returns 0 (success)
 ##################################################
-def crypto_kem_keypair(pk:List[int], sk:List[int], key_seed:List[int]=None, z:List[int]=None) -> int:
-    indcpa_keypair(pk, sk, key_seed)
-    for i in range(g.KYBER_INDCPA_PUBLICKEYBYTES):
-        sk[i+g.KYBER_INDCPA_SECRETKEYBYTES] = pk[i]
+def crypto_kem_keypair(pk:List[int], sk:List[int], key_seed:List[int]=None, z:List[int]=None, p:Parameters=g) -> int:
+    indcpa_keypair(pk, sk, key_seed, None, p)
+    for i in range(p.KYBER_INDCPA_PUBLICKEYBYTES):
+        sk[i+p.KYBER_INDCPA_SECRETKEYBYTES] = pk[i]
     temp = list(hash_h(bytes(pk)))
-    for i in range(g.KYBER_SYMBYTES):
-        sk[-2*g.KYBER_SYMBYTES+i] = temp[i]
+    for i in range(p.KYBER_SYMBYTES):
+        sk[-2*p.KYBER_SYMBYTES+i] = temp[i]
     # Value z for pseudo-random output on reject
     if z is None:
-        z = list(urandom(g.KYBER_SYMBYTES))
+        z = list(urandom(p.KYBER_SYMBYTES))
     # temp = list(range(KYBER_SYMBYTES))
-    for i in range(g.KYBER_SYMBYTES):
-        sk[-g.KYBER_SYMBYTES+i] = z[i]
+    for i in range(p.KYBER_SYMBYTES):
+        sk[-p.KYBER_SYMBYTES+i] = z[i]
     return 0
 
 
@@ -44,32 +46,35 @@ def crypto_kem_keypair(pk:List[int], sk:List[int], key_seed:List[int]=None, z:Li
 #                (an already allocated array of KYBER_SSBYTES bytes)
 #              - List[int] pk: input public key
 #                (an already allocated array of KYBER_PUBLICKEYBYTES bytes)
+#                or a PreparedPublicKey
+#              - Parameters p: parameters of the mode (defaults to g)
 #
 # Returns 0 (success)
 ##################################################
-def crypto_kem_enc(ct:List[int], ss:List[int], pk:List[int], seed:List[int]=None) -> int:
-    buf = [0]*2*g.KYBER_SYMBYTES
+def crypto_kem_enc(ct:List[int], ss:List[int], pk:List[int], seed:List[int]=None, p:Parameters=g) -> int:
+    buf = [0]*2*p.KYBER_SYMBYTES
     # Will contain key, coins
-    kr = [0]*2*g.KYBER_SYMBYTES
+    kr = [0]*2*p.KYBER_SYMBYTES
     
     if seed is None:
-        seed = list(urandom(g.KYBER_SYMBYTES))
+        seed = list(urandom(p.KYBER_SYMBYTES))
     # buf = list(range(32))
     # Don't release system RNG output
     buf = list(hash_h(bytes(seed)))
 
     # Multitarget countermeasure for coins + contributory KEM
-    buf = buf[:g.KYBER_SYMBYTES] + list(hash_h(bytes(pk)))
+    hpk = pk.hpk if isinstance(pk, PreparedPublicKey) else hash_h(bytes(pk))
+    buf = buf[:p.KYBER_SYMBYTES] + list(hpk)
     kr = list(hash_g(bytes(buf)))
 
     # coins are in kr[KYBER_SYMBYTES:]
-    indcpa_enc(ct, buf, pk, kr[g.KYBER_SYMBYTES:])
+    indcpa_enc(ct, buf, pk, kr[p.KYBER_SYMBYTES:], None, p)
 
     # overwrite coins in kr with H(c)
-    kr = kr[:g.KYBER_SYMBYTES] + list(hash_h(bytes(ct)))
+    kr = kr[:p.KYBER_SYMBYTES] + list(hash_h(bytes(ct)))
     # overwrite coins in kr with H(c)
-    temp = list(kdf(bytes(kr), 2*g.KYBER_SYMBYTES))
-    for i in range(g.KYBER_SYMBYTES):
+    temp = list(kdf(bytes(kr), 2*p.KYBER_SYMBYTES))
+    for i in range(p.KYBER_SYMBYTES):
         ss[i] = temp[i]
 
     return 0
@@ -87,38 +92,201 @@ def crypto_kem_enc(ct:List[int], ss:List[int], pk:List[int], seed:List[int]=None
 #                (an already allocated array of KYBER_CIPHERTEXTBYTES bytes)
 #              - List[int] sk: input private key
 #                (an already allocated array of KYBER_SECRETKEYBYTES bytes)
+#                or a PreparedSecretKey
+#              - Parameters p: parameters of the mode (defaults to g)
 #
 # Returns 0.
 #
 # On failure, ss will contain a pseudo-random value.
 ##################################################
-def crypto_kem_dec(ss:List[int], ct:List[int], sk:List[int]) -> int:
-    buf = [0]*2*g.KYBER_SYMBYTES
+def crypto_kem_dec(ss:List[int], ct:List[int], sk:List[int], p:Parameters=g) -> int:
+    buf = [0]*2*p.KYBER_SYMBYTES
     # Will contain key, coins
-    kr = [0]*2*g.KYBER_SYMBYTES
-    cmp = [0]*g.KYBER_CIPHERTEXTBYTES
-    pk = sk[g.KYBER_INDCPA_SECRETKEYBYTES:]
+    kr = [0]*2*p.KYBER_SYMBYTES
+    cmp = [0]*p.KYBER_CIPHERTEXTBYTES
+    if isinstance(sk, PreparedSecretKey):
+        pk, hpk, z = sk.public_key, sk.hpk, sk.z
+    else:
+        pk = sk[p.KYBER_INDCPA_SECRETKEYBYTES:]
+        hpk = sk[p.KYBER_SECRETKEYBYTES-2*p.KYBER_SYMBYTES:p.KYBER_SECRETKEYBYTES-p.KYBER_SYMBYTES]
+        z = sk[p.KYBER_SECRETKEYBYTES-p.KYBER_SYMBYTES:]
 
-    indcpa_dec(buf, ct, sk)
+    indcpa_dec(buf, ct, sk, None, p)
 
     # Multitarget countermeasure for coins + contributory KEM
-    for i in range(g.KYBER_SYMBYTES):
-        buf[g.KYBER_SYMBYTES+i] = sk[g.KYBER_SECRETKEYBYTES - 2*g.KYBER_SYMBYTES + i]
+    for i in range(p.KYBER_SYMBYTES):
+        buf[p.KYBER_SYMBYTES+i] = hpk[i]
     kr = list(hash_g(bytes(buf)))
 
     # coins are in kr[KYBER_SYMBYTES:]
-    indcpa_enc(cmp, buf, pk, kr[g.KYBER_SYMBYTES:])
+    indcpa_enc(cmp, buf, pk, kr[p.KYBER_SYMBYTES:], None, p)
 
-    fail = verify(ct, cmp, g.KYBER_CIPHERTEXTBYTES)
+    fail = verify(ct, cmp, p.KYBER_CIPHERTEXTBYTES)
 
     # overwrite coins in kr with H(c)
-    kr = kr[:g.KYBER_SYMBYTES] + list(hash_h(bytes(ct)))
+    kr = kr[:p.KYBER_SYMBYTES] + list(hash_h(bytes(ct)))
 
     # Overwrite pre-k with z on re-encryption failure
-    cmov(kr, sk[g.KYBER_SECRETKEYBYTES-g.KYBER_SYMBYTES:], g.KYBER_SYMBYTES, fail)
+    cmov(kr, z, p.KYBER_SYMBYTES, fail)
 
     # hash concatenation of pre-k and H(c) to k
-    temp = list(kdf(bytes(kr), 2*g.KYBER_SYMBYTES))
-    for i in range(g.KYBER_SYMBYTES):
+    temp = list(kdf(bytes(kr), 2*p.KYBER_SYMBYTES))
+    for i in range(p.KYBER_SYMBYTES):
         ss[i] = temp[i]
     return 0
+
+
+# The functions below provide the same KEM on bytes-like inputs (bytes,
+# bytearray or memoryview) and return immutable bytes instead of writing
+# into preallocated lists.
+
+#################################################
+# Name:        keypair
+#
+# Description: Generates public and private key
+#              for CCA-secure Kyber key encapsulation mechanism
+#
+# Arguments:   - bytes key_seed: optional seed for indcpa_keypair
+#                (of length KYBER_SYMBYTES)
+#              - bytes z: optional value for pseudo-random output on reject
+#                (of length KYBER_SYMBYTES)
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns (pk, sk) of KYBER_PUBLICKEYBYTES and KYBER_SECRETKEYBYTES bytes
+##################################################
+def keypair(key_seed:bytes=None, z:bytes=None, p:Parameters=g) -> Tuple[bytes, bytes]:
+    if key_seed is not None and len(key_seed) != p.KYBER_SYMBYTES:
+        raise ValueError("key_seed must be KYBER_SYMBYTES long")
+    # Value z for pseudo-random output on reject
+    if z is None:
+        z = urandom(p.KYBER_SYMBYTES)
+    if len(z) != p.KYBER_SYMBYTES:
+        raise ValueError("z must be KYBER_SYMBYTES long")
+    pk = bytearray(p.KYBER_PUBLICKEYBYTES)
+    sk = bytearray(p.KYBER_SECRETKEYBYTES)
+    indcpa_keypair(pk, sk, key_seed, None, p)
+    sk[p.KYBER_INDCPA_SECRETKEYBYTES:p.KYBER_INDCPA_SECRETKEYBYTES+p.KYBER_INDCPA_PUBLICKEYBYTES] = pk
+    sk[-2*p.KYBER_SYMBYTES:-p.KYBER_SYMBYTES] = hash_h(pk)
+    sk[-p.KYBER_SYMBYTES:] = z
+    return bytes(pk), bytes(sk)
+
+
+#################################################
+# Name:        encaps
+#
+# Description: Generates cipher text and shared
+#              secret for given public key
+#
+# Arguments:   - bytes pk: input public key
+#                (of length KYBER_PUBLICKEYBYTES) or a PreparedPublicKey
+#              - bytes seed: optional randomness
+#                (of length KYBER_SYMBYTES)
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns (ct, ss) of KYBER_CIPHERTEXTBYTES and KYBER_SSBYTES bytes
+##################################################
+def encaps(pk:bytes, seed:bytes=None, p:Parameters=g) -> Tuple[bytes, bytes]:
+    if isinstance(pk, PreparedPublicKey):
+        pk.check(p)
+        hpk = pk.hpk
+    elif len(pk) != p.KYBER_PUBLICKEYBYTES:
+        raise ValueError("Public key must be KYBER_PUBLICKEYBYTES long")
+    else:
+        hpk = hash_h(pk)
+    if seed is None:
+        seed = urandom(p.KYBER_SYMBYTES)
+    # Don't release system RNG output
+    # Multitarget countermeasure for coins + contributory KEM
+    buf = hash_h(bytes(seed)) + hpk
+    kr = hash_g(buf)
+
+    # coins are in kr[KYBER_SYMBYTES:]
+    ct = bytearray(p.KYBER_CIPHERTEXTBYTES)
+    indcpa_enc(ct, buf, pk, kr[p.KYBER_SYMBYTES:], None, p)
+
+    # hash concatenation of pre-k and H(c) to k
+    ss = kdf(kr[:p.KYBER_SYMBYTES] + hash_h(ct), p.KYBER_SSBYTES)
+    return bytes(ct), ss
+
+
+#################################################
+# Name:        decaps
+#
+# Description: Generates shared secret for given
+#              cipher text and private key
+#
+# Arguments:   - bytes ct: input cipher text
+#                (of length KYBER_CIPHERTEXTBYTES)
+#              - bytes sk: input private key
+#                (of length KYBER_SECRETKEYBYTES) or a PreparedSecretKey
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns the KYBER_SSBYTES shared secret.
+#
+# On failure, the shared secret is a pseudo-random value.
+##################################################
+def decaps(ct:bytes, sk:bytes, p:Parameters=g) -> bytes:
+    if len(ct) != p.KYBER_CIPHERTEXTBYTES:
+        raise ValueError("Ciphertext must be KYBER_CIPHERTEXTBYTES long")
+    if isinstance(sk, PreparedSecretKey):
+        sk.check(p)
+        pk, hpk, z = sk.public_key, sk.hpk, sk.z
+    elif len(sk) != p.KYBER_SECRETKEYBYTES:
+        raise ValueError("Secret key must be KYBER_SECRETKEYBYTES long")
+    else:
+        sk = memoryview(sk)
+        pk = sk[p.KYBER_INDCPA_SECRETKEYBYTES:p.KYBER_INDCPA_SECRETKEYBYTES+p.KYBER_INDCPA_PUBLICKEYBYTES]
+        hpk, z = sk[-2*p.KYBER_SYMBYTES:-p.KYBER_SYMBYTES], sk[-p.KYBER_SYMBYTES:]
+
+    buf = bytearray(2*p.KYBER_SYMBYTES)
+    indcpa_dec(buf, ct, sk, None, p)
+
+    # Multitarget countermeasure for coins + contributory KEM
+    buf[p.KYBER_SYMBYTES:] = hpk
+    kr = hash_g(buf)
+
+    # coins are in kr[KYBER_SYMBYTES:]
+    cmp = get_workspace(p).cmp
+    indcpa_enc(cmp, buf, pk, kr[p.KYBER_SYMBYTES:], None, p)
+
+    fail = verify(ct, cmp, p.KYBER_CIPHERTEXTBYTES)
+
+    # Overwrite pre-k with z on re-encryption failure
+    prek = bytes(z) if fail else kr[:p.KYBER_SYMBYTES]
+
+    # hash concatenation of pre-k and H(c) to k
+    return kdf(prek + hash_h(ct), p.KYBER_SSBYTES)
+
+
+#################################################
+# Name:        Kyber
+#
+# Description: The bytes KEM API bound to one mode. Instances use frozen
+#              parameters instead of the global g, so Kyber512, Kyber768
+#              and Kyber1024 can be used concurrently from different
+#              threads without calling g.set_mode.
+#
+# Arguments:   - int mode: 2, 3 or 4
+##################################################
+class Kyber:
+    def __init__(self, mode:int):
+        self.params = get_params(mode)
+
+    def keypair(self, key_seed:bytes=None, z:bytes=None) -> Tuple[bytes, bytes]:
+        return keypair(key_seed, z, self.params)
+
+    def encaps(self, pk:bytes, seed:bytes=None) -> Tuple[bytes, bytes]:
+        return encaps(pk, seed, self.params)
+
+    def prepare_public_key(self, pk:bytes) -> PreparedPublicKey:
+        return PreparedPublicKey(pk, self.params)
+
+    def prepare_secret_key(self, sk:bytes) -> PreparedSecretKey:
+        return PreparedSecretKey(sk, self.params)
+
+    def decaps(self, ct:bytes, sk:bytes) -> bytes:
+        return decaps(ct, sk, self.params)
+
+Kyber512 = Kyber(2)
+Kyber768 = Kyber(3)
+Kyber1024 = Kyber(4)
@@ -0,0 +1,166 @@
+# Mode-specialized versions of the hot functions in poly.py and polyvec.py.
+#
+# The functions in poly.py and polyvec.py look up g.KYBER_Q, g.KYBER_N, ...
+# on every iteration and branch on the compressed sizes on every call. The
+# factories below build a copy of each function for one parameter set, with
+# all constants bound as locals and the branches resolved when the copy is
+# made. get_kernels builds the copies for a mode on first use and caches them.
+# Every kernel produces exactly the same output as the function it replaces.
+
+from codec import *
+
+
+#################################################
+# Name:        make_poly_reduce
+#
+# Description: Specialized poly_reduce. For |a| < BARRETT_EXACT (see
+#              reduce.py) barrett_reduce returns the centered
+#              representative of a mod q, which is computed here with a
+#              single modulo; larger inputs fall back to barrett_reduce.
+#
+# Arguments:   - Parameters p: parameters of the mode
+##################################################
+def make_poly_reduce(p:Parameters):
+    Q, HALF, EXACT = p.KYBER_Q, p.KYBER_Q//2, BARRETT_EXACT
+
+    def kernel_poly_reduce(r:poly):
+        c = r.coeffs
+        if -EXACT < min(c) and max(c) < EXACT:
+            c[:] = array("i", [(x + HALF) % Q - HALF for x in c])
+        else:
+            poly_reduce(r)
+    return kernel_poly_reduce
+
+
+#################################################
+# Name:        make_poly_tomont
+#
+# Description: Specialized poly_tomont with montgomery_reduce inlined
+#
+# Arguments:   - Parameters p: parameters of the mode
+##################################################
+def make_poly_tomont(p:Parameters):
+    Q, HALF, F = p.KYBER_Q, p.KYBER_Q>>1, (1<<32) % p.KYBER_Q
+
+    def kernel_poly_tomont(r:poly):
+        t = [((x - ((x*QINV) & 0xFFFF)*Q) >> 16) + Q for x in [a*F for a in r.coeffs]]
+        r.coeffs[:] = array("i", [x - Q if x > HALF else x for x in t])
+    return kernel_poly_tomont
+
+
+#################################################
+# Name:        make_poly_tobytes
+#
+# Description: Specialized poly_tobytes and poly_frombytes. Both take an
+#              offset into the byte array so polyvecs and keys can be
+#              written and read in place; bytes-like input is read
+#              through a memoryview instead of being copied.
+#
+# Arguments:   - Parameters p: parameters of the mode
+#              - int NBYTES: packed size, POLYBYTES or POLYVECBYTES
+##################################################
+def make_poly_tobytes(p:Parameters, NBYTES:int):
+    Q = p.KYBER_Q
+
+    def kernel_poly_tobytes(r:List[int], a:poly, off:int=0):
+        t = [x + ((x >> 15) & Q) for x in a.coeffs]
+        r[off:off+NBYTES] = [b for t0, t1 in zip(t[0::2], t[1::2])
+                               for b in (t0 & 255, (t0 >> 8) | (t1 << 4) & 255, (t1 >> 4) & 255)]
+
+    def kernel_poly_frombytes(r:poly, a:List[int], off:int=0):
+        a = byte_view(a, off, NBYTES)
+        r.coeffs[:] = array("i", [c for a0, a1, a2 in zip(a[0::3], a[1::3], a[2::3])
+                                    for c in ((a0 | (a1 << 8)) & 0xFFF, ((a1 >> 4) | (a2 << 4)) & 0xFFF)])
+    return kernel_poly_tobytes, kernel_poly_frombytes
+
+
+#################################################
+# Name:        make_poly_compress
+#
+# Description: Specialized poly_compress and poly_decompress for the
+#              KYBER_POLYCOMPRESSEDBYTES of the mode, using the codec of
+#              codec.py for the bit width of the mode
+#
+# Arguments:   - Parameters p: parameters of the mode
+##################################################
+def make_poly_compress(p:Parameters):
+    return make_codec(p, 8*p.KYBER_POLYCOMPRESSEDBYTES//p.KYBER_N, p.KYBER_N)
+
+
+#################################################
+# Name:        make_polyvec_compress
+#
+# Description: Specialized polyvec_compress and polyvec_decompress for the
+#              KYBER_POLYVECCOMPRESSEDBYTES of the mode; one codec call
+#              covers all K polynomials
+#
+# Arguments:   - Parameters p: parameters of the mode
+##################################################
+def make_polyvec_compress(p:Parameters):
+    N = p.KYBER_K*p.KYBER_N
+    return make_codec(p, 8*p.KYBER_POLYVECCOMPRESSEDBYTES//N, N)
+
+
+#################################################
+# Name:        make_poly_msg
+#
+# Description: Specialized poly_frommsg and poly_tomsg; a message is a
+#              polynomial compressed to 1 bit per coefficient
+#
+# Arguments:   - Parameters p: parameters of the mode
+##################################################
+def make_poly_msg(p:Parameters):
+    compress, decompress = make_codec(p, 1, p.KYBER_N)
+
+    def kernel_poly_frommsg(r:poly, msg:List[int]):
+        decompress(r, msg)
+
+    def kernel_poly_tomsg(msg:List[int], a:poly):
+        compress(msg, a)
+    return kernel_poly_frommsg, kernel_poly_tomsg
+
+
+#################################################
+# Name:        Kernels
+#
+# Description: All specialized kernels of one mode. The polyvec kernels
+#              work on the K*N coefficient buffer of the polyvec at once.
+#
+# Arguments:   - Parameters p: parameters of the mode
+##################################################
+class Kernels:
+    def __init__(self, p:Parameters):
+        K = p.KYBER_K
+        self.mode = K
+
+        self.poly_reduce = poly_reduce_k = make_poly_reduce(p)
+        self.poly_tomont = make_poly_tomont(p)
+        self.poly_compress, self.poly_decompress = make_poly_compress(p)
+        self.polyvec_compress, self.polyvec_decompress = make_polyvec_compress(p)
+        self.poly_frommsg, self.poly_tomsg = make_poly_msg(p)
+
+        def kernel_polyvec_reduce(r:polyvec):
+            for i in range(K):
+                poly_reduce_k(r.vec[i])
+
+        self.polyvec_reduce = kernel_polyvec_reduce
+        # a polyvec keeps its K polynomials in one buffer, so the poly
+        # kernels sized for K*N coefficients pack it in one pass
+        self.polyvec_tobytes, self.polyvec_frombytes = make_poly_tobytes(p, p.KYBER_POLYVECBYTES)
+
+
+KERNELS = {}
+
+#################################################
+# Name:        get_kernels
+#
+# Description: Returns the specialized kernels for the mode of p,
+#              building them on first use
+#
+# Arguments:   - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def get_kernels(p:Parameters=g) -> Kernels:
+    kernels = KERNELS.get(p.KYBER_K)
+    if kernels is None:
+        kernels = KERNELS[p.KYBER_K] = Kernels(p)
+    return kernels
@@ -1,6 +1,14 @@
 # Contains elements from ntt.h and ntt.c
 
 from reduce import *
+from array import array
+from hashlib import sha256
+from sys import byteorder
+from tempfile import NamedTemporaryFile
+from threading import Lock
+from typing import Optional
+import os
+import struct
 
 zetas = [
   -1044,  -758,  -359, -1517,  1493,  1422,   287,   202,
@@ -89,6 +97,489 @@ def invntt(r:List[int]):
         r[j] = fqmul(r[j], f)
 
 
+# In the last layer of invntt, fqmul(fqmul(zetas[1], u), f) equals
+# fqmul(u, INVNTT_ZETA_F) for all |u| < 20969. The earlier layers leave
+# |u| < 5000 there, so invntt_radix4 folds the scaling by f = 1441 into
+# the twiddle of the last layer.
+INVNTT_ZETA_F = -5261
+
+#################################################
+# Name:        ntt_radix4
+#
+# Description: Same as ntt, with pairs of layers merged into radix-4
+#              butterflies on four coefficients held in locals, and
+#              fqmul inlined. Produces the same coefficients as ntt.
+#
+# Arguments:   - int r[256]: pointer to input/output vector of elements of Zq
+##################################################
+def ntt_radix4(r:List[int]):
+    Q, HALF = g.KYBER_Q, g.KYBER_Q>>1
+    for i in (0, 2, 4):
+        l = 128 >> i
+        h = l >> 1
+        for start in range(0, 256, 2*l):
+            b = start//(2*l)
+            z1, z2, z3 = zetas[(1 << i) + b], zetas[(2 << i) + 2*b], zetas[(2 << i) + 2*b + 1]
+            for j in range(start, start+h):
+                a0, a1, a2, a3 = r[j], r[j+h], r[j+l], r[j+l+h]
+
+                t = z1*a2
+                t = ((t - ((t*QINV) & 0xFFFF)*Q) >> 16) + Q
+                if t > HALF: t -= Q
+                a2 = a0 - t
+                a0 = a0 + t
+                t = z1*a3
+                t = ((t - ((t*QINV) & 0xFFFF)*Q) >> 16) + Q
+                if t > HALF: t -= Q
+                a3 = a1 - t
+                a1 = a1 + t
+
+                t = z2*a1
+                t = ((t - ((t*QINV) & 0xFFFF)*Q) >> 16) + Q
+                if t > HALF: t -= Q
+                a1 = a0 - t
+                a0 = a0 + t
+                t = z3*a3
+                t = ((t - ((t*QINV) & 0xFFFF)*Q) >> 16) + Q
+                if t > HALF: t -= Q
+                a3 = a2 - t
+                a2 = a2 + t
+
+                r[j], r[j+h], r[j+l], r[j+l+h] = a0, a1, a2, a3
+
+    # Layer 6 on its own
+    for j in range(0, 256, 4):
+        zeta = zetas[64 + j//4]
+        for j in (j, j+1):
+            t = zeta*r[j+2]
+            t = ((t - ((t*QINV) & 0xFFFF)*Q) >> 16) + Q
+            if t > HALF: t -= Q
+            r[j+2] = r[j] - t
+            r[j] = r[j] + t
+
+
+#################################################
+# Name:        invntt_radix4
+#
+# Description: Same as invntt, with pairs of layers merged into radix-4
+#              butterflies, fqmul and barrett_reduce inlined and the
+#              final multiplication by f folded into the last layer.
+#              Produces the same coefficients as invntt.
+#
+# Arguments:   - int r[256]: pointer to input/output vector of elements of Zq
+##################################################
+def invntt_radix4(r:List[int]):
+    Q, HALF, V = g.KYBER_Q, g.KYBER_Q>>1, ((1<<26) + g.KYBER_Q//2)//g.KYBER_Q
+    for i in (6, 4, 2):
+        l = 128 >> i
+        for start in range(0, 256, 4*l):
+            b = start//(4*l)
+            za, zb, zc = zetas[(2 << i) - 1 - 2*b], zetas[(2 << i) - 2 - 2*b], zetas[(1 << i) - 1 - b]
+            for j in range(start, start+l):
+                a0, a1, a2, a3 = r[j], r[j+l], r[j+2*l], r[j+3*l]
+
+                t = a0 + a1
+                a1 = za*(a1 - a0)
+                a0 = t - ((((V*t + (1 << 25)) >> 26)*Q) & 0xFFFF)
+                if a0 < -Q: a0 += 0x10000
+                a1 = ((a1 - ((a1*QINV) & 0xFFFF)*Q) >> 16) + Q
+                if a1 > HALF: a1 -= Q
+                t = a2 + a3
+                a3 = zb*(a3 - a2)
+                a2 = t - ((((V*t + (1 << 25)) >> 26)*Q) & 0xFFFF)
+                if a2 < -Q: a2 += 0x10000
+                a3 = ((a3 - ((a3*QINV) & 0xFFFF)*Q) >> 16) + Q
+                if a3 > HALF: a3 -= Q
+
+                t = a0 + a2
+                a2 = zc*(a2 - a0)
+                a0 = t - ((((V*t + (1 << 25)) >> 26)*Q) & 0xFFFF)
+                if a0 < -Q: a0 += 0x10000
+                a2 = ((a2 - ((a2*QINV) & 0xFFFF)*Q) >> 16) + Q
+                if a2 > HALF: a2 -= Q
+                t = a1 + a3
+                a3 = zc*(a3 - a1)
+                a1 = t - ((((V*t + (1 << 25)) >> 26)*Q) & 0xFFFF)
+                if a1 < -Q: a1 += 0x10000
+                a3 = ((a3 - ((a3*QINV) & 0xFFFF)*Q) >> 16) + Q
+                if a3 > HALF: a3 -= Q
+
+                r[j], r[j+l], r[j+2*l], r[j+3*l] = a0, a1, a2, a3
+
+    # Layer 0 with the multiplication by f = 1441
+    for j in range(128):
+        a0, a1 = r[j], r[j+128]
+        t = a0 + a1
+        t = t - ((((V*t + (1 << 25)) >> 26)*Q) & 0xFFFF)
+        if t < -Q: t += 0x10000
+        t *= 1441
+        t = ((t - ((t*QINV) & 0xFFFF)*Q) >> 16) + Q
+        if t > HALF: t -= Q
+        r[j] = t
+        t = INVNTT_ZETA_F*(a1 - a0)
+        t = ((t - ((t*QINV) & 0xFFFF)*Q) >> 16) + Q
+        if t > HALF: t -= Q
+        r[j+128] = t
+
+
+# Twiddle lookup tables. A table for zeta and window W is an int16 array of
+# length 2W holding fqmul(zeta, x) at index x for 0 <= x < W and at index
+# 2W+x for -W <= x < 0, so table[x] is a plain Python index for every x in
+# [-W, W). fqmul depends on x itself and not only on x mod q, so the window
+# has to cover every value a layer can see: with all input coefficients in
+# (-q, q), layer i of ntt sees |x| < (i+1)q and every layer of invntt sees
+# |x| < 2q, as do the barrett_reduce inputs of invntt.
+class TwiddleTables:
+    def __init__(self, cap:int=16 << 20, path:str=None):
+        self.lock = Lock()
+        self.enabled = False
+        self.configure(cap, path)
+
+    def configure(self, cap:int=None, path:str=None):
+        with self.lock:
+            if cap is not None:
+                self.cap = cap
+            if path is not None:
+                self.path = path
+            elif not hasattr(self, "path"):
+                self.path = None
+            # Layers are built on first use; False marks a layer
+            # that did not fit under the memory cap
+            self.ntt_layers = [None]*7
+            self.invntt_layers = [None]*7
+            self.barrett = None
+            self.nbytes = 0
+
+    def enable(self, cap:int=None, path:str=None):
+        self.configure(cap, path)
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+        self.configure()
+
+    # A table file holds a header naming q, W and the factors the tables
+    # were built for, the SHA-256 of the tables and the tables as
+    # little-endian int16. A file that does not match is rebuilt.
+    @staticmethod
+    def _header(factors:List[int], W:int) -> bytes:
+        return b"KYTW" + struct.pack(f"<3I{len(factors)}i", g.KYBER_Q, W, len(factors), *factors)
+
+    @staticmethod
+    def _load(file:str, header:bytes, size:int) -> Optional[array]:
+        try:
+            with open(file, "rb") as fh:
+                raw = fh.read()
+        except OSError:
+            return None
+        n = len(header) + 32
+        if len(raw) != n + size or raw[:n-32] != header or sha256(raw[n:]).digest() != raw[n-32:n]:
+            return None
+        data = array("h")
+        data.frombytes(raw[n:])
+        if byteorder == "big":
+            data.byteswap()
+        return data
+
+    def _store(self, file:str, header:bytes, data:array):
+        out = array("h", data)
+        if byteorder == "big":
+            out.byteswap()
+        out = out.tobytes()
+        # A temporary file of our own, so processes sharing the directory
+        # never write to the same file
+        tmp = None
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with NamedTemporaryFile("wb", dir=self.path, prefix=os.path.basename(file) + ".",
+                                    suffix=".tmp", delete=False) as fh:
+                tmp = fh.name
+                fh.write(header + sha256(out).digest() + out)
+            os.replace(tmp, file)
+        except OSError:
+            if tmp is not None:
+                try:
+                    os.remove(tmp)
+                except OSError:
+                    pass
+
+    # The tables of one layer, or None if they do not fit under the cap
+    def _build(self, name:str, factors:List[int], W:int, f) -> Optional[List[array]]:
+        size = 4*W*len(factors)
+        if self.nbytes + size > self.cap:
+            return None
+        header = self._header(factors, W)
+        file = os.path.join(self.path, f"kyber_{name}_{W}.bin") if self.path else None
+        data = self._load(file, header, size) if file is not None else None
+        if data is None:
+            data = array("h")
+            for z in factors:
+                data.extend(twiddle_table(z, W, f))
+            if file is not None:
+                self._store(file, header, data)
+        self.nbytes += size
+        return [data[2*W*k:2*W*(k+1)] for k in range(len(factors))]
+
+    def ntt_layer(self, i:int):
+        layer = self.ntt_layers[i]
+        if layer is None:
+            with self.lock:
+                layer = self.ntt_layers[i]
+                if layer is None:
+                    layer = self.ntt_layers[i] = self._build(f"ntt{i}", zetas[1 << i:2 << i], (i+1)*g.KYBER_Q, fqmul) or False
+        return layer
+
+    def invntt_layer(self, i:int):
+        layer = self.invntt_layers[i]
+        if layer is None:
+            with self.lock:
+                layer = self.invntt_layers[i]
+                if layer is None:
+                    # Layer 0 only needs the folded twiddle and f
+                    factors = [INVNTT_ZETA_F, 1441] if i == 0 else zetas[(2 << i)-1:(1 << i)-1:-1]
+                    layer = self.invntt_layers[i] = self._build(f"invntt{i}", factors, 2*g.KYBER_Q, fqmul) or False
+        return layer
+
+    def barrett_table(self):
+        if self.barrett is None:
+            with self.lock:
+                if self.barrett is None:
+                    table = self._build("barrett", [1], 2*g.KYBER_Q, lambda z, x: barrett_reduce(x))
+                    self.barrett = table[0] if table else False
+        return self.barrett
+
+twiddle_tables = TwiddleTables()
+if os.environ.get("KYBER_TWIDDLE_LUT"):
+    twiddle_tables.enable(int(float(os.environ["KYBER_TWIDDLE_LUT"])*(1 << 20)), os.environ.get("KYBER_TWIDDLE_CACHE"))
+
+
+#################################################
+# Name:        twiddle_table
+#
+# Description: Build the lookup table of f(z, x) for x in [-W, W)
+#
+# Arguments:   - int z: twiddle factor
+#              - int W: window
+#              - f: fqmul, or a function of the same signature
+#
+# Returns an int16 array of length 2W
+##################################################
+def twiddle_table(z:int, W:int, f) -> array:
+    if np is not None and f is fqmul:
+        x = np.concatenate((np.arange(W), np.arange(-W, 0)))
+        t = array("h")
+        t.frombytes(montgomery_reduce_np(z*x).astype(np.int16).tobytes())
+        return t
+    return array("h", [f(z, x) for x in range(W)] + [f(z, x) for x in range(-W, 0)])
+
+
+#################################################
+# Name:        ntt_lut_layer
+#
+# Description: Layer i of ntt, with lookups in tables if it is not False
+#
+# Arguments:   - int r[256]: pointer to input/output vector of elements of Zq
+#              - int i: layer
+#              - tables: twiddle_tables.ntt_layer(i)
+##################################################
+def ntt_lut_layer(r:List[int], i:int, tables):
+    Q, HALF = g.KYBER_Q, g.KYBER_Q>>1
+    l = 128 >> i
+    for b in range(1 << i):
+        start = 2*l*b
+        if tables:
+            z = tables[b]
+            for j in range(start, start+l):
+                t = z[r[j+l]]
+                r[j+l] = r[j] - t
+                r[j] = r[j] + t
+        else:
+            zeta = zetas[(1 << i) + b]
+            for j in range(start, start+l):
+                t = zeta*r[j+l]
+                t = ((t - ((t*QINV) & 0xFFFF)*Q) >> 16) + Q
+                if t > HALF: t -= Q
+                r[j+l] = r[j] - t
+                r[j] = r[j] + t
+
+
+#################################################
+# Name:        ntt_lut
+#
+# Description: Same as ntt_radix4, with fqmul by the zetas replaced by
+#              lookups in twiddle_tables. Pairs of layers that are not
+#              both in the tables (memory cap) are computed one layer at a
+#              time; with the tables disabled or input coefficients
+#              outside (-q, q) this is ntt_radix4.
+#              Produces the same coefficients as ntt.
+#
+# Arguments:   - int r[256]: pointer to input/output vector of elements of Zq
+##################################################
+def ntt_lut(r:List[int]):
+    if not twiddle_tables.enabled or min(r) <= -g.KYBER_Q or max(r) >= g.KYBER_Q:
+        ntt_radix4(r)
+        return
+
+    for i in (0, 2, 4):
+        t1, t2 = twiddle_tables.ntt_layer(i), twiddle_tables.ntt_layer(i+1)
+        if not (t1 and t2):
+            ntt_lut_layer(r, i, t1)
+            ntt_lut_layer(r, i+1, t2)
+            continue
+        l = 128 >> i
+        h = l >> 1
+        for start in range(0, 256, 2*l):
+            b = start//(2*l)
+            z1, z2, z3 = t1[b], t2[2*b], t2[2*b+1]
+            for j in range(start, start+h):
+                a0, a1, a2, a3 = r[j], r[j+h], r[j+l], r[j+l+h]
+                t = z1[a2]
+                a2 = a0 - t
+                a0 = a0 + t
+                t = z1[a3]
+                a3 = a1 - t
+                a1 = a1 + t
+                t = z2[a1]
+                r[j+h] = a0 - t
+                r[j] = a0 + t
+                t = z3[a3]
+                r[j+l+h] = a2 - t
+                r[j+l] = a2 + t
+    ntt_lut_layer(r, 6, twiddle_tables.ntt_layer(6))
+
+
+#################################################
+# Name:        invntt_lut_layer
+#
+# Description: Layer i > 0 of invntt, with lookups in tables if it is not
+#              False
+#
+# Arguments:   - int r[256]: pointer to input/output vector of elements of Zq
+#              - int i: layer
+#              - tables: twiddle_tables.invntt_layer(i)
+#              - B: twiddle_tables.barrett_table()
+##################################################
+def invntt_lut_layer(r:List[int], i:int, tables, B):
+    Q, HALF = g.KYBER_Q, g.KYBER_Q>>1
+    l = 128 >> i
+    for b in range(1 << i):
+        start = 2*l*b
+        if tables:
+            z = tables[b]
+            for j in range(start, start+l):
+                a0, a1 = r[j], r[j+l]
+                r[j] = B[a0 + a1]
+                r[j+l] = z[a1 - a0]
+        else:
+            zeta = zetas[(2 << i) - 1 - b]
+            for j in range(start, start+l):
+                a0, a1 = r[j], r[j+l]
+                r[j] = B[a0 + a1]
+                t = zeta*(a1 - a0)
+                t = ((t - ((t*QINV) & 0xFFFF)*Q) >> 16) + Q
+                if t > HALF: t -= Q
+                r[j+l] = t
+
+
+#################################################
+# Name:        invntt_lut
+#
+# Description: Same as invntt_radix4, with fqmul by the zetas and by f and
+#              barrett_reduce replaced by lookups in twiddle_tables.
+#              Pairs of layers that are not both in the tables are computed
+#              one layer at a time; with the tables disabled or input
+#              coefficients outside (-q, q) this is invntt_radix4.
+#              Produces the same coefficients as invntt.
+#
+# Arguments:   - int r[256]: pointer to input/output vector of elements of Zq
+##################################################
+def invntt_lut(r:List[int]):
+    Q, HALF = g.KYBER_Q, g.KYBER_Q>>1
+    B = twiddle_tables.enabled and twiddle_tables.barrett_table()
+    if not B or min(r) <= -Q or max(r) >= Q:
+        invntt_radix4(r)
+        return
+
+    for i in (6, 4, 2):
+        t1, t2 = twiddle_tables.invntt_layer(i), twiddle_tables.invntt_layer(i-1)
+        if not (t1 and t2):
+            invntt_lut_layer(r, i, t1, B)
+            invntt_lut_layer(r, i-1, t2, B)
+            continue
+        l = 128 >> i
+        for start in range(0, 256, 4*l):
+            b = start//(4*l)
+            za, zb, zc = t1[2*b], t1[2*b+1], t2[b]
+            for j in range(start, start+l):
+                a0, a1, a2, a3 = r[j], r[j+l], r[j+2*l], r[j+3*l]
+                a0, a1 = B[a0 + a1], za[a1 - a0]
+                a2, a3 = B[a2 + a3], zb[a3 - a2]
+                r[j], r[j+2*l] = B[a0 + a2], zc[a2 - a0]
+                r[j+l], r[j+3*l] = B[a1 + a3], zc[a3 - a1]
+
+    tables = twiddle_tables.invntt_layer(0)
+    if tables:
+        zf, f = tables
+        for j in range(128):
+            a0, a1 = r[j], r[j+128]
+            r[j] = f[B[a0 + a1]]
+            r[j+128] = zf[a1 - a0]
+    else:
+        for j in range(128):
+            a0, a1 = r[j], r[j+128]
+            t = B[a0 + a1]*1441
+            t = ((t - ((t*QINV) & 0xFFFF)*Q) >> 16) + Q
+            if t > HALF: t -= Q
+            r[j] = t
+            t = INVNTT_ZETA_F*(a1 - a0)
+            t = ((t - ((t*QINV) & 0xFFFF)*Q) >> 16) + Q
+            if t > HALF: t -= Q
+            r[j+128] = t
+
+
+#################################################
+# Name:        ntt_bound
+#
+# Description: Bound on the output coefficients of ntt (without the
+#              poly_reduce of poly_ntt) for input coefficients |x| <= B
+#
+# Arguments:   - int B: bound on the input
+##################################################
+def ntt_bound(B:int) -> int:
+    for i in range(7):
+        B += montgomery_bound(max(abs(z) for z in zetas)*B)
+    return B
+
+
+#################################################
+# Name:        invntt_bound
+#
+# Description: Bound on the output coefficients of invntt for input
+#              coefficients |x| <= B; raises ValueError if a
+#              barrett_reduce inside invntt could be inexact
+#
+# Arguments:   - int B: bound on the input
+##################################################
+def invntt_bound(B:int) -> int:
+    for i in range(7):
+        B = max(barrett_bound(2*B), montgomery_bound(max(abs(z) for z in zetas)*2*B))
+    return montgomery_bound(1441*B)
+
+
+#################################################
+# Name:        basemul_bound
+#
+# Description: Bound on the output coefficients of basemul for input
+#              coefficients |a| <= A and |b| <= B
+#
+# Arguments:   - int A: bound on the first factor
+#              - int B: bound on the second factor
+##################################################
+def basemul_bound(A:int, B:int) -> int:
+    t = montgomery_bound(A*B)
+    return max(montgomery_bound(t*max(abs(z) for z in zetas)) + t, 2*t)
+
+
 #################################################
 # Name:        basemul
 #
@@ -106,3 +597,79 @@ def basemul(r:List[int], a:List[int], b:List[int], zeta:int):
     r[0] += fqmul(a[0], b[0])
     r[1]  = fqmul(a[0], b[1])
     r[1] += fqmul(a[1], b[0])
+
+
+# Twiddle vectors for the NumPy engine. Layer i of the forward transform
+# works on 2^i blocks and uses zetas[2^i:2^(i+1)], one zeta per block.
+if np is not None:
+    zetas_np = [np.array(zetas[1<<i:2<<i], dtype=np.int64).reshape(-1, 1) for i in range(7)]
+    zetas_inv_np = [z[::-1].copy() for z in zetas_np]
+
+
+#################################################
+# Name:        ntt_array
+#
+# Description: Inplace NTT of a NumPy array, computing every layer with
+#              whole-array operations. Bit-identical to ntt.
+#              A 2-D array of shape (M, 256) transforms all M rows in
+#              one call.
+#
+# Arguments:   - ndarray a: contiguous int64 array of shape (256,) or (M, 256)
+##################################################
+def ntt_array(a):
+    for i in range(7):
+        l = 128 >> i
+        x = a.reshape(-1, 1 << i, 2, l)
+        t = montgomery_reduce_np(zetas_np[i]*x[..., 1, :])
+        x[..., 1, :] = x[..., 0, :] - t
+        x[..., 0, :] += t
+
+
+#################################################
+# Name:        invntt_array
+#
+# Description: Inplace inverse NTT and multiplication by Montgomery factor
+#              2^16 of a NumPy array. Bit-identical to invntt.
+#              A 2-D array of shape (M, 256) transforms all M rows in
+#              one call.
+#
+# Arguments:   - ndarray a: contiguous int64 array of shape (256,) or (M, 256)
+##################################################
+def invntt_array(a):
+    f = 1441
+    for i in range(6, -1, -1):
+        l = 128 >> i
+        x = a.reshape(-1, 1 << i, 2, l)
+        t = x[..., 0, :].copy()
+        x[..., 0, :] = barrett_reduce_np(t + x[..., 1, :])
+        x[..., 1, :] = montgomery_reduce_np(zetas_inv_np[i]*(x[..., 1, :] - t))
+    a[:] = montgomery_reduce_np(a*f)
+
+
+# Per coefficient pair zetas for basemul_array: zeta_i for pairs 4i, 4i+1
+# and -zeta_i for pairs 4i+2, 4i+3, as used by poly_basemul_montgomery.
+if np is not None:
+    zetas_basemul_np = np.array([z for i in range(64) for z in (zetas[64+i], -zetas[64+i])], dtype=np.int64)
+
+
+#################################################
+# Name:        basemul_array
+#
+# Description: Vectorized poly_basemul_montgomery on NumPy arrays of
+#              NTT-domain polynomials. Inputs are broadcast against each
+#              other, the products are not reduced.
+#
+# Arguments:   - ndarray a: int64 array of shape (..., 256)
+#              - ndarray b: int64 array of shape (..., 256)
+#
+# Returns int64 array of shape (..., 256) with the products a*b*R^-1
+##################################################
+def basemul_array(a, b):
+    a = a.reshape(a.shape[:-1] + (128, 2))
+    b = b.reshape(b.shape[:-1] + (128, 2))
+    a0, a1 = a[..., 0], a[..., 1]
+    b0, b1 = b[..., 0], b[..., 1]
+    r = np.empty(np.broadcast_shapes(a.shape, b.shape), dtype=np.int64)
+    r[..., 0] = montgomery_reduce_np(montgomery_reduce_np(a1*b1)*zetas_basemul_np) + montgomery_reduce_np(a0*b0)
+    r[..., 1] = montgomery_reduce_np(a0*b1) + montgomery_reduce_np(a1*b0)
+    return r.reshape(r.shape[:-2] + (256,))
@@ -2,8 +2,14 @@
 
 from typing import List
 
+# A Parameters object holds every constant of one Kyber mode. Functions that
+# depend on the mode take it as their last argument, p, which defaults to the
+# global g below. g can be switched with set_mode; the objects returned by
+# get_params are frozen and can be shared freely between threads.
+# KYBER_N, KYBER_Q and the other mode independent constants are the same in
+# every object, so code that only needs those reads them from g.
 class Parameters:
-    def __init__(self, mode:int):
+    def __init__(self, mode:int, frozen:bool=False):
         self.KYBER_K = mode
 
         assert self.KYBER_K in [2, 3, 4] and "KYBER_K must be in {2, 3, 4}"
@@ -42,8 +48,22 @@ class Parameters:
         self.KYBER_SECRETKEYBYTES  = (self.KYBER_INDCPA_SECRETKEYBYTES + self.KYBER_INDCPA_PUBLICKEYBYTES + 2*self.KYBER_SYMBYTES)
         self.KYBER_CIPHERTEXTBYTES = (self.KYBER_INDCPA_BYTES)
 
+        self.frozen = frozen
+
+    def __setattr__(self, name:str, value):
+        if getattr(self, "frozen", False):
+            raise AttributeError("Parameters of a fixed mode can't be modified")
+        super().__setattr__(name, value)
+
     def set_mode(self, mode:int):
         self.__init__(mode)
 
 g = Parameters(2)
 
+PARAMS = {mode: Parameters(mode, frozen=True) for mode in [2, 3, 4]}
+
+def get_params(mode:int) -> Parameters:
+    if mode not in PARAMS:
+        raise ValueError("mode must be in {2, 3, 4}")
+    return PARAMS[mode]
+
@@ -3,19 +3,111 @@
 from reduce import *
 from symmetric import *
 from ntt import *
+from array import array
+from sys import byteorder
 
 
+# Coefficients are stored in a flat int32 array instead of a list of Python
+# ints. A poly can also be a view into a larger buffer (see polyvec), in
+# which case coeffs is a memoryview of that buffer.
 class poly:
-    coeffs: List[int]
+    __slots__ = ("coeffs",)
+    coeffs: array
 
     def __init__(self, inp: list[int] = None):
+        if isinstance(inp, memoryview):
+            if len(inp) != g.KYBER_N:
+                raise ValueError("Polynomial view must have exactly N coeffs")
+            self.coeffs = inp
+            return
         if inp is None:
-            inp = [0 for _ in range(g.KYBER_N)]
+            inp = []
         if len(inp) > g.KYBER_N:
             raise ValueError("Polynomial can't have more than N coeffs")
+        self.coeffs = array("i", inp)
         if len(inp) < g.KYBER_N:
-            inp = inp + [0 for _ in range(g.KYBER_N-len(inp))].copy()
-        self.coeffs = inp
+            self.coeffs.extend(array("i", [0])*(g.KYBER_N-len(inp)))
+
+    # A memoryview cannot be pickled, so a poly is pickled as a copy of
+    # its coefficients
+    def __reduce__(self):
+        return poly, (array("i", self.coeffs),)
+
+
+#################################################
+# Name:        poly_to_array
+#
+# Description: Copy the coefficients of several polynomials
+#              into one NumPy array
+#
+# Arguments:   - List[poly] r: input polynomials
+#
+# Returns an int64 array of shape (len(r), N)
+##################################################
+def poly_to_array(r:List[poly]):
+    return np.array([np.frombuffer(p.coeffs, dtype=np.int32) for p in r], dtype=np.int64)
+
+
+#################################################
+# Name:        poly_from_array
+#
+# Description: Write the rows of a NumPy array back into polynomials
+#
+# Arguments:   - List[poly] r: output polynomials
+#              - ndarray a: input array of shape (len(r), N)
+##################################################
+def poly_from_array(r:List[poly], a):
+    for p, c in zip(r, a):
+        np.frombuffer(p.coeffs, dtype=np.int32)[:] = c
+
+
+#################################################
+# Name:        byte_view
+#
+# Description: Bytes off to off+n of a byte array; a zero-copy view
+#              if a is bytes-like, a copy if it is a list
+#
+# Arguments:   - List[int] a: input byte array
+#              - int off: offset of the first byte
+#              - int n: number of bytes
+##################################################
+def byte_view(a:List[int], off:int, n:int):
+    if isinstance(a, list):
+        return a[off:off+n]
+    return memoryview(a).cast("B")[off:off+n]
+
+
+#################################################
+# Name:        bytes_to_array
+#
+# Description: numpy version of byte_view; a zero-copy uint8 array
+#              if a is bytes-like
+#
+# Arguments:   - List[int] a: input byte array
+#              - int off: offset of the first byte
+#              - int n: number of bytes
+##################################################
+def bytes_to_array(a:List[int], off:int, n:int):
+    if isinstance(a, list):
+        return np.array(a[off:off+n], dtype=np.uint8)
+    return np.frombuffer(a, dtype=np.uint8, count=n, offset=off)
+
+
+#################################################
+# Name:        store_bytes
+#
+# Description: Write a uint8 array to bytes off to off+len(t) of r,
+#              in place if r is a writable buffer
+#
+# Arguments:   - List[int] r: output byte array
+#              - int off: offset of the first byte
+#              - ndarray t: bytes to write
+##################################################
+def store_bytes(r:List[int], off:int, t):
+    if isinstance(r, list):
+        r[off:off+len(t)] = t.tolist()
+    else:
+        np.frombuffer(r, dtype=np.uint8)[off:off+len(t)] = t
 
 
 #################################################
@@ -100,18 +192,88 @@ def cbd3(r:poly, buf:List[int]):
             r.coeffs[4*i+j] = a - b
 
 
-def poly_cbd_eta1(r:poly, buf:List[int]):
-    assert g.KYBER_ETA1 in [2, 3] and "This implementation requires eta1 in {2,3}"
-    if g.KYBER_ETA1 == 2:
-        cbd2(r, buf)
-    elif g.KYBER_ETA1 == 3:
-        cbd3(r, buf)
+# Lookup tables for the centered binomial distribution. A coefficient with
+# parameter eta is the bit count of eta input bits minus the bit count of
+# the next eta bits, so cbd2 turns each nibble and cbd3 each 6 bits into
+# one coefficient. CBD2_TABLE maps a byte and CBD3_TABLE a 12-bit group
+# to the pair of coefficients they produce.
+def _cbd_coeff(x:int, eta:int) -> int:
+    a = sum((x >> i) & 1 for i in range(eta))
+    b = sum((x >> (eta+i)) & 1 for i in range(eta))
+    return a - b
+
+CBD2_TABLE = [(_cbd_coeff(x & 15, 2), _cbd_coeff(x >> 4, 2)) for x in range(1 << 8)]
+CBD3_TABLE = [(_cbd_coeff(x & 63, 3), _cbd_coeff(x >> 6, 3)) for x in range(1 << 12)]
+
+
+#################################################
+# Name:        cbd2_table
+#
+# Description: Table-driven cbd2; maps every input byte straight to two
+#              coefficients. Same output as cbd2.
+#
+# Arguments:   - poly r: output polynomial
+#              - List[int] buf: input byte array
+##################################################
+def cbd2_table(r:poly, buf:List[int]):
+    table = CBD2_TABLE
+    r.coeffs[:] = array("i", [c for x in buf[:g.KYBER_N//2] for c in table[x]])
+
+
+#################################################
+# Name:        cbd3_table
+#
+# Description: Table-driven cbd3; maps every 12-bit group of the input
+#              to two coefficients. Same output as cbd3.
+#
+# Arguments:   - poly r: output polynomial
+#              - List[int] buf: input byte array
+##################################################
+def cbd3_table(r:poly, buf:List[int]):
+    table = CBD3_TABLE
+    t = int.from_bytes(bytes(buf[:3*g.KYBER_N//4]), "little")
+    r.coeffs[:] = array("i", [c for i in range(0, 6*g.KYBER_N, 12) for c in table[(t >> i) & 0xFFF]])
+
+
+if np is not None:
+    CBD2_TABLE_NP = np.array(CBD2_TABLE, dtype=np.int64)
+    CBD3_TABLE_NP = np.array(CBD3_TABLE, dtype=np.int64)
+
+
+#################################################
+# Name:        cbd_np
+#
+# Description: Vectorized centered binomial sampler for many polynomials
+#              at once. Same output as cbd2/cbd3 applied to every row.
+#
+# Arguments:   - ndarray buf: uint8 array of shape (M, eta*N/4)
+#              - int eta: 2 or 3
+#
+# Returns an int64 array of shape (M, N)
+##################################################
+def cbd_np(buf, eta:int):
+    buf = buf.reshape(buf.shape[0], eta*g.KYBER_N//4)
+    if eta == 2:
+        return CBD2_TABLE_NP[buf].reshape(buf.shape[0], g.KYBER_N)
+    b = buf.reshape(buf.shape[0], -1, 3).astype(np.int64)
+    t = np.empty(b.shape[:2] + (2,), dtype=np.int64)
+    t[..., 0] = b[..., 0] | ((b[..., 1] & 15) << 8)
+    t[..., 1] = (b[..., 1] >> 4) | (b[..., 2] << 4)
+    return CBD3_TABLE_NP[t].reshape(buf.shape[0], g.KYBER_N)
+
+
+def poly_cbd_eta1(r:poly, buf:List[int], p:Parameters=g):
+    assert p.KYBER_ETA1 in [2, 3] and "This implementation requires eta1 in {2,3}"
+    if p.KYBER_ETA1 == 2:
+        cbd2_table(r, buf)
+    elif p.KYBER_ETA1 == 3:
+        cbd3_table(r, buf)
 
 
 def poly_cbd_eta2(r:poly, buf:List[int]):
     assert g.KYBER_ETA2 == 2 and "This implementation requires eta2 = 2"
     if g.KYBER_ETA2 == 2:
-        cbd2(r, buf)
+        cbd2_table(r, buf)
 
 
 #################################################
@@ -122,16 +284,17 @@ def poly_cbd_eta2(r:poly, buf:List[int]):
 # Arguments:   - List[int] r: output byte array
 #                            (of length KYBER_POLYCOMPRESSEDBYTES)
 #              - poly a: input polynomial
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def poly_compress(r:List[int], a:poly):
+def poly_compress(r:List[int], a:poly, p:Parameters=g):
     t = [0]*8
-    if g.KYBER_POLYCOMPRESSEDBYTES == 128:
+    if p.KYBER_POLYCOMPRESSEDBYTES == 128:
         start = 0
-        for i in range(g.KYBER_N//8):
+        for i in range(p.KYBER_N//8):
             for j in range(8):
                 u = a.coeffs[8*i+j]
-                u += (u >> 15) & g.KYBER_Q
-                t[j] = (((u << 4) + g.KYBER_Q//2)//g.KYBER_Q) & 15
+                u += (u >> 15) & p.KYBER_Q
+                t[j] = (((u << 4) + p.KYBER_Q//2)//p.KYBER_Q) & 15
 
             r[start + 0] = t[0] | (t[1] << 4) & 255
             r[start + 1] = t[2] | (t[3] << 4) & 255
@@ -139,13 +302,13 @@ def poly_compress(r:List[int], a:poly):
             r[start + 3] = t[6] | (t[7] << 4) & 255
             start += 4;
 
-    elif g.KYBER_POLYCOMPRESSEDBYTES == 160:
+    elif p.KYBER_POLYCOMPRESSEDBYTES == 160:
         start = 0
-        for i in range(g.KYBER_N//8):
+        for i in range(p.KYBER_N//8):
             for j in range(8):
                 u = a.coeffs[8*i+j]
-                u += (u >> 15) & g.KYBER_Q
-                t[j] = (((u << 5) + g.KYBER_Q//2)//g.KYBER_Q) & 31
+                u += (u >> 15) & p.KYBER_Q
+                t[j] = (((u << 5) + p.KYBER_Q//2)//p.KYBER_Q) & 31
 
             r[start + 0] = (t[0] >> 0) | (t[1] << 5)               & 255
             r[start + 1] = (t[1] >> 3) | (t[2] << 2) | (t[3] << 7) & 255
@@ -164,19 +327,20 @@ def poly_compress(r:List[int], a:poly):
 # Arguments:   - poly r: output polynomial
 #              - List[int] a: input byte array
 #                             (of length KYBER_POLYCOMPRESSEDBYTES bytes)
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def poly_decompress(r:poly, a:List[int]):
-    if g.KYBER_POLYCOMPRESSEDBYTES == 128:
+def poly_decompress(r:poly, a:List[int], p:Parameters=g):
+    if p.KYBER_POLYCOMPRESSEDBYTES == 128:
         start = 0
-        for i in range(g.KYBER_N//2):
-            r.coeffs[2*i+0] = (((a[start + 0] & 15)*g.KYBER_Q) + 8) >> 4
-            r.coeffs[2*i+1] = (((a[start + 0] >> 4)*g.KYBER_Q) + 8) >> 4
+        for i in range(p.KYBER_N//2):
+            r.coeffs[2*i+0] = (((a[start + 0] & 15)*p.KYBER_Q) + 8) >> 4
+            r.coeffs[2*i+1] = (((a[start + 0] >> 4)*p.KYBER_Q) + 8) >> 4
             start += 1
 
-    elif g.KYBER_POLYCOMPRESSEDBYTES == 160:
+    elif p.KYBER_POLYCOMPRESSEDBYTES == 160:
         t = [0]*8
         start = 0
-        for i in range(g.KYBER_N//8):
+        for i in range(p.KYBER_N//8):
             t[0] = (a[start + 0] >> 0);
             t[1] = (a[start + 0] >> 5) | (a[start + 1] << 3);
             t[2] = (a[start + 1] >> 2);
@@ -188,7 +352,7 @@ def poly_decompress(r:poly, a:List[int]):
             start += 5;
 
             for j in range(8):
-                r.coeffs[8*i+j] = ((t[j] & 31)*g.KYBER_Q + 16) >> 5
+                r.coeffs[8*i+j] = ((t[j] & 31)*p.KYBER_Q + 16) >> 5
 
 
 #################################################
@@ -272,11 +436,12 @@ def poly_tomsg(msg:List[int], a:poly):
 #              - List[int] seed: input seed
 #                                (of length KYBER_SYMBYTES bytes)
 #              - int nonce: one-byte input nonce
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def poly_getnoise_eta1(r:poly, seed:List[int], nonce:int):
-    buf = [0]*(g.KYBER_ETA1*g.KYBER_N//4)
+def poly_getnoise_eta1(r:poly, seed:List[int], nonce:int, p:Parameters=g):
+    buf = [0]*(p.KYBER_ETA1*p.KYBER_N//4)
     prf(buf, len(buf), seed, nonce)
-    poly_cbd_eta1(r, buf)
+    poly_cbd_eta1(r, buf, p)
 
 
 #################################################
@@ -297,6 +462,27 @@ def poly_getnoise_eta2(r:poly, seed:List[int], nonce:int):
     poly_cbd_eta2(r, buf)
 
 
+#################################################
+# Name:        poly_getnoise_array
+#
+# Description: Sample count polynomials with nonces nonce, ..., nonce+count-1
+#              in one call; row i equals the output of poly_getnoise_eta1
+#              or poly_getnoise_eta2 for nonce+i.
+#
+# Arguments:   - List[int] seed: input seed
+#                                (of length KYBER_SYMBYTES bytes)
+#              - int nonce: first one-byte nonce
+#              - int count: number of polynomials
+#              - int eta: parameter of the binomial distribution (2 or 3)
+#
+# Returns an int64 array of shape (count, N)
+##################################################
+def poly_getnoise_array(seed:List[int], nonce:int, count:int, eta:int):
+    buflen = eta*g.KYBER_N//4
+    buf = prf_batch(buflen, seed, range(nonce, nonce+count))
+    return cbd_np(np.frombuffer(buf, dtype=np.uint8).reshape(count, buflen), eta)
+
+
 #################################################
 # Name:        poly_ntt
 #
@@ -344,6 +530,49 @@ def poly_basemul_montgomery(r:poly, a:poly, b:poly):
         r.coeffs[4*i+3] = temp[1] 
 
 
+# Kronecker substitution: a polynomial with coefficients in [0, q) is packed
+# into one Python int with a 64-bit slot per coefficient, so a polynomial
+# product is a single native big-integer multiplication. A product of two
+# packed polynomials has coefficients below N*q^2 < 2^32, so sums of up to
+# 2^32 products still fit their slots.
+KRONECKER_SLOTBYTES = 8
+
+#################################################
+# Name:        poly_to_kronecker
+#
+# Description: Pack a polynomial in normal domain into an int for
+#              multiplication by Kronecker substitution
+#
+# Arguments:   - poly a: input polynomial
+#
+# Returns the packed int
+##################################################
+def poly_to_kronecker(a:poly) -> int:
+    t = array("Q", [x % g.KYBER_Q for x in a.coeffs])
+    if byteorder == "big":
+        t.byteswap()
+    return int.from_bytes(t, "little")
+
+
+#################################################
+# Name:        poly_from_kronecker
+#
+# Description: Unpack a (sum of) products of packed polynomials, reduce it
+#              modulo X^N+1 and write the centered representatives mod q
+#              of its coefficients to r
+#
+# Arguments:   - poly r: output polynomial
+#              - int x: packed product
+##################################################
+def poly_from_kronecker(r:poly, x:int):
+    N, Q, HALF = g.KYBER_N, g.KYBER_Q, g.KYBER_Q//2
+    t = array("Q")
+    t.frombytes(x.to_bytes(2*N*KRONECKER_SLOTBYTES, "little"))
+    if byteorder == "big":
+        t.byteswap()
+    r.coeffs[:] = array("i", [(lo - hi + HALF) % Q - HALF for lo, hi in zip(t[:N], t[N:])])
+
+
 #################################################
 # Name:        poly_tomont
 #
@@ -2,17 +2,34 @@
 
 from poly import *
 
+# All K polynomials live in one int32 buffer of K*N coefficients;
+# vec[i] is a poly viewing coefficients i*N to (i+1)*N of it.
+# Polynomials passed in are copied into the buffer.
 class polyvec:
+    __slots__ = ("coeffs", "vec")
+    coeffs: array
     vec: List[poly]
 
-    def __init__(self, inp: list[poly] = None):
+    def __init__(self, inp: list[poly] = None, p:Parameters = g):
         if inp is None:
-            inp = [poly() for _ in range(g.KYBER_K)]
-        if len(inp) > g.KYBER_K:
+            inp = []
+        if len(inp) > p.KYBER_K:
             raise ValueError("Polynomial Vector can't have more than N polys")
-        if len(inp) < g.KYBER_K:
-            inp = inp + [poly() for _ in range(g.KYBER_K-len(inp))].copy()
-        self.vec = inp
+        self.coeffs = array("i", [0])*(p.KYBER_K*p.KYBER_N)
+        view = memoryview(self.coeffs)
+        self.vec = [poly(view[i*p.KYBER_N:(i+1)*p.KYBER_N]) for i in range(p.KYBER_K)]
+        for i in range(len(inp)):
+            self.vec[i].coeffs[:] = inp[i].coeffs
+
+    # Pickled as the coefficient buffer, the polys are views into it
+    def __reduce__(self):
+        return polyvec_from_coeffs, (self.coeffs,)
+
+
+def polyvec_from_coeffs(coeffs:array) -> polyvec:
+    r = polyvec(None, get_params(len(coeffs)//g.KYBER_N))
+    r.coeffs[:] = coeffs
+    return r
 
 
 #################################################
@@ -23,17 +40,18 @@ class polyvec:
 # Arguments:   - List[int] r: output byte array
 #                            (needs space for KYBER_POLYVECCOMPRESSEDBYTES)
 #              - polyvec a: input vector of polynomials
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def polyvec_compress(r:List[int], a:polyvec):
-    if g.KYBER_POLYVECCOMPRESSEDBYTES == (g.KYBER_K * 352):
+def polyvec_compress(r:List[int], a:polyvec, p:Parameters=g):
+    if p.KYBER_POLYVECCOMPRESSEDBYTES == (p.KYBER_K * 352):
         start = 0
         t = [0]*8
-        for i in range(g.KYBER_K):
-            for j in range(g.KYBER_N//8):
+        for i in range(p.KYBER_K):
+            for j in range(p.KYBER_N//8):
                 for k in range(8):
                     t[k] = a.vec[i].coeffs[8*j+k]
-                    t[k] += (t[k] >> 15) & g.KYBER_Q
-                    t[k] = (((t[k] << 11) + g.KYBER_Q//2)//g.KYBER_Q) & 0x7ff
+                    t[k] += (t[k] >> 15) & p.KYBER_Q
+                    t[k] = (((t[k] << 11) + p.KYBER_Q//2)//p.KYBER_Q) & 0x7ff
                 r[start + 0] = (t[0] >>  0)               & 255
                 r[start + 1] = (t[0] >>  8) | (t[1] << 3) & 255
                 r[start + 2] = (t[1] >>  5) | (t[2] << 6) & 255
@@ -47,15 +65,15 @@ def polyvec_compress(r:List[int], a:polyvec):
                 r[start +10] = (t[7] >>  3)               & 255
                 start += 11
 
-    elif g.KYBER_POLYVECCOMPRESSEDBYTES == (g.KYBER_K * 320):
+    elif p.KYBER_POLYVECCOMPRESSEDBYTES == (p.KYBER_K * 320):
         start = 0
         t = [0]*4
-        for i in range(g.KYBER_K):
-            for j in range(g.KYBER_N//4):
+        for i in range(p.KYBER_K):
+            for j in range(p.KYBER_N//4):
                 for k in range(4):
                     t[k] = a.vec[i].coeffs[4*j+k]
-                    t[k] += (t[k] >> 15) & g.KYBER_Q
-                    t[k] = (((t[k] << 10) + g.KYBER_Q//2)//g.KYBER_Q) & 0x3ff
+                    t[k] += (t[k] >> 15) & p.KYBER_Q
+                    t[k] = (((t[k] << 10) + p.KYBER_Q//2)//p.KYBER_Q) & 0x3ff
                 r[start + 0] = (t[0] >> 0)               & 255
                 r[start + 1] = (t[0] >> 8) | (t[1] << 2) & 255
                 r[start + 2] = (t[1] >> 6) | (t[2] << 4) & 255
@@ -73,13 +91,14 @@ def polyvec_compress(r:List[int], a:polyvec):
 # Arguments:   - polyvec r:   output vector of polynomials
 #              - List[int] a: input byte array
 #                             (of length KYBER_POLYVECCOMPRESSEDBYTES)
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def polyvec_decompress(r:polyvec, a:List[int]):
-    if g.KYBER_POLYVECCOMPRESSEDBYTES == (g.KYBER_K * 352):
+def polyvec_decompress(r:polyvec, a:List[int], p:Parameters=g):
+    if p.KYBER_POLYVECCOMPRESSEDBYTES == (p.KYBER_K * 352):
         start = 0
         t = [0]*8
-        for i in range(g.KYBER_K):
-            for j in range(g.KYBER_N//8):
+        for i in range(p.KYBER_K):
+            for j in range(p.KYBER_N//8):
                 t[0] = (a[start + 0] >> 0) | (a[start +  1] << 8)
                 t[1] = (a[start + 1] >> 3) | (a[start +  2] << 5)
                 t[2] = (a[start + 2] >> 6) | (a[start +  3] << 2) | (a[start+4] << 10)
@@ -91,13 +110,13 @@ def polyvec_decompress(r:polyvec, a:List[int]):
                 start += 11
                 
                 for k in range(8):
-                    r.vec[i].coeffs[8*j+k] = ((t[k] & 0x7ff)*g.KYBER_Q + 1024) >> 11
+                    r.vec[i].coeffs[8*j+k] = ((t[k] & 0x7ff)*p.KYBER_Q + 1024) >> 11
 
-    elif g.KYBER_POLYVECCOMPRESSEDBYTES == (g.KYBER_K * 320):
+    elif p.KYBER_POLYVECCOMPRESSEDBYTES == (p.KYBER_K * 320):
         start = 0
         t = [0]*4
-        for i in range(g.KYBER_K):
-            for j in range(g.KYBER_N//4):
+        for i in range(p.KYBER_K):
+            for j in range(p.KYBER_N//4):
                 t[0] = (a[start + 0] >> 0) | (a[start + 1] << 8);
                 t[1] = (a[start + 1] >> 2) | (a[start + 2] << 6);
                 t[2] = (a[start + 2] >> 4) | (a[start + 3] << 4);
@@ -105,7 +124,7 @@ def polyvec_decompress(r:polyvec, a:List[int]):
                 start += 5;
 
                 for k in range(4):
-                    r.vec[i].coeffs[4*j+k] = ((t[k] & 0x3ff)*g.KYBER_Q + 512) >> 10
+                    r.vec[i].coeffs[4*j+k] = ((t[k] & 0x3ff)*p.KYBER_Q + 512) >> 10
 
 
 #################################################
@@ -116,13 +135,14 @@ def polyvec_decompress(r:polyvec, a:List[int]):
 # Arguments:   - List[int] r: output byte array
 #                            (needs space for KYBER_POLYVECBYTES)
 #              - polyvec a: input vector of polynomials
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def polyvec_tobytes(r:List[int], a:polyvec):
-    temp = [0]*g.KYBER_POLYBYTES
-    for i in range(g.KYBER_K):
+def polyvec_tobytes(r:List[int], a:polyvec, p:Parameters=g):
+    temp = [0]*p.KYBER_POLYBYTES
+    for i in range(p.KYBER_K):
         poly_tobytes(temp, a.vec[i])
-        for j in range(g.KYBER_POLYBYTES):
-            r[i*g.KYBER_POLYBYTES+j] = temp[j]
+        for j in range(p.KYBER_POLYBYTES):
+            r[i*p.KYBER_POLYBYTES+j] = temp[j]
 
 
 #################################################
@@ -134,10 +154,79 @@ def polyvec_tobytes(r:List[int], a:polyvec):
 # Arguments:   - List[int] r: output byte array
 #              - polyvec a:   input vector of polynomials
 #                             (of length KYBER_POLYVECBYTES)
+#              - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def polyvec_frombytes(r:polyvec, a:List[int], p:Parameters=g):
+    for i in range(p.KYBER_K):
+        poly_frombytes(r.vec[i], a[i*p.KYBER_POLYBYTES:(i+1)*p.KYBER_POLYBYTES])
+
+
+#################################################
+# Name:        polyvec_tobytes_array
+#
+# Description: Serialize coefficients in (-q, q) to 12 bits each
+#
+# Arguments:   - ndarray t: integer array of shape (..., n), n even
+#              - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns uint8 array of shape (..., 3*n/2)
+##################################################
+def polyvec_tobytes_array(t, p:Parameters=g):
+    t = t.reshape(t.shape[:-1] + (-1, 2))
+    t = t + ((t >> 15) & p.KYBER_Q)
+    out = np.empty(t.shape[:-1] + (3,), dtype=np.uint8)
+    out[..., 0] = t[..., 0] & 255
+    out[..., 1] = (t[..., 0] >> 8) | ((t[..., 1] << 4) & 255)
+    out[..., 2] = (t[..., 1] >> 4) & 255
+    return out.reshape(out.shape[:-2] + (-1,))
+
+
+#################################################
+# Name:        polyvec_frombytes_array
+#
+# Description: Deserialize 12-bit coefficients; inverse of
+#              polyvec_tobytes_array
+#
+# Arguments:   - ndarray a: uint8 array of shape (..., m), m a multiple of 3
+#
+# Returns int32 array of shape (..., 2*m/3)
 ##################################################
-def polyvec_frombytes(r:polyvec, a:List[int]):
-    for i in range(g.KYBER_K):
-        poly_frombytes(r.vec[i], a[i*g.KYBER_POLYBYTES:(i+1)*g.KYBER_POLYBYTES])
+def polyvec_frombytes_array(a):
+    t = a.reshape(a.shape[:-1] + (-1, 3)).astype(np.int32)
+    c = np.empty(t.shape[:-1] + (2,), dtype=np.int32)
+    c[..., 0] = (t[..., 0] | (t[..., 1] << 8)) & 0xFFF
+    c[..., 1] = ((t[..., 1] >> 4) | (t[..., 2] << 4)) & 0xFFF
+    return c.reshape(c.shape[:-2] + (-1,))
+
+
+#################################################
+# Name:        polyvec_tobytes_np
+#
+# Description: numpy version of polyvec_tobytes; packs all polynomials
+#              at once and writes straight into r
+#
+# Arguments:   - List[int] r: output byte array
+#              - polyvec a: input vector of polynomials
+#              - int off: offset of the packed vector in r
+#              - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def polyvec_tobytes_np(r:List[int], a:polyvec, off:int=0, p:Parameters=g):
+    store_bytes(r, off, polyvec_tobytes_array(np.frombuffer(a.coeffs, dtype=np.int32), p))
+
+
+#################################################
+# Name:        polyvec_frombytes_np
+#
+# Description: numpy version of polyvec_frombytes; unpacks all
+#              polynomials at once from a zero-copy view of a
+#
+# Arguments:   - polyvec r: output vector of polynomials
+#              - List[int] a: input byte array
+#              - int off: offset of the packed vector in a
+#              - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def polyvec_frombytes_np(r:polyvec, a:List[int], off:int=0, p:Parameters=g):
+    np.frombuffer(r.coeffs, dtype=np.int32)[:] = polyvec_frombytes_array(bytes_to_array(a, off, p.KYBER_POLYVECBYTES))
 
 
 #################################################
@@ -148,8 +237,8 @@ def polyvec_frombytes(r:polyvec, a:List[int]):
 # Arguments:   - polyvec *r: pointer to in/output vector of polynomials
 ##################################################
 def polyvec_ntt(r:polyvec):
-    for i in range(g.KYBER_K):
-        poly_ntt(r.vec[i])
+    for a in r.vec:
+        poly_ntt(a)
 
 
 #################################################
@@ -161,8 +250,8 @@ def polyvec_ntt(r:polyvec):
 # Arguments:   - polyvec r: in/output vector of polynomials
 ##################################################
 def polyvec_invntt_tomont(r:polyvec):
-    for i in range(g.KYBER_K):
-        poly_invntt_tomont(r.vec[i])
+    for a in r.vec:
+        poly_invntt_tomont(a)
 
 
 #################################################
@@ -174,16 +263,77 @@ def polyvec_invntt_tomont(r:polyvec):
 # Arguments: - poly r: output polynomial
 #            - polyvec a: first input vector of polynomials
 #            - polyvec b: second input vector of polynomials
+#            - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def polyvec_basemul_acc_montgomery(r:poly, a:polyvec, b:polyvec):
+def polyvec_basemul_acc_montgomery(r:poly, a:polyvec, b:polyvec, p:Parameters=g):
     t = poly()
     poly_basemul_montgomery(r, a.vec[0], b.vec[0])
-    for i in range(1, g.KYBER_K):
+    for i in range(1, p.KYBER_K):
         poly_basemul_montgomery(t, a.vec[i], b.vec[i])
         poly_add(r, r, t)
     poly_reduce(r)
 
 
+#################################################
+# Name:        polyvec_matrix_to_array
+#
+# Description: Converts a matrix of polynomials to the int64 array of
+#              shape (rows, K, N) that polyvec_matrix_basemul_acc_np
+#              multiplies with
+#
+# Arguments: - List[polyvec] a: input matrix of polynomials
+#            - Parameters p: parameters of the mode (defaults to g)
+#
+# Returns the array
+##################################################
+def polyvec_matrix_to_array(a:List[polyvec], p:Parameters=g):
+    ma = np.array([np.frombuffer(row.coeffs, dtype=np.int32) for row in a], dtype=np.int64)
+    return ma.reshape(len(a), -1, p.KYBER_N)
+
+
+#################################################
+# Name:        polyvec_matrix_basemul_acc_np
+#
+# Description: Multiply a matrix of polynomials with a vector of
+#              polynomials in NTT domain; r[i] is the result of
+#              polyvec_basemul_acc_montgomery(r[i], a[i], b, p). All rows
+#              are computed in one vectorized numpy pass.
+#
+# Arguments: - List[poly] r: output polynomials, one per row of a
+#            - List[polyvec] a: input matrix of polynomials, or its
+#                               polyvec_matrix_to_array
+#            - polyvec b: input vector of polynomials
+#            - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def polyvec_matrix_basemul_acc_np(r:List[poly], a:List[polyvec], b:polyvec, p:Parameters=g):
+    ma = a if isinstance(a, np.ndarray) else polyvec_matrix_to_array(a, p)
+    vb = np.frombuffer(b.coeffs, dtype=np.int32).astype(np.int64)
+    t = basemul_array(ma, vb.reshape(-1, p.KYBER_N))
+    poly_from_array(r, barrett_reduce_np(t.sum(axis=1)))
+
+
+#################################################
+# Name:        polyvec_matrix_mul_kronecker
+#
+# Description: Multiply a matrix of polynomials with a vector of
+#              polynomials in normal domain by Kronecker substitution;
+#              r[i] = sum_j a[i][j]*b[j] in R_q with centered coefficients.
+#
+# Arguments: - List[poly] r: output polynomials, one per row of a
+#            - List[List[int]] a: input matrix, entries packed by
+#                                 poly_to_kronecker
+#            - polyvec b: input vector of polynomials
+#            - Parameters p: parameters of the mode (defaults to g)
+##################################################
+def polyvec_matrix_mul_kronecker(r:List[poly], a:List[List[int]], b:polyvec, p:Parameters=g):
+    bk = [poly_to_kronecker(b.vec[j]) for j in range(p.KYBER_K)]
+    for i in range(len(a)):
+        acc = 0
+        for j in range(p.KYBER_K):
+            acc += a[i][j]*bk[j]
+        poly_from_kronecker(r[i], acc)
+
+
 #################################################
 # Name:        polyvec_reduce
 #
@@ -192,9 +342,10 @@ def polyvec_basemul_acc_montgomery(r:poly, a:polyvec, b:polyvec):
 #              for details of the Barrett reduction see comments in reduce.c
 #
 # Arguments:   - polyvec r: input/output polynomial
+#              - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def polyvec_reduce(r:polyvec):
-    for i in range(g.KYBER_K):
+def polyvec_reduce(r:polyvec, p:Parameters=g):
+    for i in range(p.KYBER_K):
         poly_reduce(r.vec[i])
 
 
@@ -206,7 +357,8 @@ def polyvec_reduce(r:polyvec):
 # Arguments: - polyvec r: output vector of polynomials
 #            - polyvec a: first input vector of polynomials
 #            - polyvec b: second input vector of polynomials
+#            - Parameters p: parameters of the mode (defaults to g)
 ##################################################
-def polyvec_add(r:polyvec, a:polyvec, b:polyvec):
-    for i in range(g.KYBER_K):
+def polyvec_add(r:polyvec, a:polyvec, b:polyvec, p:Parameters=g):
+    for i in range(p.KYBER_K):
         poly_add(r.vec[i], a.vec[i], b.vec[i])
@@ -0,0 +1,167 @@
+# Process pool for the KEM.
+#
+# The KEM is pure Python, so threads cannot run more than one operation
+# at a time. KyberPool runs keypair, encaps and decaps requests in a
+# ProcessPoolExecutor instead. Every worker process is initialized once
+# with the mode and backend and keeps its caches between tasks: the
+# matrix cache, and prepared public and secret keys (see indcpa.py) for
+# the keys it has seen, bounded by KyberPool.KEY_CACHE_SIZE. Keys passed
+# to the constructor are prepared in every worker up front. Requests are
+# sent in chunks of chunksize operations, one task per chunk, to amortize
+# the cost of pickling and IPC. The results come back in request order.
+
+from kem import *
+from concurrent.futures import ProcessPoolExecutor
+
+
+#################################################
+# Name:        PoolWorker
+#
+# Description: The state a pool worker keeps between tasks: the mode
+#              and LRU caches of prepared public and secret keys
+#
+# Arguments:   - int mode: 2, 3 or 4
+#              - int cache_size: number of prepared keys kept per kind
+##################################################
+class PoolWorker:
+    def __init__(self, mode:int, cache_size:int):
+        self.kyber = Kyber(mode)
+        self.cache_size = cache_size
+        self.public_keys = OrderedDict()
+        self.secret_keys = OrderedDict()
+
+    def prepared(self, cache:OrderedDict, key:bytes, prepare):
+        prepared = cache.get(key)
+        if prepared is None:
+            prepared = cache[key] = prepare(key)
+            while len(cache) > self.cache_size:
+                cache.popitem(last=False)
+        else:
+            cache.move_to_end(key)
+        return prepared
+
+    def public_key(self, pk:bytes) -> PreparedPublicKey:
+        return self.prepared(self.public_keys, pk, self.kyber.prepare_public_key)
+
+    def secret_key(self, sk:bytes) -> PreparedSecretKey:
+        return self.prepared(self.secret_keys, sk, self.kyber.prepare_secret_key)
+
+# The state of the current worker process, set by init_worker
+worker = None
+
+def init_worker(mode:int, backend:str, cache_size:int, public_keys:List[bytes], secret_keys:List[bytes]):
+    global worker
+    set_backend(backend)
+    worker = PoolWorker(mode, cache_size)
+    for pk in public_keys:
+        worker.public_key(pk)
+    for sk in secret_keys:
+        worker.secret_key(sk)
+
+
+# The keys as bytes (workers use them as dict keys), with equal keys as one
+# object, which pickle sends only once per chunk
+def key_list(keys:List[bytes]) -> List[bytes]:
+    shared = {}
+    return [shared.setdefault(key, key) for key in map(bytes, keys)]
+
+
+# The values as bytes, checked to be size bytes long so that a bad one
+# fails here rather than in a worker
+def sized_list(values:List[bytes], size:int, name:str) -> List[bytes]:
+    values = [bytes(x) for x in values]
+    if any(len(x) != size for x in values):
+        raise ValueError(f"{name} must be {size} bytes long")
+    return values
+
+
+# Tasks; each one runs a chunk of requests in a worker
+def keypair_task(chunk:List[tuple]) -> List[Tuple[bytes, bytes]]:
+    return [worker.kyber.keypair(key_seed, z) for key_seed, z in chunk]
+
+def encaps_task(chunk:List[tuple]) -> List[Tuple[bytes, bytes]]:
+    return [worker.kyber.encaps(worker.public_key(pk), seed) for pk, seed in chunk]
+
+def decaps_task(chunk:List[tuple]) -> List[bytes]:
+    return [worker.kyber.decaps(ct, worker.secret_key(sk)) for ct, sk in chunk]
+
+
+#################################################
+# Name:        KyberPool
+#
+# Description: Runs KEM operations of one mode in worker processes.
+#              keypair, encaps and decaps take lists of requests and
+#              return the results in the same order. Use as a context
+#              manager or call close.
+#
+# Arguments:   - int mode: 2, 3 or 4
+#              - int workers: number of processes, defaults to os.cpu_count()
+#              - int chunksize: number of operations sent to a worker at once
+#              - List[bytes] public_keys: keys to prepare in every worker
+#              - List[bytes] secret_keys: keys to prepare in every worker
+#              - mp_context: optional multiprocessing context
+##################################################
+class KyberPool:
+    KEY_CACHE_SIZE = 16
+
+    def __init__(self, mode:int, workers:int=None, chunksize:int=16, public_keys:List[bytes]=(),
+                 secret_keys:List[bytes]=(), mp_context=None):
+        if chunksize < 1:
+            raise ValueError("chunksize must be at least 1")
+        self.params = get_params(mode)
+        self.chunksize = chunksize
+        public_keys = [bytes(pk) for pk in public_keys]
+        secret_keys = [bytes(sk) for sk in secret_keys]
+        # Fail here rather than in every worker
+        for pk in public_keys:
+            PreparedPublicKey(pk, self.params)
+        for sk in secret_keys:
+            PreparedSecretKey(sk, self.params)
+        self.executor = ProcessPoolExecutor(workers, mp_context, init_worker,
+                                            (mode, active_backend(), self.KEY_CACHE_SIZE, public_keys, secret_keys))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def run(self, task, requests:list) -> list:
+        chunks = [requests[i:i+self.chunksize] for i in range(0, len(requests), self.chunksize)]
+        return [result for results in self.executor.map(task, chunks) for result in results]
+
+    def keypair(self, n:int, key_seeds:List[bytes]=None, zs:List[bytes]=None) -> List[Tuple[bytes, bytes]]:
+        key_seeds = [None]*n if key_seeds is None else list(key_seeds)
+        zs = [None]*n if zs is None else list(zs)
+        if len(key_seeds) != n or len(zs) != n:
+            raise ValueError("keypair needs n key seeds and n values z")
+        return self.run(keypair_task, list(zip(key_seeds, zs)))
+
+    # pks is a list of public keys, or a single key used for n requests
+    def encaps(self, pks:List[bytes], seeds:List[bytes]=None, n:int=None) -> List[Tuple[bytes, bytes]]:
+        if isinstance(pks, (bytes, bytearray, memoryview)):
+            if n is None:
+                if seeds is None:
+                    raise ValueError("encaps with a single public key needs n or seeds")
+                n = len(seeds)
+            pks = [bytes(pks)]*n
+        else:
+            pks = key_list(pks)
+        seeds = [None]*len(pks) if seeds is None else sized_list(seeds, self.params.KYBER_SYMBYTES, "Seeds")
+        if len(seeds) != len(pks):
+            raise ValueError("encaps needs one seed per public key")
+        return self.run(encaps_task, list(zip(pks, seeds)))
+
+    # sks is a list of secret keys, or a single key used for every cipher text
+    def decaps(self, cts:List[bytes], sks:List[bytes]) -> List[bytes]:
+        cts = sized_list(cts, self.params.KYBER_CIPHERTEXTBYTES, "Cipher texts")
+        if isinstance(sks, (bytes, bytearray, memoryview)):
+            sks = [bytes(sks)]*len(cts)
+        else:
+            sks = key_list(sks)
+        if len(sks) != len(cts):
+            raise ValueError("decaps needs one secret key per cipher text")
+        return self.run(decaps_task, list(zip(cts, sks)))
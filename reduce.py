@@ -2,6 +2,11 @@
 
 from params import *
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 MONT = -1044 # 2^16 mod q
 QINV = -3327 # q^-1 mod 2^16
 
@@ -46,3 +51,72 @@ def barrett_reduce(a:int) -> int:
     if res < -g.KYBER_Q:
         res += 2**16
     return res
+
+
+#################################################
+# Name:        montgomery_reduce_np
+#
+# Description: Vectorized montgomery_reduce over a NumPy array. Produces
+#              exactly the same representatives as montgomery_reduce.
+#
+# Arguments:   - ndarray a: int64 array of integers to be reduced
+#
+# Returns int64 array congruent to a * R^-1 modulo q.
+##################################################
+def montgomery_reduce_np(a):
+    t = (a*QINV) & 0xFFFF
+    t = (a - t*g.KYBER_Q) >> 16
+    t += g.KYBER_Q
+    t -= g.KYBER_Q*(t > (g.KYBER_Q>>1))
+    return t
+
+
+#################################################
+# Name:        barrett_reduce_np
+#
+# Description: Vectorized barrett_reduce over a NumPy array. Produces
+#              exactly the same representatives as barrett_reduce.
+#
+# Arguments:   - ndarray a: int64 array of integers to be reduced
+#
+# Returns int64 array congruent to a modulo q.
+##################################################
+def barrett_reduce_np(a):
+    v = ((1<<26) + g.KYBER_Q//2)//g.KYBER_Q
+
+    t = (v*a + (1<<25)) >> 26
+    t *= g.KYBER_Q
+    t &= 0xFFFF
+    res = a - t
+    res += (res < -g.KYBER_Q)*(2**16)
+    return res
+
+
+# Bounds on the absolute value of the outputs of the reductions, used to
+# decide where a reduction can be skipped (see indcpa.py). barrett_reduce
+# emulates 16-bit arithmetic and is only correct mod q below this bound.
+BARRETT_EXACT = 64916
+
+#################################################
+# Name:        montgomery_bound
+#
+# Description: Bound on |montgomery_reduce(a)| for all |a| <= A
+#
+# Arguments:   - int A: bound on the input
+##################################################
+def montgomery_bound(A:int) -> int:
+    return max(g.KYBER_Q//2, (A >> 16) + 1)
+
+
+#################################################
+# Name:        barrett_bound
+#
+# Description: Bound on |barrett_reduce(a)| for all |a| <= A;
+#              raises ValueError if barrett_reduce is not correct there
+#
+# Arguments:   - int A: bound on the input
+##################################################
+def barrett_bound(A:int) -> int:
+    if A >= BARRETT_EXACT:
+        raise ValueError(f"barrett_reduce is not exact for inputs up to {A}")
+    return g.KYBER_Q//2
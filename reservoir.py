@@ -0,0 +1,164 @@
+# Pre-generated ephemeral key pairs.
+#
+# Key generation is dominated by gen_a, noise sampling and the NTTs, all
+# of which can be done before a request needs the key. KeypairReservoir
+# keeps a bounded queue of fresh key pairs that a background thread
+# fills: when the queue drops to low_water pairs the thread generates new
+# ones, refill_size at a time (through the batched KEM when numpy is
+# available), until the queue holds capacity pairs again. pop takes the
+# oldest pair in O(1). A pair is removed from the queue when it is handed
+# out and the reservoir keeps no other reference to it, so every pair is
+# handed out exactly once. If the queue is empty pop generates a pair
+# inline rather than wait for the thread; stats counts these as misses.
+# If generating fails, the thread records the error (see stats), waits
+# RETRY_DELAY seconds and tries again; a pending fill raises RuntimeError.
+
+from batch import *
+from collections import deque
+from threading import Condition, Thread
+from time import perf_counter
+
+
+#################################################
+# Name:        KeypairReservoir
+#
+# Description: Bounded queue of fresh key pairs of one mode, refilled
+#              in the background, see above. Use as a context manager
+#              or call close.
+#
+# Arguments:   - int mode: 2, 3 or 4
+#              - int capacity: maximum number of pairs kept
+#              - int low_water: refill when at most this many pairs are
+#                left, defaults to capacity//4
+#              - int refill_size: number of pairs generated at a time
+##################################################
+class KeypairReservoir:
+    RETRY_DELAY = 1.0
+
+    def __init__(self, mode:int, capacity:int=64, low_water:int=None, refill_size:int=16):
+        if low_water is None:
+            low_water = capacity//4
+        if capacity < 1 or not 0 <= low_water < capacity or refill_size < 1:
+            raise ValueError("Need capacity >= 1, 0 <= low_water < capacity and refill_size >= 1")
+        self.kyber = Kyber(mode)
+        self.capacity = capacity
+        self.low_water = low_water
+        self.refill_size = refill_size
+        self.pairs = deque()
+        self.condition = Condition()
+        self.closed = False
+        self.topup = False
+        self.hits = 0
+        self.misses = 0
+        self.refills = 0
+        self.refill_times = deque(maxlen=1000)
+        self.errors = 0
+        self.error = None
+        self.thread = Thread(target=self.refill_loop, name="KeypairReservoir", daemon=True)
+        self.thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.pairs)
+
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.pairs.clear()
+            self.condition.notify_all()
+        self.thread.join()
+
+    # Take the oldest pair, or generate one if the reservoir is empty
+    def pop(self) -> Tuple[bytes, bytes]:
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("The reservoir is closed")
+            if self.pairs:
+                pair = self.pairs.popleft()
+                self.hits += 1
+            else:
+                pair = None
+                self.misses += 1
+            if len(self.pairs) <= self.low_water:
+                self.condition.notify_all()
+        return pair or self.kyber.keypair()
+
+    def generate(self, n:int) -> List[Tuple[bytes, bytes]]:
+        p = self.kyber.params
+        if np is None:
+            return [self.kyber.keypair() for i in range(n)]
+        pks, sks = crypto_kem_keypair_batch(n, p=p)
+        return [(pks[i*p.KYBER_PUBLICKEYBYTES:(i+1)*p.KYBER_PUBLICKEYBYTES],
+                 sks[i*p.KYBER_SECRETKEYBYTES:(i+1)*p.KYBER_SECRETKEYBYTES]) for i in range(n)]
+
+    # Called with the condition held when a refill ends, once it filled
+    # the reservoir or failed
+    def count_refill(self, start:float):
+        self.refills += 1
+        self.refill_times.append(perf_counter() - start)
+
+    def refill_loop(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or self.topup or len(self.pairs) <= self.low_water)
+                if self.closed:
+                    return
+                self.topup = False
+            start = perf_counter()
+            generated = 0
+            while True:
+                with self.condition:
+                    missing = self.capacity - len(self.pairs)
+                if missing <= 0:
+                    break
+                try:
+                    pairs = self.generate(min(missing, self.refill_size))
+                except Exception as e:
+                    with self.condition:
+                        self.errors += 1
+                        self.error = e
+                        if generated:
+                            self.count_refill(start)
+                        self.condition.notify_all()
+                        if self.condition.wait_for(lambda: self.closed, self.RETRY_DELAY):
+                            return
+                    break
+                generated += len(pairs)
+                with self.condition:
+                    if self.closed:
+                        return
+                    self.pairs.extend(pairs[:self.capacity - len(self.pairs)])
+                    if len(self.pairs) >= self.capacity:
+                        self.count_refill(start)
+                    self.condition.notify_all()
+
+    # Refill to capacity and wait until the reservoir is full, e.g. before
+    # taking traffic; returns False on timeout and raises RuntimeError if
+    # generating pairs fails meanwhile
+    def fill(self, timeout:float=None) -> bool:
+        with self.condition:
+            self.topup = True
+            errors = self.errors
+            self.condition.notify_all()
+            full = self.condition.wait_for(lambda: self.closed or len(self.pairs) >= self.capacity
+                                           or self.errors > errors, timeout)
+            if self.errors > errors and not self.closed and len(self.pairs) < self.capacity:
+                raise RuntimeError("Refilling the reservoir failed") from self.error
+            return full
+
+    def stats(self) -> dict:
+        with self.condition:
+            times = list(self.refill_times)
+            requests = self.hits + self.misses
+            return {"size": len(self.pairs), "capacity": self.capacity, "low_water": self.low_water,
+                    "hits": self.hits, "misses": self.misses,
+                    "hit_rate": self.hits/requests if requests else 0.0,
+                    "refills": self.refills,
+                    "errors": self.errors, "last_error": repr(self.error) if self.error is not None else None,
+                    "refill_latency": {"last": times[-1], "mean": sum(times)/len(times), "max": max(times)}
+                                      if times else {}}
@@ -13,8 +13,8 @@ from fips202 import *
 #              - int j: additional byte of input
 ##################################################
 def kyber_shake128_absorb(state: SHAKE128.SHAKE128_XOF, seed:List[int], x:int, y:int):
-    extseed = seed + [x, y]
-    state.update(bytes(extseed))
+    extseed = bytes(seed) + bytes([x, y])
+    state.update(extseed)
 
 
 #################################################
@@ -29,18 +29,36 @@ def kyber_shake128_absorb(state: SHAKE128.SHAKE128_XOF, seed:List[int], x:int, y
 #              - int nonce: single-byte nonce (public PRF input)
 ##################################################
 def kyber_shake256_prf(out:List[int], outlen:int, key:List[int], nonce:int):
-    extkey = key+[nonce]
-    temp = shake256(bytes(extkey), outlen)
+    extkey = bytes(key) + bytes([nonce])
+    temp = shake256(extkey, outlen)
     for i in range(len(out)):
         out[i] = temp[i]
 
 
+#################################################
+# Name:        kyber_shake256_prf_batch
+#
+# Description: kyber_shake256_prf for a range of nonces. The outputs for
+#              all nonces are concatenated into one contiguous buffer.
+#
+# Arguments:   - int outlen: number of requested output bytes per nonce
+#              - int key: key (of length KYBER_SYMBYTES)
+#              - range nonces: single-byte nonces (public PRF input)
+#
+# Returns len(nonces)*outlen bytes; the output for nonces[i] starts at i*outlen
+##################################################
+def kyber_shake256_prf_batch(outlen:int, key:List[int], nonces:range) -> bytes:
+    key = bytes(key)
+    return b"".join([shake256(key + bytes([nonce]), outlen) for nonce in nonces])
+
+
 XOF_BLOCKBYTES = SHAKE128_RATE
 hash_h = sha3_256
 hash_g = sha3_512
 xof_absorb = kyber_shake128_absorb
 xof_squeezeblocks = shake128_squeezeblocks
 prf = kyber_shake256_prf
+prf_batch = kyber_shake256_prf_batch
 kdf = shake256
 
 xof_state = SHAKE128.new
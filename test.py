@@ -1,5 +1,14 @@
 from aes_drbg import AES_DRBG
 from kem import *
+from batch import *
+from pool import *
+from async_kem import *
+from reservoir import *
+from random import randint
+import os
+import pickle
+import shutil
+import tempfile
 
 
 def test_kyber2():
@@ -119,7 +128,775 @@ def test_kyber4():
     print("Kyber 1024 passes all KATs!")
 
 
+def test_bytes_api():
+    print("Testing bytes API")
+    for mode, kat in [(2, "KATs/PQCkemKAT_1632.rsp"), (3, "KATs/PQCkemKAT_2400.rsp"), (4, "KATs/PQCkemKAT_3168.rsp")]:
+        g.set_mode(mode)
+        f = open(kat, "r")
+        f.readline()
+        f.readline()
+        for i in range(10):
+            count = int(f.readline().split()[-1])
+            seed = bytes.fromhex(f.readline().split()[-1])
+            pk_kat = bytes.fromhex(f.readline().split()[-1])
+            sk_kat = bytes.fromhex(f.readline().split()[-1])
+            ct_kat = bytes.fromhex(f.readline().split()[-1])
+            ss_kat = bytes.fromhex(f.readline().split()[-1])
+            a = AES_DRBG(256)
+            a.instantiate(seed)
+            indcpa_seed = a.generate(g.KYBER_SYMBYTES)
+            z = a.generate(g.KYBER_SYMBYTES)
+            enc_seed = a.generate(g.KYBER_SYMBYTES)
+
+            pk, sk = keypair(indcpa_seed, z)
+            assert pk == pk_kat and sk == sk_kat
+            ct, ss = encaps(pk, enc_seed)
+            assert ct == ct_kat and ss == ss_kat
+            assert decaps(ct, sk) == ss
+            assert decaps(bytes(len(ct)), sk) != ss
+
+            f.readline()
+        f.close()
+    for key_seed, z in ((bytes(31), None), (None, bytes(33))):
+        try:
+            keypair(key_seed, z)
+            assert False
+        except ValueError:
+            pass
+    print("Bytes API passes KATs")
+
+
+def test_kyber_instances():
+    print("Testing concurrent Kyber instances")
+    from concurrent.futures import ThreadPoolExecutor
+
+    def roundtrip(kyber):
+        seed, z, enc_seed = urandom(32), urandom(32), urandom(32)
+        pk, sk = kyber.keypair(seed, z)
+        ct, ss = kyber.encaps(pk, enc_seed)
+        assert kyber.decaps(ct, sk) == ss
+        return seed, z, enc_seed, pk, sk, ct, ss
+
+    kybers = [Kyber512, Kyber768, Kyber1024]*4
+    with ThreadPoolExecutor(4) as pool:
+        results = list(pool.map(roundtrip, kybers))
+
+    for kyber, (seed, z, enc_seed, pk, sk, ct, ss) in zip(kybers, results):
+        g.set_mode(kyber.params.KYBER_K)
+        assert keypair(seed, z) == (pk, sk)
+        assert encaps(pk, enc_seed) == (ct, ss)
+
+    try:
+        Kyber768.params.set_mode(2)
+        assert False
+    except AttributeError:
+        pass
+    print("Concurrent Kyber instances work")
+
+
+def test_ntt_engines():
+    print("Testing NTT engines")
+    for i in range(100):
+        r = [randint(-2**15, 2**15-1) for _ in range(g.KYBER_N)]
+        a, b = r.copy(), r.copy()
+        ntt(a)
+        ntt_radix4(b)
+        assert a == b
+        a, b = r.copy(), r.copy()
+        invntt(a)
+        invntt_radix4(b)
+        assert a == b
+    assert all(fqmul(fqmul(zetas[1], u), 1441) == fqmul(u, INVNTT_ZETA_F) for u in range(-20968, 20969))
+
+    if np is None:
+        print("numpy not installed, skipping")
+        return
+    for i in range(100):
+        r = [randint(-g.KYBER_Q, g.KYBER_Q) for _ in range(g.KYBER_N)]
+        a, b = r.copy(), np.array(r, dtype=np.int64)
+        ntt(a)
+        ntt_array(b)
+        assert a == b.tolist()
+        invntt(a)
+        invntt_array(b)
+        assert a == b.tolist()
+
+    rows = [[randint(-g.KYBER_Q, g.KYBER_Q) for _ in range(g.KYBER_N)] for _ in range(8)]
+    batch = np.array(rows, dtype=np.int64)
+    ntt_array(batch)
+    for r in rows:
+        ntt(r)
+    assert batch.tolist() == rows
+    invntt_array(batch)
+    for r in rows:
+        invntt(r)
+    assert batch.tolist() == rows
+
+    a = [polyvec([poly([randint(-g.KYBER_Q, g.KYBER_Q) for _ in range(g.KYBER_N)]) for _ in range(g.KYBER_K)]) for _ in range(g.KYBER_K)]
+    b = polyvec([poly([randint(-g.KYBER_Q, g.KYBER_Q) for _ in range(g.KYBER_N)]) for _ in range(g.KYBER_K)])
+    r_ref, r_np = polyvec(), polyvec()
+    for i in range(g.KYBER_K):
+        polyvec_basemul_acc_montgomery(r_ref.vec[i], a[i], b)
+    polyvec_matrix_basemul_acc_np(r_np.vec, a, b)
+    assert r_np.coeffs == r_ref.coeffs
+    print("NTT engines agree")
+
+
+def test_rej_uniform():
+    print("Testing vectorized rejection sampling")
+    if np is None:
+        print("numpy not installed, skipping")
+        return
+    for buflen in [3, 96, 168, 504]:
+        buf = urandom(buflen)
+        r = [0]*g.KYBER_N
+        ctr = rej_uniform(r, g.KYBER_N, list(buf), buflen)
+        vals, n = rej_uniform_np(np.frombuffer(buf, dtype=np.uint8).reshape(1, -1), g.KYBER_N)
+        assert min(n[0], g.KYBER_N) == ctr
+        assert vals[0, :ctr].tolist() == r[:ctr]
+    for mode in (2, 3, 4):
+        p = get_params(mode)
+        seed = list(urandom(p.KYBER_SYMBYTES))
+        for transposed in (0, 1):
+            a = [polyvec(p=p) for i in range(p.KYBER_K)]
+            b = [polyvec(p=p) for i in range(p.KYBER_K)]
+            expand_matrix(a, seed, transposed, p)
+            gen_matrix_np(b, seed, transposed, p)
+            assert [x.coeffs for x in a] == [x.coeffs for x in b]
+    print("Vectorized rejection sampling agrees")
+
+
+def test_cbd():
+    print("Testing CBD samplers")
+    for i in range(50):
+        for eta, cbd_ref, cbd_fast in [(2, cbd2, cbd2_table), (3, cbd3, cbd3_table)]:
+            buf = list(urandom(eta*g.KYBER_N//4))
+            a, b = poly(), poly()
+            cbd_ref(a, buf)
+            cbd_fast(b, buf)
+            assert a.coeffs == b.coeffs
+            if np is not None:
+                c = cbd_np(np.frombuffer(bytes(buf), dtype=np.uint8).reshape(1, -1), eta)
+                assert c[0].tolist() == a.coeffs.tolist()
+    print("CBD samplers agree")
+
+
+def test_getnoise_batch():
+    print("Testing batched noise sampling")
+    active = active_backend()
+    for name in available_backends():
+        set_backend(name)
+        for mode in [2, 3, 4]:
+            g.set_mode(mode)
+            seed = list(urandom(g.KYBER_SYMBYTES))
+            r = [poly() for _ in range(g.KYBER_K+1)]
+            get_backend(g).getnoise(r, seed, 3, g.KYBER_ETA1)
+            for i in range(len(r)):
+                p = poly()
+                poly_getnoise_eta1(p, seed, 3+i)
+                assert p.coeffs == r[i].coeffs
+    set_backend(active)
+    print("Batched noise sampling agrees")
+
+
+def test_workspace():
+    print("Testing workspaces")
+    g.set_mode(2)
+    ws = Workspace()
+    pk = [0]*g.KYBER_INDCPA_PUBLICKEYBYTES
+    sk = [0]*g.KYBER_INDCPA_SECRETKEYBYTES
+    indcpa_keypair(pk, sk, None, ws)
+    m = list(urandom(g.KYBER_INDCPA_MSGBYTES))
+    coins = list(urandom(g.KYBER_SYMBYTES))
+    c1, c2 = [0]*g.KYBER_INDCPA_BYTES, [0]*g.KYBER_INDCPA_BYTES
+    indcpa_enc(c1, m, pk, coins, ws)
+    indcpa_enc(c2, m, pk, coins, Workspace())
+    assert c1 == c2
+    mp = [0]*g.KYBER_INDCPA_MSGBYTES
+    indcpa_dec(mp, c1, sk, ws)
+    assert mp == m
+
+    g.set_mode(3)
+    try:
+        indcpa_dec(mp, c1, sk, ws)
+        assert False
+    except ValueError:
+        pass
+    print("Workspaces work")
+
+
+def test_matrix_cache():
+    print("Testing matrix cache")
+    g.set_mode(3)
+    pk = [0]*g.KYBER_PUBLICKEYBYTES
+    sk = [0]*g.KYBER_SECRETKEYBYTES
+    crypto_kem_keypair(pk, sk)
+    matrix_cache.invalidate()
+    hits, misses = matrix_cache.hits, matrix_cache.misses
+
+    ct1, ct2 = [0]*g.KYBER_CIPHERTEXTBYTES, [0]*g.KYBER_CIPHERTEXTBYTES
+    ss1, ss2 = [0]*g.KYBER_SSBYTES, [0]*g.KYBER_SSBYTES
+    seed = list(urandom(g.KYBER_SYMBYTES))
+    crypto_kem_enc(ct1, ss1, pk, seed)
+    crypto_kem_enc(ct2, ss2, pk, seed)
+    assert ct1 == ct2 and ss1 == ss2
+    assert matrix_cache.misses == misses + 1
+    assert matrix_cache.hits == hits + 1
+
+    ssp = [0]*g.KYBER_SSBYTES
+    crypto_kem_dec(ssp, ct1, sk)
+    assert ssp == ss1
+    assert matrix_cache.hits == hits + 2
+
+    matrix_cache.invalidate(pk[g.KYBER_POLYVECBYTES:])
+    assert len(matrix_cache) == 0
+    print("Matrix cache works")
+
+
+def test_kernels():
+    print("Testing mode-specialized kernels")
+    for mode in (2, 3, 4):
+        p = get_params(mode)
+        kernels = get_kernels(p)
+        for i in range(20):
+            a, b = polyvec(p=p), polyvec(p=p)
+            a.coeffs[:] = array("i", [randint(-p.KYBER_Q+1, p.KYBER_Q-1) for j in range(p.KYBER_K*p.KYBER_N)])
+            b.coeffs[:] = a.coeffs
+            polyvec_reduce(a, p)
+            kernels.polyvec_reduce(b)
+            assert a.coeffs == b.coeffs
+
+            x, y = [0]*p.KYBER_POLYVECBYTES, [0]*p.KYBER_POLYVECBYTES
+            polyvec_tobytes(x, a, p)
+            kernels.polyvec_tobytes(y, a)
+            assert x == y
+            polyvec_frombytes(b, x, p)
+            kernels.polyvec_frombytes(a, x)
+            assert a.coeffs == b.coeffs
+
+            x, y = [0]*p.KYBER_INDCPA_BYTES, [0]*p.KYBER_INDCPA_BYTES
+            polyvec_compress(x, a, p)
+            poly_compress(x[p.KYBER_POLYVECCOMPRESSEDBYTES:], a.vec[0], p)
+            kernels.polyvec_compress(y, a)
+            kernels.poly_compress(y, a.vec[0], p.KYBER_POLYVECCOMPRESSEDBYTES)
+            assert x[:p.KYBER_POLYVECCOMPRESSEDBYTES] == y[:p.KYBER_POLYVECCOMPRESSEDBYTES]
+            x = list(urandom(p.KYBER_INDCPA_BYTES))
+            polyvec_decompress(a, x, p)
+            kernels.polyvec_decompress(b, x)
+            assert a.coeffs == b.coeffs
+            poly_decompress(a.vec[0], x[p.KYBER_POLYVECCOMPRESSEDBYTES:], p)
+            kernels.poly_decompress(b.vec[0], x, p.KYBER_POLYVECCOMPRESSEDBYTES)
+            assert a.coeffs == b.coeffs
+
+            c, d = poly(), poly()
+            c.coeffs[:] = array("i", [randint(-2**15, 2**15-1) for j in range(p.KYBER_N)])
+            d.coeffs[:] = c.coeffs
+            e = poly(list(c.coeffs))
+            e.coeffs[0] = d.coeffs[0] = randint(BARRETT_EXACT, 2**18)
+            poly_reduce(e)
+            kernels.poly_reduce(d)
+            assert e.coeffs == d.coeffs
+            d.coeffs[:] = c.coeffs
+            poly_tomont(c)
+            kernels.poly_tomont(d)
+            assert c.coeffs == d.coeffs
+            x, y = [0]*p.KYBER_INDCPA_MSGBYTES, [0]*p.KYBER_INDCPA_MSGBYTES
+            poly_tomsg(x, c)
+            kernels.poly_tomsg(y, c)
+            assert x == y
+            poly_frommsg(c, x)
+            kernels.poly_frommsg(d, x)
+            assert c.coeffs == d.coeffs
+    print("Kernels agree with the reference functions")
+
+
+def test_polyvec_codecs():
+    print("Testing polyvec pack/unpack codecs")
+    codecs = [get_kernels]
+    if np is not None:
+        codecs.append(numpy_backend)
+    for mode in (2, 3, 4):
+        p = get_params(mode)
+        n = p.KYBER_POLYVECBYTES
+        for codec in codecs:
+            codec = codec(p)
+            for i in range(10):
+                a, b = polyvec(p=p), polyvec(p=p)
+                a.coeffs[:] = array("i", [randint(-p.KYBER_Q+1, p.KYBER_Q-1) for j in range(p.KYBER_K*p.KYBER_N)])
+                x = [0]*n
+                polyvec_tobytes(x, a, p)
+                for y in ([0]*(n+5), bytearray(n+5)):
+                    codec.polyvec_tobytes(y, a, 5)
+                    assert list(y[5:]) == x and list(y[:5]) == [0]*5
+
+                x = list(urandom(n+7))
+                polyvec_frombytes(a, x[7:], p)
+                for y in (x, bytes(x), bytearray(x), memoryview(bytes(x))):
+                    b.coeffs[:] = array("i", [0]*(p.KYBER_K*p.KYBER_N))
+                    codec.polyvec_frombytes(b, y, 7)
+                    assert a.coeffs == b.coeffs
+
+
+def test_codec():
+    print("Testing the generic compression codec")
+    p = get_params(3)
+    Q = p.KYBER_Q
+    codecs = [make_codec]
+    if np is not None:
+        codecs.append(make_codec_np)
+    for d in (1, 4, 5, 10, 11):
+        for n in (256, 768):
+            a = poly() if n == 256 else polyvec(p=p)
+            for make in codecs:
+                compress, decompress = make(p, d, n)
+                for i in range(5):
+                    a.coeffs[:] = array("i", [randint(-Q, Q-1) for j in range(n)])
+                    if i == 4:
+                        a.coeffs[0] = 2**15-1
+                    t = [((((u + ((u >> 15) & Q)) << d) + Q//2)//Q) & ((1 << d) - 1) for u in a.coeffs]
+                    bits = [(x >> j) & 1 for x in t for j in range(d)]
+                    x = [sum(bits[8*k+j] << j for j in range(8)) for k in range(n*d//8)]
+                    y = bytearray(n*d//8 + 3)
+                    compress(y, a, 3)
+                    assert list(y[3:]) == x
+
+                    x = list(urandom(n*d//8))
+                    bits = [(b >> j) & 1 for b in x for j in range(8)]
+                    t = [sum(bits[d*k+j] << j for j in range(d)) for k in range(n)]
+                    decompress(a, bytes(x))
+                    assert list(a.coeffs) == [(u*Q + (1 << (d-1))) >> d for u in t]
+
+
+def test_backends():
+    print("Testing arithmetic backends")
+    active = active_backend()
+    assert active in available_backends()
+    try:
+        set_backend("nonexistent")
+        assert False
+    except ValueError:
+        pass
+    assert active_backend() == active
+
+    outputs = []
+    for name in available_backends():
+        set_backend(name)
+        assert active_backend() == name and get_backend().name == name
+        out = []
+        for kyber in (Kyber512, Kyber768, Kyber1024):
+            pk, sk = kyber.keypair(bytes(range(32)), bytes(range(32, 64)))
+            ct, ss = kyber.encaps(pk, bytes(range(64, 96)))
+            assert kyber.decaps(ct, sk) == ss
+            out.append((pk, sk, ct, ss))
+        outputs.append(out)
+    set_backend(active)
+    assert all(out == outputs[0] for out in outputs)
+    print(f"Backends {available_backends()} agree")
+
+
+def test_kronecker():
+    print("Testing Kronecker substitution multiplier")
+    for mode in (2, 3, 4):
+        p = get_params(mode)
+        for i in range(10):
+            a = [polyvec([poly([randint(-p.KYBER_Q+1, p.KYBER_Q-1) for k in range(p.KYBER_N)]) for j in range(p.KYBER_K)], p) for _ in range(p.KYBER_K)]
+            b = polyvec([poly([randint(-p.KYBER_Q+1, p.KYBER_Q-1) for k in range(p.KYBER_N)]) for j in range(p.KYBER_K)], p)
+            r, s = [poly() for _ in range(p.KYBER_K)], [poly() for _ in range(p.KYBER_K)]
+            ak = [[poly_to_kronecker(x) for x in row.vec] for row in a]
+            polyvec_matrix_mul_kronecker(r, ak, b, p)
+
+            for row in a:
+                polyvec_ntt(row)
+            polyvec_ntt(b)
+            for x, row in zip(s, a):
+                polyvec_basemul_acc_montgomery(x, row, b, p)
+            for x in s:
+                poly_invntt_tomont(x)
+                poly_reduce(x)
+            assert [x.coeffs for x in r] == [x.coeffs for x in s]
+
+    # Decapsulation only caches the public operands of the re-encryption
+    active = active_backend()
+    set_backend("kronecker")
+    pk, sk = Kyber768.keypair()
+    ct, ss = Kyber768.encaps(pk)
+    public_kronecker_operand.cache_clear()
+    Kyber768.encaps(pk)
+    public = public_kronecker_operand.cache_info().currsize
+    public_kronecker_operand.cache_clear()
+    assert Kyber768.decaps(ct, sk) == ss
+    assert public_kronecker_operand.cache_info().currsize == public
+    # Prepared keys keep their packed operands and skip the shared cache
+    seed = urandom(32)
+    enc = Kyber768.encaps(pk, seed)
+    public_kronecker_operand.cache_clear()
+    assert Kyber768.encaps(Kyber768.prepare_public_key(pk), seed) == enc
+    assert Kyber768.decaps(ct, Kyber768.prepare_secret_key(sk)) == ss
+    assert public_kronecker_operand.cache_info().currsize == 0
+    set_backend(active)
+    print("Kronecker substitution agrees with NTT multiplication")
+
+
+def test_twiddle_tables():
+    print("Testing twiddle lookup tables")
+    path = tempfile.mkdtemp()
+    for cap in (16 << 20, 1 << 20, 0, 16 << 20):
+        # The last round loads the tables written by the first
+        twiddle_tables.enable(cap, path)
+        for i in range(50):
+            r = [randint(-g.KYBER_Q+1, g.KYBER_Q-1) for _ in range(g.KYBER_N)]
+            a, b = r.copy(), r.copy()
+            ntt(a)
+            ntt_lut(b)
+            assert a == b
+            a, b = r.copy(), r.copy()
+            invntt(a)
+            invntt_lut(b)
+            assert a == b
+        assert twiddle_tables.nbytes <= cap
+    # Out of range inputs fall back to ntt_radix4 and invntt_radix4
+    r = [randint(-2**15, 2**15-1) for _ in range(g.KYBER_N)]
+    a, b = r.copy(), r.copy()
+    invntt(a)
+    invntt_lut(b)
+    assert a == b
+
+    active = active_backend()
+    set_backend("fast")
+    pk, sk = Kyber768.keypair(bytes(32), bytes(32))
+    twiddle_tables.disable()
+    assert (pk, sk) == Kyber768.keypair(bytes(32), bytes(32))
+
+    # Zeroed, truncated and stale (other q) table files are rebuilt
+    files = {name: open(os.path.join(path, name), "rb").read() for name in os.listdir(path)}
+    assert files
+    assert not [name for name in files if name.endswith(".tmp")]
+    for damage in (lambda raw: bytes(len(raw)), lambda raw: raw[:len(raw)//2], lambda raw: raw[:4] + bytes(4) + raw[8:]):
+        for name, raw in files.items():
+            with open(os.path.join(path, name), "wb") as fh:
+                fh.write(damage(raw))
+        twiddle_tables.enable(16 << 20, path)
+        assert (pk, sk) == Kyber768.keypair(bytes(32), bytes(32))
+        r = [randint(-g.KYBER_Q+1, g.KYBER_Q-1) for _ in range(g.KYBER_N)]
+        a, b = r.copy(), r.copy()
+        invntt(a)
+        invntt_lut(b)
+        assert a == b
+        twiddle_tables.disable()
+        assert all(open(os.path.join(path, name), "rb").read() == raw for name, raw in files.items())
+    set_backend(active)
+    shutil.rmtree(path)
+    print("Twiddle lookup tables agree with fqmul")
+
+
+def test_lazy_reduction():
+    print("Testing lazy reduction")
+    for i in range(20):
+        r = [randint(-g.KYBER_Q+1, g.KYBER_Q-1) for _ in range(g.KYBER_N)]
+        ntt(r)
+        assert max(map(abs, r)) <= ntt_bound(g.KYBER_Q-1)
+        invntt(r)
+        assert max(map(abs, r)) <= invntt_bound(ntt_bound(g.KYBER_Q-1))
+
+    active = active_backend()
+    for name in available_backends():
+        set_backend(name)
+        for kyber in (Kyber512, Kyber768, Kyber1024):
+            lazy_reduction.set_mode("eager")
+            pk, sk = kyber.keypair(bytes(32), bytes(32))
+            ct, ss = kyber.encaps(pk, bytes(32))
+            lazy_reduction.set_mode("validate")
+            for i in range(3):
+                lpk, lsk = kyber.keypair(bytes([i]*32), bytes(32))
+                lct, lss = kyber.encaps(lpk, bytes([i]*32))
+                assert kyber.decaps(lct, lsk) == lss
+            lazy_reduction.set_mode("lazy")
+            assert (pk, sk) == kyber.keypair(bytes(32), bytes(32))
+            assert (ct, ss) == kyber.encaps(pk, bytes(32))
+            assert kyber.decaps(ct, sk) == ss
+    lazy_reduction.set_mode("eager")
+    set_backend(active)
+    print("Lazy reduction gives the same encodings")
+
+
+def test_prepared_public_key():
+    print("Testing prepared public keys")
+    active = active_backend()
+    for name in available_backends():
+        set_backend(name)
+        for kyber in (Kyber512, Kyber768, Kyber1024):
+            p = kyber.params
+            pk, sk = kyber.keypair()
+            ppk = kyber.prepare_public_key(pk)
+            assert ppk.nbytes == PreparedPublicKey.footprint(p)
+            for i in range(3):
+                seed = urandom(32)
+                ct, ss = kyber.encaps(ppk, seed)
+                assert (ct, ss) == kyber.encaps(pk, seed)
+                assert kyber.decaps(ct, sk) == ss
+                ct1, ss1 = [0]*p.KYBER_CIPHERTEXTBYTES, [0]*p.KYBER_SSBYTES
+                crypto_kem_enc(ct1, ss1, ppk, list(seed), p)
+                assert bytes(ct1) == ct and bytes(ss1) == ss
+            # The per-backend operands are not pickled
+            assert ppk.operands and pickle.loads(pickle.dumps(ppk)).operands == {}
+            try:
+                Kyber512.encaps(ppk) if kyber is not Kyber512 else Kyber768.encaps(ppk)
+                assert False
+            except ValueError:
+                pass
+    set_backend(active)
+    try:
+        PreparedPublicKey(bytes(10))
+        assert False
+    except ValueError:
+        pass
+    print("Prepared public keys give the same ciphertexts")
+
+
+def test_prepared_secret_key():
+    print("Testing prepared secret keys")
+    active = active_backend()
+    for name in available_backends():
+        set_backend(name)
+        for kyber in (Kyber512, Kyber768, Kyber1024):
+            p = kyber.params
+            pk, sk = kyber.keypair()
+            psk = kyber.prepare_secret_key(sk)
+            assert psk.nbytes == PreparedSecretKey.footprint(p)
+            for i in range(3):
+                ct, ss = kyber.encaps(pk)
+                if i == 2:
+                    # Rejected ciphertexts give the same pseudo-random secret
+                    ct = bytes([ct[0] ^ 1]) + ct[1:]
+                    ss = kyber.decaps(ct, sk)
+                assert kyber.decaps(ct, psk) == ss
+                ss1 = [0]*p.KYBER_SSBYTES
+                crypto_kem_dec(ss1, list(ct), psk, p)
+                assert bytes(ss1) == ss
+            try:
+                Kyber512.decaps(ct, psk) if kyber is not Kyber512 else Kyber768.decaps(ct, psk)
+                assert False
+            except ValueError:
+                pass
+    set_backend(active)
+    try:
+        PreparedSecretKey(bytes(10))
+        assert False
+    except ValueError:
+        pass
+    print("Prepared secret keys give the same shared secrets")
+
+
+def test_batch():
+    print("Testing the batched KEM")
+    if np is None:
+        print("numpy is not installed, skipping")
+        return
+    n = 5
+    for kyber in (Kyber512, Kyber768, Kyber1024):
+        p = kyber.params
+        PK, SK, CT, S = p.KYBER_PUBLICKEYBYTES, p.KYBER_SECRETKEYBYTES, p.KYBER_CIPHERTEXTBYTES, p.KYBER_SYMBYTES
+        key_seeds, zs, seeds = urandom(n*S), urandom(n*S), urandom(n*S)
+        pks, sks = crypto_kem_keypair_batch(n, key_seeds, zs, p)
+        cts, sss = crypto_kem_enc_batch(pks, seeds, p)
+        assert crypto_kem_dec_batch(cts, sks, p) == sss
+        bad = bytearray(cts)
+        bad[CT-1] ^= 1
+        rejected = crypto_kem_dec_batch(bytes(bad), sks, p)
+        for i in range(n):
+            pk, sk = kyber.keypair(key_seeds[i*S:(i+1)*S], zs[i*S:(i+1)*S])
+            assert (pks[i*PK:(i+1)*PK], sks[i*SK:(i+1)*SK]) == (pk, sk)
+            ct, ss = kyber.encaps(pk, seeds[i*S:(i+1)*S])
+            assert (cts[i*CT:(i+1)*CT], sss[i*S:(i+1)*S]) == (ct, ss)
+            assert rejected[i*S:(i+1)*S] == kyber.decaps(bytes(bad[i*CT:(i+1)*CT]), sk)
+
+        # One public key for all items, one secret key for all cipher texts
+        pk, sk = kyber.keypair()
+        cts, sss = crypto_kem_enc_batch([pk]*n, None, p)
+        assert crypto_kem_dec_batch(cts, sk, p) == sss
+        try:
+            crypto_kem_enc_batch(pks[:-1], None, p)
+            assert False
+        except ValueError:
+            pass
+
+        # Empty batches give empty outputs
+        assert crypto_kem_keypair_batch(0, p=p) == (b"", b"")
+        assert crypto_kem_enc_batch(b"", None, p) == (b"", b"")
+        assert crypto_kem_dec_batch(b"", b"", p) == b""
+        assert crypto_kem_dec_batch(b"", sk, p) == b""
+    print("The batched KEM matches the single operations")
+
+
+def test_pool():
+    print("Testing the process pool")
+    kyber = Kyber768
+    pk, sk = kyber.keypair()
+    with KyberPool(3, 2, chunksize=3, secret_keys=[sk]) as pool:
+        key_seeds = [urandom(32) for i in range(7)]
+        zs = [urandom(32) for i in range(7)]
+        assert pool.keypair(7, key_seeds, zs) == [kyber.keypair(a, b) for a, b in zip(key_seeds, zs)]
+        seeds = [urandom(32) for i in range(10)]
+        results = pool.encaps(pk, seeds)
+        assert results == [kyber.encaps(pk, seed) for seed in seeds]
+        assert pool.decaps([ct for ct, ss in results], sk) == [ss for ct, ss in results]
+        keys = pool.keypair(4)
+        results = pool.encaps([pk for pk, sk in keys])
+        assert pool.decaps([ct for ct, ss in results], [sk for pk, sk in keys]) == [ss for ct, ss in results]
+        # bytearray and memoryview keys, in lists or on their own
+        results = pool.encaps([bytearray(pk) for pk, sk in keys])
+        assert pool.decaps([ct for ct, ss in results], [memoryview(sk) for pk, sk in keys]) == [ss for ct, ss in results]
+        results = pool.encaps(memoryview(pk), n=2)
+        assert pool.decaps([ct for ct, ss in results], bytearray(sk)) == [ss for ct, ss in results]
+        # Seeds and cipher texts are converted and checked before dispatch
+        seeds = [bytearray(seed) for seed in seeds[:2]]
+        results = pool.encaps(pk, seeds)
+        assert results == [kyber.encaps(pk, bytes(seed)) for seed in seeds]
+        assert pool.decaps([memoryview(ct) for ct, ss in results], sk) == [ss for ct, ss in results]
+        for call in (lambda: pool.decaps([results[0][0]]*2, [sk]),
+                     lambda: pool.encaps(pk, [bytes(31)]),
+                     lambda: pool.decaps([results[0][0][:-1]], sk)):
+            try:
+                call()
+                assert False
+            except ValueError:
+                pass
+    print("The process pool matches the single operations")
+
+
+def test_async():
+    print("Testing the asyncio front-end")
+    kyber = Kyber768
+    pk, sk = kyber.keypair()
+    seeds = [urandom(32) for i in range(12)]
+    expected = [kyber.encaps(pk, seed) for seed in seeds]
+
+    async def run(frontend):
+        results = await asyncio.gather(*[async_encaps(pk, seed, frontend, kyber.params) for seed in seeds])
+        assert list(results) == expected
+        secrets = await asyncio.gather(*[async_decaps(ct, sk, frontend, kyber.params) for ct, ss in results])
+        assert list(secrets) == [ss for ct, ss in expected]
+        assert await async_keypair(seeds[0], seeds[1], frontend, kyber.params) == kyber.keypair(seeds[0], seeds[1])
+
+    asyncio.run(run(None))
+    assert sorted(default_frontend(kyber.params).latency_percentiles()) == [50, 90, 99]
+    if np is not None:
+        with AsyncKyber(3, batch_window=0.01, max_batch=5) as frontend:
+            asyncio.run(run(frontend))
+            assert 0 < frontend.stats()["batches"] < 25
+
+    # Prepared keys are pickled to a process executor
+    async def prepared(frontend):
+        ppk, psk = kyber.prepare_public_key(pk), kyber.prepare_secret_key(sk)
+        results = await asyncio.gather(*[frontend.encaps(ppk, seed) for seed in seeds[:4]])
+        assert list(results) == expected[:4]
+        secrets = await asyncio.gather(*[frontend.decaps(ct, psk) for ct, ss in results])
+        assert list(secrets) == [ss for ct, ss in expected[:4]]
+    with ProcessPoolExecutor(2) as executor, AsyncKyber(3, executor) as frontend:
+        asyncio.run(prepared(frontend))
+    with AsyncKyber(3) as frontend:
+        asyncio.run(prepared(frontend))
+
+    # Prepared keys of another mode are rejected, batched or not
+    async def wrong_mode(frontend):
+        for call in (lambda: frontend.encaps(Kyber512.prepare_public_key(Kyber512.keypair()[0])),
+                     lambda: frontend.decaps(expected[0][0], Kyber512.prepare_secret_key(Kyber512.keypair()[1]))):
+            try:
+                await call()
+                assert False
+            except ValueError:
+                pass
+    with AsyncKyber(3) as frontend:
+        asyncio.run(wrong_mode(frontend))
+    if np is not None:
+        with AsyncKyber(3, batch_window=0.01) as frontend:
+            asyncio.run(wrong_mode(frontend))
+
+    async def overload():
+        with AsyncKyber(3, max_concurrency=1, max_pending=2) as frontend:
+            return await asyncio.gather(*[frontend.encaps(pk) for i in range(4)], return_exceptions=True)
+    results = asyncio.run(overload())
+    assert [isinstance(x, Overloaded) for x in results] == [False, False, True, True]
+    print("The asyncio front-end matches the single operations")
+
+
+def test_reservoir():
+    print("Testing the keypair reservoir")
+    with KeypairReservoir(3, capacity=8, low_water=2, refill_size=3) as reservoir:
+        assert reservoir.fill(60) and len(reservoir) == 8
+        seen = set()
+        for i in range(20):
+            pk, sk = reservoir.pop()
+            assert pk not in seen
+            seen.add(pk)
+            ct, ss = Kyber768.encaps(pk)
+            assert Kyber768.decaps(ct, sk) == ss
+        stats = reservoir.stats()
+        assert stats["hits"] + stats["misses"] == 20 and stats["refills"] >= 1
+        assert stats["refill_latency"]["max"] > 0
+        # Waking the thread on a full reservoir is not a refill
+        assert reservoir.fill(60)
+        refills = reservoir.stats()["refills"]
+        assert reservoir.fill(60) and reservoir.stats()["refills"] == refills
+    try:
+        reservoir.pop()
+        assert False
+    except RuntimeError:
+        pass
+    try:
+        KeypairReservoir(3, capacity=4, low_water=4)
+        assert False
+    except ValueError:
+        pass
+
+    # A failure in the thread is reported and the thread keeps running
+    class FailingReservoir(KeypairReservoir):
+        RETRY_DELAY = 0.01
+        failing = True
+
+        def generate(self, n:int):
+            if self.failing:
+                raise MemoryError("injected")
+            return super().generate(n)
+
+    with FailingReservoir(3, capacity=4, low_water=1, refill_size=2) as reservoir:
+        try:
+            reservoir.fill()
+            assert False
+        except RuntimeError as e:
+            assert isinstance(e.__cause__, MemoryError)
+        stats = reservoir.stats()
+        assert stats["errors"] >= 1 and "MemoryError" in stats["last_error"] and stats["refills"] == 0
+        pk, sk = reservoir.pop()
+        assert reservoir.stats()["misses"] == 1
+        reservoir.failing = False
+        assert reservoir.fill(60) and len(reservoir) == 4
+        assert reservoir.stats()["refills"] >= 1
+    print("The keypair reservoir hands out every pair once")
+
+
 if __name__ == "__main__":
     test_kyber2()
     test_kyber3()
     test_kyber4()
+    test_bytes_api()
+    test_kyber_instances()
+    test_ntt_engines()
+    test_rej_uniform()
+    test_cbd()
+    test_getnoise_batch()
+    test_workspace()
+    test_matrix_cache()
+    test_kernels()
+    test_polyvec_codecs()
+    test_codec()
+    test_backends()
+    test_kronecker()
+    test_twiddle_tables()
+    test_lazy_reduction()
+    test_prepared_public_key()
+    test_prepared_secret_key()
+    test_batch()
+    test_pool()
+    test_async()
+    test_reservoir()